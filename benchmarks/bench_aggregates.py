@@ -0,0 +1,174 @@
+"""Benchmark the aggregate paths used to build scores from the Results table.
+
+Builds a synthetic Races/Results database in memory and compares:
+
+* the season score build with the original XPercentile aggregate and Races_Rename CTE against the
+  current ones (using the generated Races columns), plus a window function (ROW_NUMBER) version for reference,
+* the original sum of squares stddev aggregate against the Welford aggregate and the native SQL
+  mean_std_sql query, both for speed and for accuracy against numpy.
+
+Usage:
+    python benchmarks/bench_aggregates.py [number of result rows]
+"""
+import math
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from fellpace.db.aggregates import XPercentile, std_dev, mean_std_sql
+from fellpace.db.migrations import SQL_ADD_RACE_COLUMNS
+from fellpace.db.season_scores import RACES_RENAME_SQL, SQL_CREATE_SEASON_SCORES, refresh_season_scores
+
+
+class LegacyXPercentile:
+    """XPercentile as it was before fellpace.db.aggregates."""
+    percentile = 0.2
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        self.values.append(value)
+
+    def finalize(self):
+        self.values.sort()
+        return self.values[round(self.percentile * (len(self.values)))-1]
+
+class LegacyStdDev:
+    """The sum of squares stddev aggregate as it was before fellpace.db.aggregates."""
+    def __init__(self):
+        self.n = 0
+        self.sum = 0
+        self.sq = 0
+
+    def step(self, value):
+        self.n += 1
+        self.sum += value
+        self.sq += value * value
+
+    def finalize(self):
+        return math.sqrt(self.sq/self.n - (self.sum/self.n * self.sum/self.n))
+
+
+LEGACY_SEASON_SCORES = """
+    WITH Races_Rename AS
+    (
+        SELECT CASE
+        WHEN Race_Name LIKE "Parkrun_endcliffe%" THEN "PR_Endcliffe"
+        WHEN Race_Name LIKE "Parkrun_hillsborough%" THEN "PR_Hillsborough"
+        ELSE Race_Name
+        END  AS Race_Name,
+        CASE
+            WHEN CAST(strftime("%m",Race_Date) AS INTEGER) > 5
+            THEN CAST(strftime("%Y",Race_Date) AS INTEGER)
+            ELSE CAST(strftime("%Y",Race_Date) AS INTEGER) -1
+        END AS Season,
+        Race_ID
+        FROM Races
+    )
+    SELECT Res.Racer_ID, C.Race_Name, C.Season, LegacyXPercentile(Res.ZScore_log) AS ZScore
+    FROM Results AS Res
+    JOIN Races_Rename AS C
+    ON C.Race_ID = Res.Race_ID
+    WHERE Res.Time IS NOT NULL
+    GROUP BY Res.Racer_ID, C.Race_Name, C.Season
+"""
+
+# XPercentile picks index round(0.2 * n) - 1, which only wraps to the largest value for n <= 2
+WINDOW_SEASON_SCORES = f"""
+    WITH {RACES_RENAME_SQL.replace('Races_Rename AS', 'Races_Rename AS MATERIALIZED')}
+    SELECT Racer_ID, Race_Name, Season, ZScore_log AS ZScore
+    FROM
+    (
+        SELECT Res.Racer_ID, C.Race_Name, C.Season, Res.ZScore_log,
+            ROW_NUMBER() OVER (PARTITION BY Res.Racer_ID, C.Race_Name, C.Season ORDER BY Res.ZScore_log) AS Row_Num,
+            COUNT(*) OVER (PARTITION BY Res.Racer_ID, C.Race_Name, C.Season) AS Num
+        FROM Results AS Res
+        JOIN Races_Rename AS C
+        ON C.Race_ID = Res.Race_ID
+        WHERE Res.Time IS NOT NULL
+    )
+    WHERE Row_Num = CASE WHEN Num <= 2 THEN Num ELSE CAST(round(0.2 * Num) AS INTEGER) END
+"""
+
+
+def build_database(n_rows: int, seed: int = 0) -> sqlite3.Connection:
+    rng = np.random.default_rng(seed)
+    con = sqlite3.connect(':memory:')
+    con.create_aggregate('XPercentile', 1, XPercentile)
+    con.create_aggregate('stddev', 1, std_dev)
+    con.create_aggregate('LegacyXPercentile', 1, LegacyXPercentile)
+    con.create_aggregate('LegacyStdDev', 1, LegacyStdDev)
+
+    # Mostly weekly parkruns with a few hundred other races, over 20 years
+    n_races = max(n_rows // 200, 10)
+    race_ids = np.arange(1, n_races + 1)
+    race_names = np.where(
+        race_ids % 3 == 0, 'Race ' + (race_ids % 150).astype(str),
+        np.where(race_ids % 3 == 1, 'Parkrun_endcliffe_', 'Parkrun_hillsborough_') + race_ids.astype(str)
+    )
+    race_dates = (pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 7300, n_races), unit='D')).strftime('%Y-%m-%d')
+    con.execute('CREATE TABLE Races (Race_ID INTEGER PRIMARY KEY, Race_Name TEXT, Race_Date TEXT)')
+    con.executemany('INSERT INTO Races VALUES (?,?,?)', zip(race_ids.tolist(), race_names.tolist(), race_dates))
+    con.executescript(SQL_ADD_RACE_COLUMNS)
+
+    # Racers run repeatedly so most racer/race/season groups have several results
+    con.execute('CREATE TABLE Results (Result_ID INTEGER PRIMARY KEY, Race_ID INTEGER, Racer_ID INTEGER, Time INTEGER, ZScore_log REAL)')
+    results = pd.DataFrame({
+        'Race_ID': rng.integers(1, n_races + 1, n_rows),
+        'Racer_ID': rng.integers(1, max(n_rows // 100, 2), n_rows),
+        'Time': rng.integers(900, 9000, n_rows),
+        'ZScore_log': np.round(rng.normal(0, 1, n_rows), 6),
+    })
+    results.to_sql('Results', con, index=False, if_exists='append')
+    return con
+
+
+def timed(label: str, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<55}{elapsed:8.2f}s')
+    return result, elapsed
+
+
+def main(n_rows: int = 3_000_000) -> None:
+    print(f'Building {n_rows:,} synthetic results')
+    con = build_database(n_rows)
+    sort_columns = ['Racer_ID', 'Race_Name', 'Season']
+
+    print('\nSeason scores (XPercentile per racer, race and season)')
+    legacy, legacy_t = timed('original XPercentile and Races_Rename CTE', lambda: pd.read_sql(LEGACY_SEASON_SCORES, con))
+    con.execute(SQL_CREATE_SEASON_SCORES)
+    _, current_t = timed('refresh_season_scores (full rebuild)', lambda: refresh_season_scores(con))
+    current = pd.read_sql('SELECT Racer_ID, Race_Name, Season, ZScore FROM Racer_Season_Scores', con)
+    window, _ = timed('ROW_NUMBER window functions (reference)', lambda: pd.read_sql(WINDOW_SEASON_SCORES, con))
+    for label, scores in (('refresh_season_scores', current), ('window functions', window)):
+        pd.testing.assert_frame_equal(
+            legacy.sort_values(sort_columns).reset_index(drop=True),
+            scores.sort_values(sort_columns).reset_index(drop=True),
+            check_exact=True
+        )
+        print(f'{label} matches the original exactly')
+    print(f'Speed up of the season score build: {legacy_t / current_t:.1f}x')
+
+    print('\nStandard deviation of log times per race')
+    log_times = '(SELECT Race_ID, ln(Time) AS Time_log FROM Results)'
+    legacy_sd, legacy_sd_t = timed('original sum of squares stddev aggregate', lambda: pd.read_sql(
+        f'SELECT Race_ID, LegacyStdDev(Time_log) AS StdDev FROM {log_times} GROUP BY Race_ID', con))
+    welford_sd, _ = timed('Welford stddev aggregate', lambda: pd.read_sql(
+        f'SELECT Race_ID, stddev(Time_log) AS StdDev FROM {log_times} GROUP BY Race_ID', con))
+    native_sd, native_sd_t = timed('mean_std_sql (native SQL)', lambda: pd.read_sql(
+        mean_std_sql(log_times, 'Time_log', 'Race_ID'), con))
+
+    times = pd.read_sql('SELECT Race_ID, Time FROM Results', con)
+    reference = np.log(times['Time']).groupby(times['Race_ID']).std(ddof=0).values
+    for label, sd in (('sum of squares', legacy_sd), ('Welford', welford_sd), ('native SQL', native_sd)):
+        print(f'{label:<20} largest error against numpy: {np.abs(sd["StdDev"].values - reference).max():.2e}')
+    print(f'Speed up of native SQL over the original aggregate: {legacy_sd_t / native_sd_t:.1f}x')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,95 @@
+"""Benchmark parsing race times into seconds.
+
+Compares the original per-string time_string_to_seconds and ParkRunConverter.convert_PR_time loops
+with the vectorised versions in fellpace.convert_tools, on a synthetic column of times in the formats
+found in results tables (hh:mm:ss, mm:ss, fractional seconds, decimal minutes and missing values).
+
+Usage:
+    python benchmarks/bench_convert_tools.py [number of times]
+"""
+import sys
+import time
+from re import match
+
+import numpy as np
+import pandas as pd
+
+from fellpace.convert_tools import time_string_to_seconds, ParkRunConverter
+
+
+def legacy_time_string_to_seconds(duration_strings):
+    """time_string_to_seconds as it was before it was vectorised."""
+    ftr = [3600,60,1]
+    out =[]
+    for duration_string in duration_strings:
+        try:
+            hrsminssecs = duration_string.split(':')
+            if len(hrsminssecs) < 3:
+                hrsminssecs.insert(0,'00')
+            hrsminssecs[2] = hrsminssecs[2].rsplit('.')[0]
+            out.append(sum([a*b for a,b in zip(ftr, [int(i) for i in hrsminssecs])]))
+        except:
+            try:
+                out.append(int(float(duration_string)*60))
+            except:
+                out.append(None)
+    return np.array(out)
+
+def legacy_convert_PR_time(duration_strings):
+    """ParkRunConverter.convert_PR_time as it was before it was vectorised."""
+    ftr = [3600,60,1]
+    out = []
+    for duration_string in duration_strings:
+        if type(duration_string) is not str:
+            out.append(None)
+            continue
+        duration_match = match('[0-9:]+',duration_string)
+        if not duration_match:
+            out.append(None)
+            continue
+        try:
+            hrsminssecs = duration_match.group().split(':')
+            if len(hrsminssecs) < 3:
+                hrsminssecs.insert(0,'00')
+            out.append(sum([a*b for a,b in zip(ftr, [int(i) for i in hrsminssecs])]))
+        except:
+            out.append(None)
+    return out
+
+def make_times(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    seconds = rng.lognormal(np.log(3000), 0.4, n).astype(int)
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    times = pd.Series([f'{m:02d}:{s:02d}' for m, s in zip(minutes + hours * 60, secs)], dtype=object)
+    kind = rng.integers(0, 10, n)
+    long = kind < 4
+    times[long] = [f'{h}:{m:02d}:{s:02d}' for h, m, s in zip(hours[long], minutes[long], secs[long])]
+    times[kind == 4] = times[kind == 4] + '.7'
+    times[kind == 5] = (seconds[kind == 5] / 60).round(2).astype(str)
+    times[kind == 6] = None
+    return times.to_numpy(copy=True)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def main(n: int = 1000000):
+    times = make_times(n)
+    print(f'{n} times')
+    legacy_t, legacy = timed(legacy_time_string_to_seconds, times)
+    new_t, new = timed(time_string_to_seconds, times)
+    pd.testing.assert_extension_array_equal(new, pd.array(list(legacy), dtype='Int64'))
+    print(f'time_string_to_seconds: legacy {legacy_t:.2f} s, vectorised {new_t:.2f} s ({legacy_t / new_t:.1f}x)')
+
+    # parkrun times can have text after them
+    times[::10] = [f'{time}PB' if time is not None else None for time in times[::10]]
+    legacy_t, legacy = timed(legacy_convert_PR_time, times)
+    new_t, new = timed(ParkRunConverter.convert_PR_time, None, times)
+    pd.testing.assert_extension_array_equal(new, pd.array(legacy, dtype='Int64'))
+    print(f'convert_PR_time: legacy {legacy_t:.2f} s, vectorised {new_t:.2f} s ({legacy_t / new_t:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,87 @@
+"""Benchmark evaluating the race models against chase times.
+
+Compares the original get_rmse_in_seconds, which called np.polyval once per racer and converted
+times once per race and season, with get_residuals_in_seconds in fellpace.modelling.training, on a
+synthetic database of chases and race scores.
+
+Usage:
+    python benchmarks/bench_evaluation.py [number of race scores]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fellpace.analysis_tools import convert_Chase_ZScore_logs
+from fellpace.db.db_setup import setup_db
+from fellpace.modelling.training import train_models, get_residuals_in_seconds, summarise_residuals
+
+SEASONS = range(2010, 2024)
+
+
+def legacy_get_rmse_in_seconds(con, data_Zs, coeffs):
+    """get_rmse_in_seconds as it was before it was vectorised."""
+    data_Zs = data_Zs.loc[data_Zs['inlier'] == True]
+    data_Zs.set_index(['Race_Name','Season', 'Racer_ID'], inplace=True)
+    data_Zs['predicted_Z'] = (
+        data_Zs.groupby(['Race_Name','Season', 'Racer_ID'], sort=False)
+        .apply(
+            lambda x:
+                np.polyval(coeffs[x.name[0]], x['ZScore'])[0])
+        )
+    predicted_times = (data_Zs.groupby(['Race_Name','Season'], sort=False, group_keys=False)
+    .apply(
+        lambda x: convert_Chase_ZScore_logs(con, x['predicted_Z'], year = x.name[1] + 1)
+        )
+    )
+    data_Zs['residuals'] = predicted_times - data_Zs['HCTime']
+    return data_Zs.groupby('Race_Name').apply(lambda x: np.sqrt(np.mean(x['residuals']**2)))
+
+def make_database(path: Path, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    con = setup_db(path)
+    for chase_ID, season in enumerate(SEASONS, start=1):
+        con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (?, ?)", (chase_ID, f'{season + 1}-05-20'))
+        times = rng.lognormal(np.log(3500), 0.15, 300).astype(int)
+        con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (?, ?)", [(chase_ID, int(t)) for t in times])
+    con.commit()
+    return con
+
+def make_data_Zs(n: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    ZScore = rng.normal(size=n)
+    return pd.DataFrame({
+        'Racer_ID': np.arange(n),
+        'Race_Name': [f'Race {i}' for i in rng.integers(0, 40, n)],
+        'Season': rng.choice(list(SEASONS), n),
+        'ZScore': ZScore,
+        'HCScore': 1.1 * ZScore + rng.normal(scale=0.3, size=n),
+        'HCTime': rng.lognormal(np.log(3500), 0.15, n).astype(int),
+        'inlier': rng.random(n) > 0.1,
+    })
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def main(n: int = 50000):
+    with tempfile.TemporaryDirectory() as directory:
+        con = make_database(Path(directory) / 'fellpace.db')
+        data_Zs = make_data_Zs(n)
+        coeffs, _ = train_models(data_Zs)
+        print(f'{n} race scores')
+        legacy_t, legacy = timed(legacy_get_rmse_in_seconds, con, data_Zs.copy(), coeffs)
+        new_t, residuals = timed(get_residuals_in_seconds, con, data_Zs, coeffs)
+        summary_t, summary = timed(summarise_residuals, residuals)
+        new_t += summary_t
+        assert np.allclose(summary['RMSE'], legacy.sort_index())
+        print(f'RMSE by race: legacy {legacy_t:.2f} s, vectorised {new_t:.3f} s ({legacy_t / new_t:.0f}x)')
+        con.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,88 @@
+"""Benchmark searching the prediction parameters.
+
+Compares predicting every finisher one at a time, as predict_racers does (identify_outliers_in_predictions,
+filter_race_results and make_chase_prediction per racer), with the vectorised evaluate_parameters of
+fellpace.modelling.sweep, on synthetic results. The one at a time timing is of a few candidates,
+scaled up to the number swept.
+
+Usage:
+    python benchmarks/bench_sweep.py [number of candidates]
+"""
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from fellpace.analysis_tools import identify_outliers_in_predictions
+from fellpace.filter import filter_race_results
+from fellpace.modelling.prediction import PredictionParameters, make_chase_prediction
+from fellpace.modelling.sweep import SweepInputs, evaluate_parameters, get_posteriors, random_parameters
+
+YEARS = range(2015, 2025)
+FINISHERS = 300
+RACES = ['Tigger Tor', 'Lantern Pike', 'Hallam Chase', 'PR_Hallam', 'PR_Endcliffe', 'Exterminator', 'Cracken Edge']
+
+def make_inputs(seed: int = 0) -> SweepInputs:
+    rng = np.random.default_rng(seed)
+    results, finishers = [], []
+    for year in YEARS:
+        for _ in range(FINISHERS):
+            ability = rng.normal()
+            n = rng.integers(1, 25)
+            results.append(pd.DataFrame({
+                'Finisher': len(finishers),
+                'Year': year,
+                'Race_Name': rng.choice(RACES, n),
+                'Season': year - 1 - rng.integers(0, 6, n),
+                'Zpred_mu': ability + rng.normal(scale=0.4, size=n) + 2 * (rng.random(n) < 0.05),
+                'Zpred_sig': rng.uniform(0.03, 0.3, n),
+            }))
+            finishers.append({'Year': year, 'Racer_ID': len(finishers), 'ZScore_log': ability + rng.normal(scale=0.3)})
+    results = pd.concat(results, ignore_index=True)
+    results['include'] = True
+    for _, racer_results in results.groupby('Finisher'):
+        filter_race_results(racer_results)
+        results.loc[racer_results.index, 'include'] = racer_results['include']
+    return SweepInputs(results, pd.DataFrame(finishers))
+
+def legacy_posteriors(inputs: SweepInputs, parameters: PredictionParameters):
+    """Each finisher's prediction made one at a time, as predict_racers makes them."""
+    predictions = []
+    for (finisher, year), racer_results in inputs.results.groupby(['Finisher', 'Year']):
+        racer_results = racer_results.drop(columns='include')
+        racer_results['outlier'] = identify_outliers_in_predictions(racer_results['Zpred_mu'], threshold=parameters.outlier_threshold)
+        filter_race_results(racer_results)
+        predictions.append(make_chase_prediction(racer_results.loc[racer_results['include']], prediction_year=year, parameters=parameters))
+    return np.array(predictions).T
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def main(n: int = 5000):
+    from loguru import logger
+    logger.remove()
+    # make_chase_prediction warns about finishers whose results are all excluded
+    warnings.simplefilter('ignore', RuntimeWarning)
+    inputs = make_inputs()
+    candidates = random_parameters(n)
+    print(f'{n} candidates, {len(inputs.finishers)} finishers, {len(inputs.mu)} results')
+
+    checked = candidates.head(3)
+    legacy_t = 0
+    for (_, row), mu, sigma in zip(checked.iterrows(), *get_posteriors(inputs, checked)):
+        t, (legacy_mu, legacy_sigma) = timed(legacy_posteriors, inputs, PredictionParameters(**row))
+        legacy_t += t
+        assert np.allclose(mu, legacy_mu) and np.allclose(sigma, legacy_sigma)
+    legacy_t *= n / len(checked)
+
+    new_t, ranked = timed(evaluate_parameters, inputs, candidates)
+    print(f'sweep: one at a time {legacy_t:.0f} s (estimated), vectorised {new_t:.1f} s ({legacy_t / new_t:.0f}x)')
+    print(ranked.head(5).to_string())
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
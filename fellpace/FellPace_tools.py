@@ -10,11 +10,17 @@ import toml
 import datetime
 from datetime import datetime as dt 
 import sqlite3
+import json
 import Levenshtein
+from fellpace.db.db_setup import database_key
+from fellpace.db.season_scores import refresh_season_scores
+from fellpace.extract.name_index import update_name_index
 
 class race_entries:   
     
-    def __init__(self,num_entries):
+    def __init__(self,num_entries,category_aliases: 'convert_tools.CategoryAliases' = None):
+        # The aliases of the database the entries are for, used to convert their categories
+        self.category_aliases = category_aliases
         self.data = pd.DataFrame(
             {
                 'Racer_Name': pd.Series(dtype='str'),
@@ -39,7 +45,7 @@ class race_entries:
         if column not in self.data.columns:
             raise Exception('Incorrect column name')
         if column == 'Cat_Name':
-            column_data = convert_tools.convert_categories(column_data)
+            column_data = convert_tools.convert_categories(column_data, self.category_aliases)
         if column == 'Time':
             column_data = convert_tools.time_string_to_seconds(column_data)
         if column == 'Position':
@@ -48,7 +54,8 @@ class race_entries:
         if column == 'Racer_Name':
             #Ensure is title case
             column_data = [name.title() for name in column_data]
-        self.data.loc[:,column] = column_data 
+        # Replace the whole column, its type changes from the empty placeholder
+        self.data[column] = column_data
     
         
 def get_table_from_URL(url: str,headers: dict = {}) -> Tuple[pd.DataFrame,str]:   #Export the text response if useful at other end
@@ -161,13 +168,28 @@ def assign_race_meta(meta: dict) -> race_meta:
     race_metadata.race_climb = meta['race_climb']
     return race_metadata
 
-def process_data_for_DB(scraped_data : pd.DataFrame) -> Tuple[race_meta,race_entries]:
+def process_data_for_DB(scraped_data : pd.DataFrame, category_aliases: 'convert_tools.CategoryAliases' = None) -> Tuple[race_meta,race_entries]:
+    # Imported here, not at the top, as column_profiles imports this module and the import would be circular
+    from fellpace import column_profiles
     
     meta = get_race_meta()
     race_metadata = assign_race_meta(meta)
+    
+    #Use a mapping profile for the columns if there is one, only asking about detected mappings
+    profile_name, profile = column_profiles.get_profile(scraped_data)
+    if profile_name == 'detected':
+        print('The columns look like')
+        for role, columns in profile.items():
+            print(f'{role}: {columns}')
+        if input('Use these columns? (y)/n') == 'n':
+            profile = None
+    elif profile is not None:
+        print(f'Using the {profile_name} column mapping profile')
+    if profile is not None:
+        return (race_metadata, column_profiles.apply_profile(scraped_data, profile, category_aliases))
     #Create the data structure to store the main dataset
     num_entries = len(scraped_data.index)
-    entries = race_entries(num_entries)
+    entries = race_entries(num_entries, category_aliases)
 
     print('...')
     print(f'The column names in the chosen table are')
@@ -223,6 +245,7 @@ def process_data_for_DB(scraped_data : pd.DataFrame) -> Tuple[race_meta,race_ent
         return (scraped_data.iloc[:,choice].values,[choice]) # type: ignore
 
     print('\n\nWe are looping through the data we need')
+    profile = {}
     for index, col_entries in enumerate(list(entries.data)):
         (data,choices) = get_column_data(scraped_data,col_entries) # type: ignore
         if data.size == 0:
@@ -230,8 +253,12 @@ def process_data_for_DB(scraped_data : pd.DataFrame) -> Tuple[race_meta,race_ent
         else:
             entries.add_column_of_data(col_entries,data)
             chosen_columns = scraped_data.columns[choices]
+            profile[col_entries] = list(chosen_columns)
             scraped_data = scraped_data.drop(chosen_columns,axis = 1)
     
+    profile_name = input('Save these columns as a mapping profile? Enter a name for it or hit enter to skip\n')
+    if profile_name:
+        column_profiles.save_profile(profile_name, profile)
     return (race_metadata,entries)        
 
 # This is a CHASE version of the append to DB due to the specific nature of the Chase data tables 
@@ -256,6 +283,7 @@ def append_CHASE(con: sqlite3.Connection, data_to_insert: pd.DataFrame):
         
     #Commit to the database
     Racers_new.to_sql('Racers',con,if_exists='append',index=False)
+    update_name_index(con)
     #Get the new data, including the Racer_IDs
     Racers = pd.read_sql_query('SELECT * FROM Racers',con)
     
@@ -277,8 +305,11 @@ def append_CHASE(con: sqlite3.Connection, data_to_insert: pd.DataFrame):
     if key:
         exit()
     data_to_insert.to_sql('Results_Chase',con,index=False,if_exists='append')
+    convert_tools.save_category_aliases(con)
     print('Data Written')
     con.commit()
+    convert_tools.mark_category_aliases_saved(con)
+    analysis_tools.clear_chase_log_stats_cache(con)
     con.close()  
 
 def append_to_DB(con: sqlite3.Connection, data_to_insert: pd.DataFrame,data_metadata: race_meta,check: bool = True):
@@ -341,6 +372,7 @@ def append_to_DB(con: sqlite3.Connection, data_to_insert: pd.DataFrame,data_meta
         
     #Commit to the database
     Racers_new.to_sql('Racers',con,if_exists='append',index=False)
+    update_name_index(con)
     #Get the new data, including the Racer_IDs
     Racers = pd.read_sql_query('SELECT * FROM Racers',con)
     
@@ -365,8 +397,12 @@ def append_to_DB(con: sqlite3.Connection, data_to_insert: pd.DataFrame,data_meta
         if key:
             exit()
     data_to_insert.to_sql('Results',con,index=False,if_exists='append')
+    convert_tools.save_category_aliases(con)
     print('Data Written')
     con.commit()
+    convert_tools.mark_category_aliases_saved(con)
+    # Keep the materialised season scores in line with the new results
+    refresh_season_scores(con, race_ids=[Race_ID])
 
 def suggest_race_series(Series: pd.DataFrame, data_metadata: race_meta, check: bool) -> Tuple[int,str]:
     # Find the closest matching race series
@@ -418,5 +454,167 @@ def check_db_for_duplicate_racers(data_to_insert: pd.DataFrame, Racers: pd.DataF
     Racers_new = Racers_new.drop_duplicates(subset=['Racer_Name'])
     return Racers_new
     
+class RacerIDMap:
+    """Racer_ID of each racer name in the Racers table, held in memory so racers can be resolved without
+    reading the table. Where a name is in the table more than once the lowest Racer_ID is used.
+    """
+    def __init__(self):
+        self.ids = {} # Racer_Name: Racer_ID
+        self.table_size = (0, 0) # (COUNT, MAX(Racer_ID)) of the Racers table the map was last synced with
+        self.last_racer_ID = 0
+
+    def add_racers(self, racers) -> None:
+        """Add (Racer_ID, Racer_Name) rows, in Racer_ID order."""
+        for racer_ID, racer_name in racers:
+            if racer_name is not None:
+                self.ids.setdefault(racer_name, racer_ID)
+
+    def sync(self, con: sqlite3.Connection) -> 'RacerIDMap':
+        """Bring the map up to date with racers added to the table by anything else, rebuilding it if racers were removed."""
+        num_rows, last_racer_ID = con.execute("SELECT COUNT(*), IFNULL(MAX(Racer_ID), 0) FROM Racers").fetchone()
+        if self.table_size == (num_rows, last_racer_ID):
+            return self
+        query = "SELECT Racer_ID, Racer_Name FROM Racers WHERE Racer_ID > ? ORDER BY Racer_ID"
+        new_racers = con.execute(query, (self.last_racer_ID,)).fetchall()
+        if self.table_size[0] + len(new_racers) != num_rows:
+            self.ids = {}
+            new_racers = con.execute(query, (0,)).fetchall()
+        self.add_racers(new_racers)
+        self.table_size = (num_rows, last_racer_ID)
+        self.last_racer_ID = last_racer_ID
+        return self
+
+    def resolve(self, cur: sqlite3.Cursor, racers: pd.DataFrame) -> np.ndarray:
+        """Racer_IDs for the Racer_Name of each row of racers, inserting the racers that are new.
+
+        New racers are inserted with the Club of their first row, inside the cursor's transaction.
+        Rows without a name get a Racer_ID of 0.
+        """
+        new_racers = racers.dropna(subset=['Racer_Name']).drop_duplicates(subset=['Racer_Name'])
+        new_racers = new_racers[~new_racers['Racer_Name'].isin(self.ids.keys())]
+        for racer_name, club in zip(new_racers['Racer_Name'], new_racers['Club']):
+            cur.execute("INSERT INTO Racers (Racer_Name, Club) VALUES (?, ?)", (racer_name, None if pd.isna(club) else club))
+            self.ids[racer_name] = cur.lastrowid
+            self.last_racer_ID = cur.lastrowid
+        self.table_size = (self.table_size[0] + len(new_racers.index), self.last_racer_ID)
+        return racers['Racer_Name'].map(self.ids).fillna(0).astype(np.int64).values
+
+# Racer ID maps for each database, kept up to date by get_racer_ID_map
+_racer_ID_maps = {}
+
+def get_racer_ID_map(con: sqlite3.Connection) -> RacerIDMap:
+    """Get the racer ID map for a database, synced with its Racers table."""
+    return _racer_ID_maps.setdefault(database_key(con), RacerIDMap()).sync(con)
+
+def clear_racer_ID_map(con: sqlite3.Connection) -> None:
+    """Forget the racer ID map of a database, after rolling back racers it added."""
+    _racer_ID_maps.pop(database_key(con), None)
+
+def _closest_series_ID(Series: pd.DataFrame, race_name: str) -> int:
+    # The same choice suggest_race_series makes, without asking
+    if Series.empty:
+        return -1
+    distances = Series['Series_Name'].map(lambda i: Levenshtein.distance(i, race_name))
+    return int(Series['Series_ID'].iloc[int(np.argmin(distances.values))])
+
+SQL_INSERT_RACE = "INSERT INTO Races (Race_Name, Race_Date, Race_Distance, Race_Climb, Series_ID) VALUES (?,?,?,?,?)"
+RESULTS_COLUMNS = ['Race_ID', 'Racer_ID', 'Time', 'Cat_ID', 'Position', 'ZScore', 'ZScore_log', 'Percentile']
+
+def insert_race(cur: sqlite3.Cursor, data_metadata: race_meta, Series: pd.DataFrame) -> int:
+    """Insert a race without asking, in the series with the closest name if its series_id isn't set.
+
+    Returns:
+        int: The new Race_ID, None if a race with the same name and date is already in the database.
+    """
+    existing = cur.execute("SELECT 1 FROM Races WHERE Race_Name = ? AND Race_Date = ?",
+                           (data_metadata.race_name, data_metadata.race_date)).fetchone()
+    if existing:
+        print(f'{data_metadata.race_name} on {data_metadata.race_date} is already in the database, skipping')
+        return None
+    if data_metadata.series_id == -1:
+        data_metadata.series_id = _closest_series_ID(Series, data_metadata.race_name)
+    cur.execute(SQL_INSERT_RACE, data_metadata.get_DB_entry)
+    return cur.lastrowid
+
+def get_results_to_insert(data: pd.DataFrame, Race_ID: int, racer_ID_map: RacerIDMap, cur: sqlite3.Cursor, cat_IDs: dict) -> pd.DataFrame:
+    """The Results rows for a race's entries, adding any new racers. Entries without a name are dropped."""
+    data = data.assign(Racer_ID=racer_ID_map.resolve(cur, data))
+    data = data[data['Racer_ID'] > 0]
+    return pd.DataFrame({
+        'Race_ID': Race_ID,
+        'Racer_ID': data['Racer_ID'].values,
+        'Time': data['Time'].values,
+        'Cat_ID': data['Cat_Name'].map(cat_IDs).values,
+        'Position': data['Position'].values,
+    })
+
+def insert_results(cur: sqlite3.Cursor, results: pd.DataFrame) -> None:
+    """Insert rows into Results with executemany, stats columns that results doesn't have are left NULL."""
+    results = results.reindex(columns=RESULTS_COLUMNS)
+    # sqlite3 only takes python numbers, with None for missing values
+    results = results.astype(object).where(results.notna(), None)
+    cur.executemany(f"INSERT INTO Results ({', '.join(RESULTS_COLUMNS)}) VALUES ({', '.join('?' * len(RESULTS_COLUMNS))})", [
+        tuple(value.item() if isinstance(value, np.generic) else value for value in row)
+        for row in results.itertuples(index=False, name=None)
+    ])
+
+def update_position_stats(cur: sqlite3.Cursor, race_ids: list) -> None:
+    """Recalculate the ZScore, ZScore_log and Percentile of every result of some races from their stored times."""
+    query = "SELECT Result_ID, Race_ID, Time FROM Results WHERE Race_ID IN (SELECT value FROM json_each(?))"
+    results = pd.DataFrame(cur.execute(query, (json.dumps([int(race_id) for race_id in race_ids]),)).fetchall(),
+                           columns=['Result_ID', 'Race_ID', 'Time'])
+    stats = analysis_tools.calculate_position_stats_grouped(results)
+    stats = stats.astype(object).where(stats.notna(), None)
+    cur.executemany("UPDATE Results SET ZScore = ?, ZScore_log = ?, Percentile = ? WHERE Result_ID = ?",
+                    zip(stats['ZScore'], stats['ZScore_log'], stats['Percentile'], results['Result_ID'].tolist()))
+
+def get_category_IDs(con: sqlite3.Connection) -> dict:
+    return dict(con.execute('SELECT Cat_Name, Cat_ID FROM Categories').fetchall())
+
+def append_many_to_DB(con: sqlite3.Connection, races) -> List[int]:
+    """Add the results of many races to the database at once, without asking anything.
+
+    Racers are matched by name through an in-memory map of the Racers table and new ones are added.
+    Races whose series_id isn't set are put in the series with the closest name. Races already in the
+    database, with the same name and date, are skipped. Everything, including the refresh of the season
+    scores, is written in one transaction, so if anything fails nothing is added.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+        races: (race_meta, entries) pairs, the entries a race_entries or its DataFrame of data.
+
+    Returns:
+        List[int]: The Race_IDs of the races added.
+    """
+    cat_IDs = get_category_IDs(con)
+    Series = pd.read_sql_query('SELECT Series_ID, Series_Name FROM Race_Series', con)
+    racer_ID_map = get_racer_ID_map(con)
+    cur = con.cursor()
+    race_IDs = []
+    all_results = []
+    try:
+        for data_metadata, entries in races:
+            data = entries.data if isinstance(entries, race_entries) else entries
+            Race_ID = insert_race(cur, data_metadata, Series)
+            if Race_ID is None:
+                continue
+            race_IDs.append(Race_ID)
+            all_results.append(get_results_to_insert(data, Race_ID, racer_ID_map, cur, cat_IDs))
+            print(f'Adding {len(all_results[-1].index)} results for {data_metadata.race_name}')
+        if all_results:
+            results = pd.concat(all_results, ignore_index=True)
+            # The stats of every race at once
+            insert_results(cur, results.join(analysis_tools.calculate_position_stats_grouped(results)))
+        convert_tools.save_category_aliases(con)
+        # Commits the transaction once the season scores are up to date
+        refresh_season_scores(con, race_ids=race_IDs)
+    except Exception:
+        con.rollback()
+        clear_racer_ID_map(con)
+        raise
+    convert_tools.mark_category_aliases_saved(con)
+    update_name_index(con)
+    return race_IDs
+
 if __name__ == "__main__":
     get_race_meta()
\ No newline at end of file
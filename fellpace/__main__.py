@@ -1,39 +1,17 @@
-import matplotlib.pyplot as plt
-import pandas as pd
+"""The fellpace command line.
+
+Only the light modules are imported here, each command imports what it needs (pandas, scipy,
+scikit-learn, matplotlib...) and opens its own connection to the database, so the CLI starts quickly
+and commands that don't need the database never open it. tests/test_startup.py checks this.
+"""
 from pathlib import Path
 from datetime import date
+from typing import List
 import typer
 from typer import Option
-from fellpace.FellPace_tools import append_to_DB, process_data_for_DB, get_table_from_URL
-
-from fellpace.extract.racers import secure_racer_id
-from fellpace.scraping_tools import get_avtiming_api, get_racetek_api
-from tabulate import tabulate
-
-from fellpace.config import DB_PATH
-from fellpace.db.db_setup import setup_db
-from fellpace.extract.zscores import extract_all_zscore_data
-from fellpace.modelling.ransac import add_inliers
-from fellpace.modelling.training import train_models, get_rmse_in_seconds, load_models
-from fellpace.modelling.prediction import get_predicted_times,get_prediction_with_uncertainty_many, make_chase_prediction
-from fellpace.plotting.races import plot_all_race_Zscores
-from fellpace.plotting.racetimes import plot_time_normal
-from fellpace.extract.races import get_race_series_summary, get_chase_summary
-from fellpace.analysis_tools import convert_Chase_ZScore_logs_avg, identify_outliers_in_predictions
-
-from fellpace.extract.racers import get_racers_results
-from fellpace.config import DB_PATH, COEFFS_FILE_PATH, COVAR_FILE_PATH
-from fellpace.db.db_setup import setup_db
-from fellpace.convert_tools import seconds_to_time_string
-from fellpace.scrape_chase import process_chase_csv
-
-from fellpace.entries import load_entries, process_entries
-from fellpace.filter import filter_race_results
-from fellpace.plotting.racetimes import plot_racers_results
 from loguru import logger
 
-#Connect to the DB
-con = setup_db(DB_PATH)
+from fellpace.config import DB_PATH
 
 # Configure loguru to log to a file
 logger.add("fellpace.log", rotation="10 MB")
@@ -46,6 +24,7 @@ app = typer.Typer()
 
 @app.command()
 def process_url(url: str):
+    from fellpace.scraping_tools import get_avtiming_api, get_racetek_api
     if ('avtiming' in url) or ('raceresult' in url):
         data = get_avtiming_api(url)
     elif 'racetek' in url:
@@ -59,88 +38,183 @@ def ensure_extension(filename, extension=".csv"):
     return path        
         
 @app.command()        
-def process_csv(filename: str):
+def process_csv(
+    filename: str,
+    stream: bool = Option(
+        False, "--stream", "-s", help="Read the file in chunks, for files too big for memory. The columns must match a mapping profile"
+    ),
+    chunksize: int = Option(None, help="Rows read at a time with --stream, defaults to column_profiles.CHUNK_SIZE"),
+):
+    import pandas as pd
     # Get path with extension
     filepath =  Path('./csv') / ensure_extension(filename)
+    if stream:
+        from fellpace.FellPace_tools import get_race_meta, assign_race_meta
+        from fellpace.column_profiles import append_csv_streaming, CHUNK_SIZE
+        from fellpace.db.session import FellPaceDB
+        metadata = assign_race_meta(get_race_meta())
+        with FellPaceDB(DB_PATH) as db:
+            append_csv_streaming(db.con, filepath, metadata, chunksize=chunksize or CHUNK_SIZE)
+            return
     data = pd.read_csv(filepath)
     add_data(data)
     
+@app.command()
+def process_csv_dir(directory: str = './csv'):
+    """Add every csv file in a directory to the database, using the race details in a toml file of the same name."""
+    from fellpace.column_profiles import append_csv_directory
+    from fellpace.db.session import FellPaceDB
+    with FellPaceDB(DB_PATH) as db:
+        race_ids = append_csv_directory(db.con, directory)
+        logger.info(f"Added {len(race_ids)} races")
+
 @app.command()
 def process_html(url: str,):
+    from fellpace.FellPace_tools import get_table_from_URL
     data,_ = get_table_from_URL(url)
     add_data(data)
     
 def add_data(data):
-    (metadata,entries) = process_data_for_DB(data)
-    #Clean any null entries for time, which can't be converted to a Zscore
-    valid_data = entries.data.loc[~entries.data.Time.isnull()]
-    append_to_DB(con,valid_data,metadata)
+    from fellpace.FellPace_tools import append_to_DB, process_data_for_DB
+    from fellpace.convert_tools import load_category_aliases
+    from fellpace.db.session import FellPaceDB
+    with FellPaceDB(DB_PATH) as db:
+        category_aliases = load_category_aliases(db.con)
+        (metadata,entries) = process_data_for_DB(data, category_aliases)
+        #Clean any null entries for time, which can't be converted to a Zscore
+        valid_data = entries.data.loc[~entries.data.Time.isnull()]
+        append_to_DB(db.con,valid_data,metadata)
 
 @app.command()
 def train_model(
     plot: bool = Option(
         False, "--plot", "-p", help="Whether to plot the results or not"
-    )
+    ),
+    workers: int = Option(1, "--workers", "-w", help="Processes to fit the races' inliers on"),
+    full: bool = Option(
+        False, "--full", "-f", help="Refit every race, not just those whose data changed"
+    ),
 ):
     """Get coefficients from all race data."""
-    con = setup_db(DB_PATH)
-    data_Zs = extract_all_zscore_data(con)
-    data_Zs = add_inliers(data_Zs)
-    coeffs, covar = train_models(data_Zs)
-    rmse = get_rmse_in_seconds(data_Zs, coeffs)
-    logger.info(tabulate(pd.DataFrame(rmse), headers=['Race Name','RMSE'], tablefmt='rounded_outline'))
-    if plot:
-        plot_all_race_Zscores(data_Zs)
+    from tabulate import tabulate
+    from fellpace.db.session import FellPaceDB
+    from fellpace.db.migrations import get_schema_version
+    from fellpace.modelling.ransac import add_inliers
+    from fellpace.modelling.training import train_models_incremental, evaluate_models, save_model_file
+    with FellPaceDB(DB_PATH) as db:
+        data_Zs = db.zscore_data()
+        data_Zs = add_inliers(data_Zs, workers=workers)
+        if full:
+            db.con.execute("DELETE FROM Race_Models")
+        coeffs, covar = train_models_incremental(db.con, data_Zs)
+        by_race, by_season = evaluate_models(db.con, data_Zs, coeffs)
+        logger.info(tabulate(by_race, headers=['Race Name', *by_race.columns], tablefmt='rounded_outline'))
+        logger.info(tabulate(by_season, headers=['Season', *by_season.columns], tablefmt='rounded_outline'))
+        if plot:
+            from fellpace.plotting.races import plot_all_race_Zscores
+            plot_all_race_Zscores(data_Zs)
+
+        save_model_file(coeffs, covar, {
+            'schema_version': get_schema_version(db.con),
+            'rows': len(data_Zs),
+            'inliers': int(data_Zs['inlier'].sum()),
+        })
+        return coeffs
+
+@app.command()
+def backtest(
+    years: List[int] = Option(None, "--year", "-y", help="Chase years to replay, defaults to every chase"),
+    workers: int = Option(1, "--workers", "-w", help="Processes to run the years on"),
+):
+    """Replay past chases with models trained on what was known before each, and report how the predictions did."""
+    from tabulate import tabulate
+    from fellpace.modelling.backtest import run_backtest
+    _, summary = run_backtest(years or None, workers=workers, path=DB_PATH)
+    logger.info(tabulate(summary, headers=['Year', *summary.columns], tablefmt='rounded_outline', floatfmt='.3f'))
+
+@app.command()
+def sweep(
+    trials: int = Option(0, "--trials", "-n", help="Random candidates to try, 0 for the default grid"),
+    seed: int = Option(0, "--seed", help="Seed of the random candidates"),
+    top: int = Option(10, "--top", "-t", help="Best candidates to show"),
+    years: List[int] = Option(None, "--year", "-y", help="Chase years to replay, defaults to every chase"),
+    workers: int = Option(1, "--workers", "-w", help="Processes to gather the years on"),
+):
+    """Rank the prediction parameters by how well they would have predicted past chases."""
+    import pandas as pd
+    from tabulate import tabulate
+    from fellpace.modelling.prediction import DEFAULT_PARAMETERS
+    from fellpace.modelling.sweep import evaluate_parameters, get_sweep_inputs, parameter_grid, random_parameters
+    candidates = random_parameters(trials, seed=seed) if trials > 0 else parameter_grid()
+    inputs = get_sweep_inputs(years or None, workers=workers, path=DB_PATH)
+    ranked = evaluate_parameters(inputs, candidates)
+    current = evaluate_parameters(inputs, pd.DataFrame([vars(DEFAULT_PARAMETERS)]))
+    logger.info(f"Best of {len(ranked)} candidates on {len(inputs.finishers)} finishers:\n"
+                f"{tabulate(ranked.head(top), headers='keys', tablefmt='rounded_outline', floatfmt='.3f')}")
+    logger.info(f"Current parameters:\n{tabulate(current, headers='keys', tablefmt='rounded_outline', floatfmt='.3f')}")
 
-    coeffs.to_json(COEFFS_FILE_PATH)
-    covar.to_json(COVAR_FILE_PATH)
-    return coeffs
+@app.command()
+def rebuild_season_scores():
+    """Rebuild the materialised racer season scores from all results."""
+    from fellpace.db.session import FellPaceDB
+    from fellpace.db.season_scores import refresh_season_scores
+    with FellPaceDB(DB_PATH) as db:
+        refresh_season_scores(db.con)
 
 @app.command()
 def print_race_data():
-    con = setup_db(DB_PATH)
-    race_summary = get_race_series_summary(con)
-    con.close() #TODO: Have a class that closes this automatically
-    logger.info(tabulate(race_summary, headers='keys', tablefmt='rounded_outline'))
+    from tabulate import tabulate
+    from fellpace.db.session import FellPaceDB
+    with FellPaceDB(DB_PATH) as db:
+        race_summary = db.race_series_summary()
+        logger.info(tabulate(race_summary, headers='keys', tablefmt='rounded_outline'))
 
 @app.command()
 def print_chase_data():
-    con = setup_db(DB_PATH)
-    chase_summary = get_chase_summary(con)
-    con.close() #TODO: Have a class that closes this automatically
-    logger.info(tabulate(chase_summary, headers='keys', tablefmt='rounded_outline'))
+    from tabulate import tabulate
+    from fellpace.db.session import FellPaceDB
+    with FellPaceDB(DB_PATH) as db:
+        chase_summary = db.chase_summary()
+        logger.info(tabulate(chase_summary, headers='keys', tablefmt='rounded_outline'))
 
 @app.command()
 def print_racers_results(racer_name:str = 'nick hamillton'):
-    con = setup_db(DB_PATH)
-    logger.info(f"Getting results for {racer_name}")
-    racer_id = secure_racer_id(con, racer_name)
-    if racer_id:
-        results = get_racers_results(con, racer_id, -1)
+    from tabulate import tabulate
+    from fellpace.db.session import FellPaceDB
+    with FellPaceDB(DB_PATH) as db:
+        logger.info(f"Getting results for {racer_name}")
+        racer_id = db.secure_racer_ID(racer_name)
+        if racer_id:
+            results = db.racers_results(racer_id, -1)
+            logger.info(
+                tabulate(
+                    results.sort_values(['Season','Race_Name']).reset_index(drop=True),
+                    headers='keys',
+                    tablefmt='rounded_outline'
+                    )
+                )
+
+@app.command()
+def print_racer_prediction(racer_name: str = 'nick hamilton'):
+    from tabulate import tabulate
+    from fellpace.convert_tools import seconds_to_time_string
+    from fellpace.db.session import FellPaceDB
+    from fellpace.extract.racers import secure_racer_id
+    from fellpace.modelling.prediction import get_predicted_times
+    from fellpace.modelling.training import load_models
+    with FellPaceDB(DB_PATH) as db:
+        coeffs, _ = load_models()
+        logger.info(f"Predicting finish time for {racer_name}")
+        racer_id = secure_racer_id(db.con, racer_name)
+        prediction = get_predicted_times(db.con, coeffs,racer_id)
+        prediction['Predicted Time'] = prediction['Predicted Time'].apply(seconds_to_time_string)
         logger.info(
             tabulate(
-                results.sort_values(['Season','Race_Name']).reset_index(drop=True),
+                prediction.sort_values(['Season','Race_Name']).reset_index(drop=True),
                 headers='keys',
                 tablefmt='rounded_outline'
                 )
             )
-
-@app.command()
-def print_racer_prediction(racer_name: str = 'nick hamilton'):
-    con = setup_db(DB_PATH)
-    coeffs, _ = load_models()
-    logger.info(f"Predicting finish time for {racer_name}")
-    racer_id = secure_racer_id(con, racer_name)
-    prediction = get_predicted_times(con, coeffs,racer_id)
-    prediction['Predicted Time'] = prediction['Predicted Time'].apply(seconds_to_time_string)
-    logger.info(
-        tabulate(
-            prediction.sort_values(['Season','Race_Name']).reset_index(drop=True),
-            headers='keys',
-            tablefmt='rounded_outline'
-            )
-        )
-    con.close()
     
 @app.command()
 def examine_entries(year: int = date.today().year):
@@ -152,82 +226,99 @@ def examine_entries(year: int = date.today().year):
     Args:
         year (int): The year to examine entries for.
     """
+    from tabulate import tabulate
+    from fellpace.db.session import FellPaceDB
+    from fellpace.entries import load_entries
+    from fellpace.extract.racers import secure_racer_id_many, get_racers_results_many
     entries = load_entries(year)
     if entries.empty:
         logger.info(f"No entries found for {year}.")
         return
-    all_results = pd.DataFrame()
-    for i, row in entries.iterrows():
-        racer_name = row['Name'].lower().strip()
-        racer_id = secure_racer_id(con, racer_name)
-        if racer_id is None:
-            logger.info(f"Racer {racer_name} not found in database.")
-            continue
-        all_results = pd.concat([all_results, get_racers_results(con, racer_id)], ignore_index=True)
+    with FellPaceDB(DB_PATH) as db:
+        racer_names = [name.lower().strip() for name in entries['Name']]
+        racer_ids = secure_racer_id_many(db.con, racer_names)
+        for racer_name, racer_id in zip(racer_names, racer_ids):
+            if racer_id is None:
+                logger.info(f"Racer {racer_name} not found in database.")
+        all_results = get_racers_results_many(db.con, sorted({int(racer_id) for racer_id in racer_ids if racer_id is not None}))
         racer_counts = all_results.groupby('Racer_Name').size()
         
-    # merge back to entries
-    entries = entries.merge(racer_counts.rename('Count'), left_on='Name', right_index=True, how='left')
+        # merge back to entries
+        entries = entries.merge(racer_counts.rename('Count'), left_on='Name', right_index=True, how='left')
         
-    logger.info(
-        tabulate(
-            entries.sort_values('Count', ascending=False).reset_index(drop=True),
-            headers='keys',
-            tablefmt='rounded_outline'
-        ))
+        logger.info(
+            tabulate(
+                entries.sort_values('Count', ascending=False).reset_index(drop=True),
+                headers='keys',
+                tablefmt='rounded_outline'
+            ))
 
 @app.command()
 def show_race_outliers(racer_name: str = 'nick hamilton'):
-    con = setup_db(DB_PATH)
-    coeffs, covar = load_models()
-    logger.info(f"Examining potential outliers for {racer_name}")
-    racer_id = secure_racer_id(con, racer_name)
+    from tabulate import tabulate
+    from fellpace.analysis_tools import identify_outliers_in_predictions
+    from fellpace.db.session import FellPaceDB
+    from fellpace.extract.racers import secure_racer_id
+    from fellpace.modelling.prediction import get_predicted_times
+    from fellpace.modelling.training import load_models
+    with FellPaceDB(DB_PATH) as db:
+        coeffs, covar = load_models()
+        logger.info(f"Examining potential outliers for {racer_name}")
+        racer_id = secure_racer_id(db.con, racer_name)
     
-    racer_results = get_predicted_times(con, coeffs,racer_id).sort_values('PredZ', ascending=True)
+        racer_results = get_predicted_times(db.con, coeffs,racer_id).sort_values('PredZ', ascending=True)
     
-    identify_outliers_in_predictions(racer_results['PredZ'], threshold=1.2)
+        identify_outliers_in_predictions(racer_results['PredZ'], threshold=1.2)
     
-    racer_results['Expanding Mean'] = racer_results['PredZ'].expanding().mean()
-    racer_results['Expanding Std'] = racer_results['PredZ'].expanding().std()
-    mean_mean = racer_results['Expanding Mean'].mean()
-    racer_results['Distance from Mean'] = (racer_results['Expanding Mean'] - mean_mean).abs()
-    # drop Racer_Name column
-    racer_results = racer_results.drop(columns=['Racer_Name'])
-    # use tabulate to print racer_results
-    logger.info(tabulate(racer_results, headers='keys', tablefmt='rounded_outline'))
-    logger.info(racer_results['Expanding Mean'].mean())
-    con.close()
+        racer_results['Expanding Mean'] = racer_results['PredZ'].expanding().mean()
+        racer_results['Expanding Std'] = racer_results['PredZ'].expanding().std()
+        mean_mean = racer_results['Expanding Mean'].mean()
+        racer_results['Distance from Mean'] = (racer_results['Expanding Mean'] - mean_mean).abs()
+        # drop Racer_Name column
+        racer_results = racer_results.drop(columns=['Racer_Name'])
+        # use tabulate to print racer_results
+        logger.info(tabulate(racer_results, headers='keys', tablefmt='rounded_outline'))
+        logger.info(racer_results['Expanding Mean'].mean())
 
 @app.command()
 def plot_racer_likelihoods(racer_name: str = 'nick hamilton'):
-    con = setup_db(DB_PATH)
-    coeffs, covar = load_models()
-    logger.info(f"Predicting finish time for {racer_name}")
-    racer_id = secure_racer_id(con, racer_name)
-    racer_results = get_racers_results(con, racer_id)
+    import matplotlib.pyplot as plt
+    from fellpace.analysis_tools import convert_Chase_ZScore_logs_avg, identify_outliers_in_predictions
+    from fellpace.convert_tools import seconds_to_time_string
+    from fellpace.db.session import FellPaceDB
+    from fellpace.extract.racers import secure_racer_id, get_racers_results
+    from fellpace.filter import filter_race_results
+    from fellpace.modelling.prediction import get_prediction_with_uncertainty_many, make_chase_prediction
+    from fellpace.modelling.training import load_models
+    from fellpace.plotting.racetimes import plot_racers_results, plot_time_normal
+    with FellPaceDB(DB_PATH) as db:
+        coeffs, covar = load_models()
+        logger.info(f"Predicting finish time for {racer_name}")
+        racer_id = secure_racer_id(db.con, racer_name)
+        racer_results = get_racers_results(db.con, racer_id)
         
-    racer_results = get_prediction_with_uncertainty_many(coeffs, covar, racer_results)
+        racer_results = get_prediction_with_uncertainty_many(coeffs, covar, racer_results)
     
-    racer_results['outlier'] = identify_outliers_in_predictions(racer_results['Zpred_mu'], threshold=1.2)
+        racer_results['outlier'] = identify_outliers_in_predictions(racer_results['Zpred_mu'], threshold=1.2)
         
-    filter_race_results(racer_results)
+        filter_race_results(racer_results)
     
-    chase_mu, chase_sig = make_chase_prediction(racer_results.loc[racer_results['include']], prediction_year=2024, verbose=True)
+        chase_mu, chase_sig = make_chase_prediction(racer_results.loc[racer_results['include']], prediction_year=2024, verbose=True)
     
-    _, ax = plt.subplots(figsize=(10, 6))    
+        _, ax = plt.subplots(figsize=(10, 6))    
     
-    plot_racers_results(racer_results.loc[racer_results['include']], con, ax=ax, linestyle='-')
-    plot_racers_results(racer_results.loc[~racer_results['include']], con, ax=ax, linestyle=':')
-    plot_time_normal(con, chase_mu, chase_sig, 'Chase 2024',ax, color='black', linewidth=2)
+        plot_racers_results(racer_results.loc[racer_results['include']], db.con, ax=ax, linestyle='-')
+        plot_racers_results(racer_results.loc[~racer_results['include']], db.con, ax=ax, linestyle=':')
+        plot_time_normal(db.con, chase_mu, chase_sig, 'Chase 2024',ax, color='black', linewidth=2)
     
-    prediction = chase_mu - (1.96 * chase_sig)
-    prediction_t = convert_Chase_ZScore_logs_avg(con, prediction)
-    plt.vlines(prediction_t, 0, 0.2, color='black', linestyle='--', label='Predicted time')
+        prediction = chase_mu - (1.96 * chase_sig)
+        prediction_t = convert_Chase_ZScore_logs_avg(db.con, prediction)
+        plt.vlines(prediction_t, 0, 0.2, color='black', linestyle='--', label='Predicted time')
         
-    plt.xlabel("Predicted Time")
-    plt.gca().xaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: seconds_to_time_string(x)))  # Format xticks
-    plt.legend()  # Add legend to display the labels
-    plt.show()
+        plt.xlabel("Predicted Time")
+        plt.gca().xaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: seconds_to_time_string(x)))  # Format xticks
+        plt.legend()  # Add legend to display the labels
+        plt.show()
 
 @app.command()
 def process_chase(file: str, date: str):
@@ -238,18 +329,23 @@ def process_chase(file: str, date: str):
         file (str): The name of the CSV file (e.g., 'Chase 2016.csv').
         date (str): The date of the Chase in 'yyyy-mm-dd' format.
     """
-    con = setup_db(DB_PATH)
-    process_chase_csv(file, date, con)
-    con.close()
+    from fellpace.db.session import FellPaceDB
+    from fellpace.scrape_chase import process_chase_csv
+    with FellPaceDB(DB_PATH) as db:
+        process_chase_csv(file, date, db.con)
     
 @app.command()
-def entries():
-    con = setup_db(DB_PATH)
-    entries = load_entries()
-    process_entries(entries, con)
+def entries(
+    year: int = date.today().year,
+    workers: int = Option(1, "--workers", "-w", help="Threads to predict the entrants on"),
+    quiet: bool = Option(False, "--quiet", "-q", help="Don't log the results used for each entrant"),
+):
+    from fellpace.db.session import FellPaceDB
+    from fellpace.entries import load_entries, process_entries
+    with FellPaceDB(DB_PATH) as db:
+        entries = load_entries(year)
+        process_entries(entries, db.con, year_of_entry=year, workers=workers, verbose=not quiet)
 
 if __name__ == "__main__":
     app()
     #process_csv('ShefHalf-2022.csv')
-
-con.close()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from scipy.stats import zscore, percentileofscore
+from scipy.stats import zscore, rankdata
 from typing import Tuple
 import math
 import pandas as pd
@@ -10,31 +10,69 @@ from typing import Tuple
 from sklearn.linear_model import LinearRegression
 from loguru import logger
 
+from fellpace.db.aggregates import mean_std_sql
+from fellpace.db.db_setup import database_key
+
+def _as_seconds(time: npt.ArrayLike) -> np.ndarray:
+    # Whole seconds as floats, with NaN for missing times (including pandas' <NA>)
+    return np.trunc(pd.to_numeric(pd.Series(time), errors='coerce').to_numpy(dtype=float, na_value=np.nan))
+
+def _zscore(values: np.ndarray) -> np.ndarray:
+    # The same as scipy's zscore(values, nan_policy='omit'), population standard deviation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (values - np.nanmean(values)) / np.nanstd(values)
+
 def calculate_position_stats(time: npt.ArrayLike) -> Tuple[npt.ArrayLike, npt.ArrayLike,npt.ArrayLike]:
     """Calculate position stats, specifically the percentile AND zscore for position data TIME!!!
     It is useful to have both, the zscore assumes normality but has additional power at the tails of the distribution
     as it calculates how far ahead/behind someone may be from the average rather than just relative position within a group
     As race times are typically log-normal. We will also calculate the ZScore of the log-transformed times.
 
+    The percentile is the same as scipy's percentileofscore(time, time) (kind 'rank', tied times get
+    their average rank) but from one sort of the times. Missing times are left out of the stats and get NaN.
+
     Args:
         time (np.ndarray): A 1D np array of time values in seconds, returned from a pandas dataframe
 
     Returns:
         Tuple[np.ndarray,np.ndarray, np.ndarray]: A tuple containing the (zscore,zscore_log, percentile)
     """
-    #Ensure the time is not a string object
-    time = time.astype(np.int32)
-    zscores = zscore(time,nan_policy = 'omit')
-    time_log = np.log(time)
-    zscores_log = zscore(time_log,nan_policy='omit')
-    
-    percentiles = percentileofscore(time,time,nan_policy = 'omit')
+    time = _as_seconds(time)
+    zscores = _zscore(time)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        zscores_log = _zscore(np.log(time))
+
+    valid = ~np.isnan(time)
+    percentiles = np.full(len(time), np.nan)
+    percentiles[valid] = rankdata(time[valid]) * (100.0 / valid.sum())
     #Percentile rounding errors can occur, so enforcing 0 - 100
     percentiles[percentiles < 0] = 0
     percentiles[percentiles > 100] = 100
     
     return (zscores,zscores_log,percentiles)
 
+def calculate_position_stats_grouped(data: pd.DataFrame, group: str = 'Race_ID', time: str = 'Time') -> pd.DataFrame:
+    """calculate_position_stats for every race in data at once.
+
+    Args:
+        data (pd.DataFrame): Results of one or more races.
+        group (str): The column identifying each race.
+        time (str): The column of times in seconds.
+
+    Returns:
+        pd.DataFrame: ZScore, ZScore_log and Percentile columns, with the same index as data.
+    """
+    times = pd.DataFrame({'Time': _as_seconds(data[time]), 'Group': data[group].values}, index=data.index)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        times['Time_log'] = np.log(times['Time'])
+    grouped = times.groupby('Group')
+    stats = pd.DataFrame(index=data.index)
+    for column, values in [('ZScore', 'Time'), ('ZScore_log', 'Time_log')]:
+        stats[column] = (times[values] - grouped[values].transform('mean')) / grouped[values].transform('std', ddof=0)
+    # Average ranks of ties, as calculate_position_stats
+    stats['Percentile'] = (grouped['Time'].rank(method='average') * 100.0 / grouped['Time'].transform('count')).clip(0, 100)
+    return stats
+
 
 def get_linear_models(data:pd.DataFrame, g: str,x: str,y: str):
     # Get linear models for each race, present coefficients in a table so can correct Zscore between races
@@ -105,47 +143,64 @@ def remove_outliers_xy(data: pd.DataFrame,x: str, y: str,g:str, thresh: float =
     #Strip out records where Z is above 2.5
     return data.loc[abs(data["ZoCZ"]) <=thresh],data["ZoCZ"] ,np.where(abs(data["ZoCZ"])<=thresh,"Included","Cleaned")
 
-def convert_Chase_ZScore_logs(con: sqlite3.Connection,Zscore_logs: pd.Series, year: int):
-    
-    # Add logarithm to the sqllite connection
+class ChaseLogStats:
+    """The mean and standard deviation of the log times of each chase, held for converting ZScore_logs
+    back into times without going back to the database.
 
-    def ln(t):
-        return np.log(t)
-    con.create_function("ln", 1, ln)
+    Args:
+        stats (pd.DataFrame): One row per chase with the Year of the chase, sd and mn of the log times.
+    """
+    def __init__(self, stats: pd.DataFrame):
+        self.by_year = {int(year): (chase['mn'].values, chase['sd'].values) for year, chase in stats.groupby('Year')}
+        # One chase a year, indexed by Year for looking up the stats of many rows at once
+        self.yearly = stats.groupby('Year')[['mn', 'sd']].first()
+        # Kept as single element arrays so conversions return the same types as they always have
+        self.average = (np.array([stats['mn'].mean()]), np.array([stats['sd'].mean()]))
 
-    """This function extracts raw stats from the original Chase data in order to convert back Zscore log data.
-    
+    def for_year(self, year: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.by_year.get(int(year), (np.empty(0), np.empty(0)))
+
+# Chase stats for each database, cleared by append_CHASE when a chase is added
+_chase_log_stats_cache = {}
+
+def get_chase_log_stats(con: sqlite3.Connection) -> ChaseLogStats:
+    """Get the log time statistics of every chase, calculated once per database and then cached.
 
     Args:
-        con (sqlite3.Connection): A connection to the fellpace database. MUST HAVE sttdev ADDED!!
+        con (sqlite3.Connection): A connection to the fellpace database.
+
+    Returns:
+        ChaseLogStats: The statistics of each chase.
+    """
+    key = database_key(con)
+    if key not in _chase_log_stats_cache:
+        chase_log_times = "(SELECT Chase_ID, ln(Time) AS Time_log FROM Results_Chase WHERE Time IS NOT NULL)"
+        SQL_get_log_chase_stats = f'''
+            SELECT cast(strftime("%Y",C.Chase_Date) as integer) as Year, R.StdDev AS sd, R.Mean AS mn
+            FROM ({mean_std_sql(chase_log_times, 'Time_log', 'Chase_ID')}) AS R
+            JOIN Chases as C ON C.Chase_ID = R.Chase_ID
+            ORDER BY C.Chase_ID
+        '''
+        _chase_log_stats_cache[key] = ChaseLogStats(pd.read_sql(SQL_get_log_chase_stats, con))
+    return _chase_log_stats_cache[key]
+
+def clear_chase_log_stats_cache(con: sqlite3.Connection = None) -> None:
+    """Forget the cached chase statistics for a database, or for all databases if con is None."""
+    if con is None:
+        _chase_log_stats_cache.clear()
+    else:
+        _chase_log_stats_cache.pop(database_key(con), None)
+
+def convert_Chase_ZScore_logs(con: sqlite3.Connection,Zscore_logs: pd.Series, year: int):
+    """This function uses the stats of the original Chase data in order to convert back Zscore log data.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
         Zscore_logs (pd.Series): A series of Zscore_log values to be converted into expected times
         year (int): We also need the year of the chase for which the times need converting
     """
-    
-    SQL_get_log_chase_stats = '''
-        WITH Timel AS
-        (
-            SELECT *, ln(Time) Timel
-            FROM Results_Chase
-            WHERE Time IS NOT NULL
-        ),
-
-        sds AS
-        (
-            SELECT Chase_ID, stddev(Timel) AS sd, avg(Timel) AS mn
-            FROM Timel
-            GROUP BY Chase_ID
-        )
-        
-
-        SELECT cast(strftime("%Y",C.Chase_Date) as integer) as Year, R.sd, R.mn FROM sds as R   
-                JOIN Chases as C ON C.Chase_ID = R.Chase_ID
-                WHERE Year == ?   
-    '''
-    year = int(year)
-    # Ensure the year is an integer, np int type doesn't work with sqlite3
-    Chase_stats = pd.read_sql(SQL_get_log_chase_stats,con,params=(year,))
-    pred_logs = Chase_stats['mn'].values + Chase_stats['sd'].values * Zscore_logs
+    mn, sd = get_chase_log_stats(con).for_year(year)
+    pred_logs = mn + sd * Zscore_logs
     return np.exp(pred_logs)
     
 def convert_Chase_ZScore_logs_avg(con: sqlite3.Connection,Zscore_logs: pd.Series):
@@ -153,47 +208,12 @@ def convert_Chase_ZScore_logs_avg(con: sqlite3.Connection,Zscore_logs: pd.Series
     times, we will not have that year's HC results and so an average of all available data must be taken
 
     Args:
-        con (sqlite3.Connection): A connection to a database -- A standard deviation function 'stddev'
-        must be included
+        con (sqlite3.Connection): A connection to the fellpace database.
         Zscore_logs (pd.Series): A series of ZScores
 
     Returns:
         _type_: Expected times based on ZScore values
     """
-    # Add logarithm to the sqllite connection
-
-    def ln(t):
-        return np.log(t)
-    con.create_function("ln", 1, ln)
-
-    """This function extracts raw stats from the original Chase data in order to convert back Zscore log data.
-    
-
-    Args:
-        con (sqlite3.Connection): A connection to the fellpace database. MUST HAVE sttdev ADDED!!
-        Zscore_logs (pd.Series): A series of Zscore_log values to be converted into expected times
-        year (int): We also need the year of the chase for which the times need converting
-    """
-    
-    SQL_get_log_chase_stats = '''
-        WITH Timel AS
-        (
-            SELECT *, ln(Time) Timel
-            FROM Results_Chase
-            WHERE Time IS NOT NULL
-        ),
-
-        sds AS
-        (
-            SELECT Chase_ID, stddev(Timel) AS sd, avg(Timel) AS mn
-            FROM Timel
-            GROUP BY Chase_ID
-        )
-        
-
-        SELECT  avg(R.sd) as sd, avg(R.mn) as mn FROM sds as R
-    '''
-    
-    Chase_stats = pd.read_sql(SQL_get_log_chase_stats,con)
-    pred_logs = Chase_stats['mn'].values + Chase_stats['sd'].values * Zscore_logs
-    return np.exp(pred_logs)
\ No newline at end of file
+    mn, sd = get_chase_log_stats(con).average
+    pred_logs = mn + sd * Zscore_logs
+    return np.exp(pred_logs)
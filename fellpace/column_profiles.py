@@ -0,0 +1,286 @@
+"""Map the columns of scraped results onto the race_entries columns without asking.
+
+A mapping profile gives, for each of Racer_Name, Club, Time, Position and Cat_Name, the scraped columns
+that hold it. A name split into forename and surname columns is joined with a space, and a gender column
+followed by a category column are joined without one, as process_data_for_DB does when asked. There are
+profiles for the layouts returned by the avtiming/raceresult and racetek APIs, and more can be saved in
+mapping_profiles (a toml file alongside current_meta). Results that don't match a profile have their
+columns detected from the header names and what the values look like.
+"""
+import re
+from pathlib import Path
+
+import pandas as pd
+import toml
+
+import fellpace.convert_tools as convert_tools
+import fellpace.FellPace_tools as FellPace_tools
+
+PROFILES_FILENAME = 'mapping_profiles'
+ROLES = ['Racer_Name', 'Club', 'Time', 'Position', 'Cat_Name']
+REQUIRED_ROLES = ['Racer_Name', 'Time']
+CHUNK_SIZE = 50000 # Rows read at a time by append_csv_streaming
+
+DEFAULT_PROFILES = {
+    'avtiming': { # Also used for raceresult, see scraping_tools.get_avtiming_api
+        'Racer_Name': ['Name'], 'Club': ['Club'], 'Time': ['Time'], 'Position': ['Pos'], 'Cat_Name': ['M/F', 'Cat'],
+    },
+    'racetek': {
+        'Racer_Name': ['First Name', 'Surname'], 'Club': ['Club'], 'Time': ['Time'], 'Position': ['Position'],
+        'Cat_Name': ['Gender', 'Age Cat'],
+    },
+}
+
+# Lower case header names of each role, in order of preference
+HEADER_NAMES = {
+    'Racer_Name': ['name', 'runner', 'athlete', 'competitor', 'racer', 'full name', 'parkrunner'],
+    'Forename': ['first name', 'firstname', 'forename', 'first'],
+    'Surname': ['surname', 'last name', 'lastname', 'family name', 'last'],
+    'Club': ['club', 'team', 'club/team', 'affiliation'],
+    'Time': ['time', 'finish time', 'chip time', 'net time', 'gun time', 'result', 'chip'],
+    'Position': ['position', 'pos', 'pos.', 'place', 'overall', 'overall position', 'rank'],
+    'Cat_Name': ['category', 'cat', 'age cat', 'age category', 'age group', 'class'],
+    'Gender': ['gender', 'sex', 'm/f'],
+}
+TIME_PATTERN = re.compile(r'^\s*(\d{1,2}:)?\d{1,2}:\d{2}(\.\d+)?\s*$')
+NAME_PATTERN = re.compile(r"^\s*[^\W\d_][^\W\d_'.-]*([ '.-]+[^\W\d_]+)+\s*$")
+PATTERN_SHARE = 0.8 # Share of a column's values that must fit a pattern for the column to be picked
+
+
+def get_profiles_path(filename: str = PROFILES_FILENAME) -> Path:
+    return Path.cwd() / filename
+
+def load_profiles(filename: str = PROFILES_FILENAME) -> dict:
+    """The default profiles and any saved in filename, saved profiles replace defaults with the same name."""
+    profiles = dict(DEFAULT_PROFILES)
+    filepath = get_profiles_path(filename)
+    if filepath.exists():
+        profiles.update(toml.load(filepath))
+    return profiles
+
+def save_profile(name: str, profile: dict, filename: str = PROFILES_FILENAME) -> None:
+    """Save a profile to filename, adding it to any already saved."""
+    filepath = get_profiles_path(filename)
+    saved = toml.load(filepath) if filepath.exists() else {}
+    saved[name] = {role: list(columns) for role, columns in profile.items() if columns}
+    with open(filepath, 'w') as toml_file:
+        toml.dump(saved, toml_file)
+
+
+def profile_matches(profile: dict, scraped_data: pd.DataFrame) -> bool:
+    """Whether every column the profile uses is in the scraped data and it has the required roles."""
+    columns = set(scraped_data.columns)
+    return all(profile.get(role) for role in REQUIRED_ROLES) and \
+        all(column in columns for role_columns in profile.values() for column in role_columns)
+
+def find_profile(scraped_data: pd.DataFrame, profiles: dict = None) -> tuple:
+    """The name and profile of the first profile the scraped data matches, (None, None) if none do."""
+    profiles = load_profiles() if profiles is None else profiles
+    for name, profile in profiles.items():
+        if profile_matches(profile, scraped_data):
+            return name, profile
+    return None, None
+
+
+def _share_matching(values: pd.Series, pattern: re.Pattern) -> float:
+    values = values.dropna()
+    if values.empty:
+        return 0
+    return values.astype(str).map(lambda value: bool(pattern.match(value))).mean()
+
+def _looks_like_positions(values: pd.Series) -> bool:
+    numbers = pd.to_numeric(values, errors='coerce').dropna()
+    if len(numbers.index) < PATTERN_SHARE * len(values.dropna().index) or numbers.empty:
+        return False
+    return bool((numbers % 1 == 0).all() and numbers.is_monotonic_increasing and numbers.iloc[0] <= 1)
+
+def detect_profile(scraped_data: pd.DataFrame) -> dict:
+    """Work out which columns hold each role, from the header names then from the values.
+
+    Returns:
+        dict: The detected profile, roles that couldn't be found are left out.
+    """
+    headers = {column: str(column).strip().lower() for column in scraped_data.columns}
+    unused = list(scraped_data.columns)
+
+    def by_header(role: str):
+        for header_name in HEADER_NAMES[role]:
+            for column in unused:
+                if headers[column] == header_name:
+                    unused.remove(column)
+                    return column
+        return None
+
+    def by_values(test):
+        for column in unused:
+            if test(scraped_data[column]):
+                unused.remove(column)
+                return column
+        return None
+
+    profile = {}
+    forename, surname = by_header('Forename'), by_header('Surname')
+    name = by_header('Racer_Name')
+    if forename is not None and surname is not None:
+        profile['Racer_Name'] = [forename, surname]
+    elif name is not None:
+        profile['Racer_Name'] = [name]
+    for role in ['Club', 'Time', 'Position']:
+        column = by_header(role)
+        if column is not None:
+            profile[role] = [column]
+    gender, category = by_header('Gender'), by_header('Cat_Name')
+    if category is not None:
+        profile['Cat_Name'] = [category] if gender is None else [gender, category]
+
+    # Fall back on the values for the columns every results table has
+    if 'Time' not in profile:
+        column = by_values(lambda values: _share_matching(values, TIME_PATTERN) >= PATTERN_SHARE)
+        if column is not None:
+            profile['Time'] = [column]
+    if 'Position' not in profile:
+        column = by_values(_looks_like_positions)
+        if column is not None:
+            profile['Position'] = [column]
+    if 'Racer_Name' not in profile:
+        column = by_values(lambda values: _share_matching(values, NAME_PATTERN) >= PATTERN_SHARE)
+        if column is not None:
+            profile['Racer_Name'] = [column]
+    return profile
+
+def get_profile(scraped_data: pd.DataFrame, profiles: dict = None) -> tuple:
+    """The matching saved or default profile, otherwise a detected one if it has the required roles.
+
+    Returns:
+        tuple: The profile name ('detected' if detected) and profile, (None, None) if there's no mapping.
+    """
+    name, profile = find_profile(scraped_data, profiles)
+    if profile is not None:
+        return name, profile
+    profile = detect_profile(scraped_data)
+    if all(role in profile for role in REQUIRED_ROLES):
+        return 'detected', profile
+    return None, None
+
+
+def apply_profile(scraped_data: pd.DataFrame, profile: dict,
+                  category_aliases: convert_tools.CategoryAliases = None) -> FellPace_tools.race_entries:
+    """Build the race entries from the scraped data using a profile, and the category aliases of the database they're for."""
+    entries = FellPace_tools.race_entries(len(scraped_data.index), category_aliases)
+    for role in ROLES:
+        columns = profile.get(role)
+        if not columns:
+            continue # Already an empty column
+        if len(columns) == 1:
+            column_data = scraped_data[columns[0]].values
+        else:
+            separator = ' ' if role == 'Racer_Name' else ''
+            parts = [scraped_data[column].fillna('').astype(str).str.strip() for column in columns]
+            column_data = parts[0].str.cat(parts[1:], sep=separator).str.strip().values
+        entries.add_column_of_data(role, column_data)
+    return entries
+
+
+def read_csv_meta(filepath: Path) -> FellPace_tools.race_meta:
+    """The race metadata for a csv file, from the toml file of the same name, None if there isn't one."""
+    meta_path = filepath.with_suffix('.toml')
+    if not meta_path.exists():
+        return None
+    return FellPace_tools.assign_race_meta(toml.load(meta_path))
+
+def iter_csv_directory(directory: str | Path = './csv', profiles: dict = None,
+                       category_aliases: convert_tools.CategoryAliases = None):
+    """Read the results in a directory of csv files one at a time, ready for append_many_to_DB.
+
+    Each csv needs a toml file of the same name with its race_name, race_date, race_distance and
+    race_climb (the same as current_meta), which can also name the profile to use. Files without one,
+    or whose columns can't be mapped, are skipped.
+
+    Yields:
+        Tuple[race_meta, pd.DataFrame]: The metadata and entries with a time of each race.
+    """
+    profiles = load_profiles() if profiles is None else profiles
+    for filepath in sorted(Path(directory).glob('*.csv')):
+        metadata = read_csv_meta(filepath)
+        if metadata is None:
+            print(f'Skipping {filepath.name}, no {filepath.with_suffix(".toml").name} with the race details')
+            continue
+        scraped_data = pd.read_csv(filepath)
+        profile_name = toml.load(filepath.with_suffix('.toml')).get('profile')
+        if profile_name is not None:
+            profile = profiles[profile_name]
+        else:
+            profile_name, profile = get_profile(scraped_data, profiles)
+        if profile is None:
+            print(f'Skipping {filepath.name}, could not work out its columns, add a profile for it')
+            continue
+        print(f'Reading {filepath.name} with the {profile_name} profile')
+        entries = apply_profile(scraped_data, profile, category_aliases)
+        #Clean any null entries for time, which can't be converted to a Zscore
+        yield metadata, entries.data.loc[~entries.data.Time.isnull()]
+
+def append_csv_directory(con, directory: str | Path = './csv', profiles: dict = None) -> list:
+    """Add every csv file in a directory to the database in one batch, see iter_csv_directory.
+
+    Returns:
+        list: The Race_IDs of the races added.
+    """
+    category_aliases = convert_tools.load_category_aliases(con)
+    return FellPace_tools.append_many_to_DB(con, iter_csv_directory(directory, profiles, category_aliases))
+
+def append_csv_streaming(con, filepath: str | Path, metadata: FellPace_tools.race_meta, profile: dict = None,
+                         chunksize: int = CHUNK_SIZE) -> int:
+    """Add the results of a race from a csv file too big to hold in memory, chunksize rows at a time.
+
+    Each chunk is converted, has its racers resolved and its results written before the next is read.
+    The position stats need the whole field, so they're calculated once every result is stored.
+    It's all one transaction, nothing is added if anything fails.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+        filepath (str | Path): The csv file.
+        metadata (race_meta): The details of the race.
+        profile (dict): The mapping of the csv's columns, detected from the first chunk if None.
+        chunksize (int): Rows read at a time.
+
+    Raises:
+        ValueError: If no profile is given and the columns can't be mapped.
+
+    Returns:
+        int: The Race_ID of the race added, None if it was already in the database.
+    """
+    category_aliases = convert_tools.load_category_aliases(con)
+    cat_IDs = FellPace_tools.get_category_IDs(con)
+    Series = pd.read_sql_query('SELECT Series_ID, Series_Name FROM Race_Series', con)
+    racer_ID_map = FellPace_tools.get_racer_ID_map(con)
+    cur = con.cursor()
+    try:
+        Race_ID = None
+        for chunk_number, chunk in enumerate(pd.read_csv(filepath, chunksize=chunksize)):
+            if chunk_number == 0:
+                if profile is None:
+                    profile_name, profile = get_profile(chunk)
+                    if profile is None:
+                        raise ValueError(f'Could not work out the columns of {filepath}, add a profile for it')
+                    print(f'Reading {filepath} with the {profile_name} profile')
+                Race_ID = FellPace_tools.insert_race(cur, metadata, Series)
+                if Race_ID is None:
+                    return None
+            entries = apply_profile(chunk, profile, category_aliases).data
+            entries = entries.loc[~entries.Time.isnull()]
+            FellPace_tools.insert_results(cur, FellPace_tools.get_results_to_insert(entries, Race_ID, racer_ID_map, cur, cat_IDs))
+            print(f'Added rows {chunk_number * chunksize + 1} to {chunk_number * chunksize + len(chunk.index)}')
+        if Race_ID is None:
+            return None
+        # Second pass, over the stored times of the whole field
+        FellPace_tools.update_position_stats(cur, [Race_ID])
+        convert_tools.save_category_aliases(con)
+        # Commits the transaction once the season scores are up to date
+        FellPace_tools.refresh_season_scores(con, race_ids=[Race_ID])
+    except Exception:
+        con.rollback()
+        FellPace_tools.clear_racer_ID_map(con)
+        raise
+    convert_tools.mark_category_aliases_saved(con)
+    FellPace_tools.update_name_index(con)
+    return Race_ID
@@ -10,8 +10,12 @@ DB_PATH = DB_DIR / "fellpace.db"
 ENTRIES_PATH = PROJECT_PATH.parent / "entries"
 
 MODELS_PATH = PROJECT_PATH.parent / "models"
+MODEL_FILE_PATH = MODELS_PATH / "models.npz"
+# Models used to be saved as json, still read if there is no model file
 COEFFS_FILE_PATH = MODELS_PATH / "coeffs.json"
 COVAR_FILE_PATH = MODELS_PATH / "covars.json"
+INLIERS_CACHE_PATH = MODELS_PATH / "inliers.npz"
+BACKTEST_CACHE_PATH = MODELS_PATH / "backtest"
 
 # Race results
 EXCLUDE_LIST = ['Exterminator']
\ No newline at end of file
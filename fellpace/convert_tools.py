@@ -1,7 +1,12 @@
 import numpy.typing as npt 
 import numpy as np
 import pandas as pd
+import re
+import sqlite3
+import threading
+from typing import Tuple
 import fellpace.FellPace_tools as FellPace_tools
+from fellpace.db.db_setup import database_key
 
 
 def seconds_to_time_string(seconds: float):
@@ -10,35 +15,90 @@ def seconds_to_time_string(seconds: float):
     hours, minutes = divmod(minutes_t, 60)
     return f"{hours:02.0f}:{minutes:02.0f}:{seconds:02.0f}"
 
-def time_string_to_seconds(duration_strings : npt.NDArray) -> npt.NDArray:   
-    ftr = [3600,60,1]
-    out =[]
-    
-    for duration_string in duration_strings:
-        try:
-            hrsminssecs = duration_string.split(':')
-            if len(hrsminssecs) < 3: # Checking whether just 'mm:ss' modifying crudely
-                hrsminssecs.insert(0,'00')
-            # Removing any value after a decimal point as this can't be cast to an integer
-            hrsminssecs[2] = hrsminssecs[2].rsplit('.')[0]
-            out.append(sum([a*b for a,b in zip(ftr, [int(i) for i in hrsminssecs])]))
-        except:
-            try:
-                #If it's not a time string, perhaps it's a decimal value of minutes
-                duration_float = float(duration_string)
-                out.append(int(duration_float*60))
-            except:
-                out.append(None)
-        
-    return np.array(out)
+# hh:mm:ss or mm:ss, anything after a decimal point in the seconds is dropped
+TIME_STRING_PATTERN = r'^\s*(?:(?P<hours>\d+)\s*:)?\s*(?P<minutes>\d+)\s*:\s*(?P<seconds>\d+)\s*(?:\.[^:]*)?$'
+TIME_STRING_WIDTH = 16 # Longer strings are parsed with TIME_STRING_PATTERN
+
+def _to_characters(times: np.ndarray, width: int) -> np.ndarray:
+    """The character codes of strings as a 2D array with a row for each character position and a column
+    for each string, padded with zeros. Laid out this way a position of every string is a contiguous row.
+    """
+    return np.ascontiguousarray(times.astype(f'U{width}').view(np.uint32).reshape(len(times), width).T)
+
+def _parse_plain_times(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Parse hh:mm:ss and mm:ss times without spaces, with anything after a decimal point in the seconds.
+
+    Args:
+        codes (np.ndarray): The character codes of the times, from _to_characters.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Which times could be parsed, and their seconds.
+    """
+    num_times = codes.shape[1]
+    valid = np.ones(num_times, dtype=bool)
+    fraction = np.zeros(num_times, dtype=bool) # from the decimal point on
+    was_digit = np.zeros(num_times, dtype=bool)
+    was_colon = np.ones(num_times, dtype=bool) # so a time has to start with a digit
+    colons = np.zeros(num_times, dtype=np.int64)
+    seconds = np.zeros(num_times, dtype=np.int64) # (hours * 60 + minutes) * 60 of the components done
+    component = np.zeros(num_times, dtype=np.int64)
+    # Horner's method along the characters, multiplying by 10 each digit and 60 each colon
+    for position_codes in codes:
+        fraction |= position_codes == 46
+        digits = position_codes - 48 # wraps around below '0'
+        is_digit = (digits < 10) & ~fraction
+        is_colon = (position_codes == 58) & ~fraction
+        # Only digits and colons before the decimal point, and every hh, mm and ss has digits
+        valid &= is_digit | is_colon | fraction | (position_codes == 0)
+        valid &= ~(is_colon & ~was_digit) & ~(was_colon & ~is_digit)
+        component = np.where(is_digit, component * 10 + digits, component)
+        seconds = np.where(is_colon, (seconds + component) * 60, seconds)
+        component[is_colon] = 0
+        colons += is_colon
+        was_digit, was_colon = is_digit, is_colon
+    valid &= ~was_colon & ((colons == 1) | (colons == 2))
+    return valid, seconds + component
+
+def time_string_to_seconds(duration_strings : npt.ArrayLike) -> pd.arrays.IntegerArray:
+    """Convert race times to whole seconds, for the whole array at once.
+
+    Times can be hh:mm:ss or mm:ss, with fractions of a second (which are dropped), or a decimal
+    number of minutes.
+
+    Args:
+        duration_strings (npt.ArrayLike): The times, usually strings from a results table.
+
+    Returns:
+        pd.arrays.IntegerArray: The times in seconds, <NA> where a time couldn't be read.
+    """
+    strings = pd.Series(duration_strings, dtype=object)
+    times = strings.to_numpy(dtype=str)
+    seconds = np.full(len(times), np.nan)
+    plain = np.char.str_len(times) <= TIME_STRING_WIDTH
+    width = min(times.dtype.itemsize // 4, TIME_STRING_WIDTH)
+    if width > 0:
+        valid, plain_seconds = _parse_plain_times(_to_characters(times[plain], width))
+        plain[plain] = valid
+        seconds[plain] = plain_seconds[valid]
 
+    #If it's not a plain time string, perhaps it's a decimal value of minutes
+    others = strings[~plain].astype('string')
+    seconds[~plain] = np.trunc(pd.to_numeric(others, errors='coerce').to_numpy(dtype=float, na_value=np.nan) * 60)
+    # Or a time with spaces in
+    spaced = np.flatnonzero(~plain)[np.isnan(seconds[~plain]) & others.str.contains(':', regex=False).fillna(False).values]
+    if len(spaced):
+        parts = strings.iloc[spaced].astype('string').str.extract(TIME_STRING_PATTERN).apply(pd.to_numeric).fillna({'hours': 0})
+        seconds[spaced] = (parts['hours'] * 3600 + parts['minutes'] * 60 + parts['seconds']).to_numpy(dtype=float, na_value=np.nan)
+    seconds[~np.isfinite(seconds)] = np.nan
+    return pd.array(seconds, dtype='Int64')
 
-from re import sub,match,search
+
+from re import sub,match
 class ParkRunConverter:
     
-    def __init__(self, data: pd.DataFrame) -> None:
+    def __init__(self, data: pd.DataFrame, category_aliases: 'CategoryAliases' = None) -> None:
         names = self.convert_PR_name(data['parkrunner'])
-        categories = self.convert_PR_categories(data['Age Group'])
+        categories = self.convert_PR_categories(data['Age Group'], category_aliases)
         times = self.convert_PR_time(data['Time'])
         #Construct the data table
         self.entries = FellPace_tools.race_entries(len(data.index))
@@ -49,26 +109,18 @@ class ParkRunConverter:
         self.entries.data['Cat_Name'] = categories
         self.entries.data['Time'] = times
     
-    def convert_PR_time(self,duration_strings : npt.ArrayLike) -> npt.ArrayLike:
-        ftr = [3600,60,1]
-        out = []
-        for i,duration_string in enumerate(duration_strings):
-            if type(duration_string) is not str:
-                out.append(None) # Sometimes nan gets returned from the table
-                continue
-            duration_match = match('[0-9:]+',duration_string) # should only match first string because match
-            if not duration_match:
-                out.append(None)
-                continue
-            duration_string = duration_match.group()
-            try:
-                hrsminssecs = duration_string.split(':')
-                if len(hrsminssecs) < 3: # Checking whether just 'mm:ss' modifying crudely
-                    hrsminssecs.insert(0,'00')
-                out.append(sum([a*b for a,b in zip(ftr, [int(i) for i in hrsminssecs])]))
-            except:
-                out.append(None)
-        return out
+    def convert_PR_time(self,duration_strings : npt.ArrayLike) -> pd.arrays.IntegerArray:
+        # Only the time at the start of the string is wanted, there may be text after (e.g. PB)
+        strings = pd.Series(duration_strings, dtype=object)
+        times = strings.where(strings.map(type) == str, '').to_numpy(dtype=str)
+        codes = _to_characters(times, max(times.dtype.itemsize // 4, 1))
+        codes *= np.logical_and.accumulate(((codes >= 48) & (codes <= 57)) | (codes == 58), axis=0)
+        valid, seconds = _parse_plain_times(codes)
+        seconds = pd.array(seconds, dtype='Int64')
+        # Only times without a colon (minutes) or not times at all are left
+        others = np.ascontiguousarray(codes[:, ~valid].T).view(times.dtype).ravel()
+        seconds[~valid] = time_string_to_seconds(others)
+        return seconds
     
     def convert_PR_name(self,name_strings : npt.ArrayLike) -> npt.ArrayLike:        
         
@@ -84,130 +136,167 @@ class ParkRunConverter:
             out.append(name) 
         return out
     
-    def convert_PR_categories(self,category_strings : npt.ArrayLike) -> npt.ArrayLike:
-        #Will split the text here so we can just pass the full-string into the function
-        #All categories seem to have a length of 7
-        
-        out = []
-        for category_string in category_strings:
-            if type(category_string) is not str:
-                out.append('')
-                continue
-            category_string = category_string[0:7]
-                
-            
-            #CASE remove whitespaces at any point in the string
-            category_string = sub('\s','',category_string)
-            
-            #CASE W in stead of F (Ladies, not Female)
-            category_string = sub('W|w','F',category_string)
-            
-            #CASE put anyone in intermediate categors (M45) into the main category (M40)
-            #Tried to expand to include things like M45-49 of M40-44 to basically replace all with a 0
-            # This is excessive as will always match M40 and replace with 0 needlessly
-            category_string = sub('(?<=[0-9])(0|5)\S*','0',category_string)
-            
-            #At this point, any age category that ends in 0 or 5 should be in the form - SM40, SF30 VM50 etc.
-            
-            #Remove Vs
-            #CASE remove any V instances for Vet (V or Vet)
-            category_string = sub('(?i)v(et){0,1}','',category_string)
-            
-            #Remove the Ss too, modify to SENIOR afterwards
-            category_string = sub('(?i)s','',category_string)
-            
-            # Any category with a number under 30 will be put into SENIOR if over 18 but U18 if under 18
-            #Get last number in string
-            number = search('[0-9]+$',category_string)
-            if not number:
-                out.append('')
-                continue
-            number = int(number.group())
-            if number < 30:
-                if number > 18:
-                    #Check for match with M
-                    if search('(m|M)',category_string):
-                        category_string = 'MSENIOR'
-                    else:
-                        category_string = 'FSENIOR'
-                
-                else:
-                    #Check for match with M
-                    if search('(m|M)',category_string):
-                        category_string = 'MU18'
-                    else:
-                        category_string = 'FU18'
-            
-            
-            
-            out.append(str.upper(category_string))
-        return out
+    def convert_PR_categories(self,category_strings : npt.ArrayLike, category_aliases: 'CategoryAliases' = None) -> npt.ArrayLike:
+        return map_categories(category_strings, 'parkrun', category_aliases)
 
-def convert_categories(category_strings : npt.ArrayLike) -> npt.ArrayLike:
+def convert_categories(category_strings : npt.ArrayLike, category_aliases: 'CategoryAliases' = None) -> npt.ArrayLike:
     """Converts the race categories by trying to deal with the variety of ways categories are represented
     For example it may replace 'Open' with 'Senior' we are assuming it is not truly open and people of specific age will be in their specific categories
     Will add more examples with time
 
     Args:
         category_strings (npt.NDArray): The string of categories from a results table
+        category_aliases (CategoryAliases): The aliases of the database the results are for, see load_category_aliases.
 
     Returns:
         npt.NDArray: the cleaned and changed strings so they should match those in the database
     """
-    from re import sub, match
-    
-    out = []
-    
-    for category_string in category_strings:
-        
-        if (not category_string) or pd.isna(category_string):
-            out.append(str.upper("UNC"))
-            continue
-            
-            
-        #CASE L\W in stead of F (Ladies, not Female)
-        category_string = sub('L|l|W|w','F',category_string)
-        #CASE remove whitespaces at any point in the string
-        category_string = sub('\s','',category_string)
-        #CASE remove J from the string
-        category_string = sub('(?i)j','',category_string)
-        
-        #CASE M or F only, append SENIOR
-        if match('(M|F)$',category_string):
-            category_string = category_string + 'SENIOR'
-        #CASE replace the S in MS or FS with SENIOR
-        category_string = sub('(?<=M|F)S$','SENIOR',category_string)
-        
-        category_string = sub('(?i)sen$','SENIOR',category_string)
-        #CASE replace SENR with SENIOR, decided easier to do individual cases than try one shaky catch all
-        
-        #CASE replace OPEN with SENIOR
-        category_string = sub('(?i)open','SENIOR',category_string)
-        #CASE replace SEN with SENIOR
+    return map_categories(category_strings, 'results', category_aliases)
 
-        category_string = sub('(?i)senr$','SENIOR',category_string)
-        #Eradicate any U22,U23 category should it exist, SENIOR NOW!!
-        category_string = sub('(?i)u*2[2+3]','SENIOR',category_string)
-        
-        #Add a U to the U18 category if it doesn't have one
-        category_string = sub('(?i)u*1[7,8]','U18',category_string)
-        
-        #Add a U to the U21 category if it doesn't have one
-        category_string = sub('(?i)u*21','U21',category_string)
-        
-        #There may be a loose U now if U was before a sex qualifier (UM23 for example)
-        category_string = sub('(?i)u(?![0-9])','',category_string)
-        
-        #CASE put anyone in intermediate categors (M45) into the main category (M40)
-        #Tried to expand to include things like M45-49 of M40-44 to basically replace all with a 0
-        # This is excessive as will always match M40 and replace with 0 needlessly
-        category_string = sub('(?<=[0-9])(0|5)\S*','0',category_string)
-        #CASE remove any V instances for Vet (V or Vet)
-        category_string = sub('(?i)v(et){0,1}','',category_string)
-        # Capitalise the string before returning so it matches the database
-        out.append(str.upper(category_string))
-        
-    return out
+# Precompiled patterns for normalise_category, in the order they're applied
+CATEGORY_SUBSTITUTIONS = [
+    (re.compile('L|l|W|w'), 'F'), #CASE L\W in stead of F (Ladies, not Female)
+    (re.compile(r'\s'), ''), #CASE remove whitespaces at any point in the string
+    (re.compile('(?i)j'), ''), #CASE remove J from the string
+    (re.compile('^(M|F)$'), r'\1SENIOR'), #CASE M or F only, append SENIOR
+    (re.compile('(?<=M|F)S$'), 'SENIOR'), #CASE replace the S in MS or FS with SENIOR
+    (re.compile('(?i)sen$'), 'SENIOR'),
+    (re.compile('(?i)open'), 'SENIOR'), #CASE replace OPEN with SENIOR
+    (re.compile('(?i)senr$'), 'SENIOR'), #CASE replace SENR with SENIOR
+    (re.compile('(?i)u*2[2+3]'), 'SENIOR'), #Eradicate any U22,U23 category should it exist, SENIOR NOW!!
+    (re.compile('(?i)u*1[7,8]'), 'U18'), #Add a U to the U18 category if it doesn't have one
+    (re.compile('(?i)u*21'), 'U21'), #Add a U to the U21 category if it doesn't have one
+    (re.compile('(?i)u(?![0-9])'), ''), #There may be a loose U now if U was before a sex qualifier (UM23 for example)
+    #CASE put anyone in intermediate categors (M45) into the main category (M40)
+    #Tried to expand to include things like M45-49 of M40-44 to basically replace all with a 0
+    (re.compile(r'(?<=[0-9])(0|5)\S*'), '0'),
+    (re.compile('(?i)v(et){0,1}'), ''), #CASE remove any V instances for Vet (V or Vet)
+]
+
+def normalise_category(category_string) -> str:
+    """The database category for a category from a results table, see convert_categories."""
+    if (not category_string) or pd.isna(category_string):
+        return "UNC"
+    for pattern, replacement in CATEGORY_SUBSTITUTIONS:
+        category_string = pattern.sub(replacement, category_string)
+    # Capitalise the string before returning so it matches the database
+    return category_string.upper()
+
+# Precompiled patterns for normalise_PR_category, in the order they're applied
+PR_CATEGORY_SUBSTITUTIONS = [
+    (re.compile(r'\s'), ''), #CASE remove whitespaces at any point in the string
+    (re.compile('W|w'), 'F'), #CASE W in stead of F (Ladies, not Female)
+    (re.compile(r'(?<=[0-9])(0|5)\S*'), '0'), #CASE put anyone in intermediate categors (M45) into the main category (M40)
+    (re.compile('(?i)v(et){0,1}'), ''), #CASE remove any V instances for Vet (V or Vet)
+    (re.compile('(?i)s'), ''), #Remove the Ss too, modify to SENIOR afterwards
+]
+PR_CATEGORY_NUMBER = re.compile('[0-9]+$')
+PR_CATEGORY_MALE = re.compile('(m|M)')
+
+def normalise_PR_category(category_string) -> str:
+    """The database category for a parkrun age group, e.g. VW45-49 -> F40."""
+    if type(category_string) is not str:
+        return ''
+    #All categories seem to have a length of 7
+    category_string = category_string[0:7]
+    for pattern, replacement in PR_CATEGORY_SUBSTITUTIONS:
+        category_string = pattern.sub(replacement, category_string)
+    #At this point, any age category that ends in 0 should be in the form - M40, F30 M50 etc.
+    # Any category with a number under 30 will be put into SENIOR if over 18 but U18 if under 18
+    number = PR_CATEGORY_NUMBER.search(category_string)
+    if not number:
+        return ''
+    number = int(number.group())
+    if number < 30:
+        male = PR_CATEGORY_MALE.search(category_string)
+        if number > 18:
+            category_string = 'MSENIOR' if male else 'FSENIOR'
+        else:
+            category_string = 'MU18' if male else 'FU18'
+    return category_string.upper()
+
+CATEGORY_NORMALISERS = {'results': normalise_category, 'parkrun': normalise_PR_category}
+
+class CategoryAliases:
+    """The Category_Aliases rows of one database, as far as this process knows them."""
+    def __init__(self):
+        # Raw category: database category, for each normaliser, committed to the table
+        self.saved = {source: {} for source in CATEGORY_NORMALISERS}
+        # (Source, Raw_Name, Cat_Name) rows written by save_category_aliases and not yet committed
+        self.saving = []
+
+# Raw category: normalised category, for each normaliser. The same for every database.
+_normalised = {source: {} for source in CATEGORY_NORMALISERS}
+# The aliases of each database, filled by load_category_aliases and mark_category_aliases_saved
+_database_aliases = {}
+_aliases_lock = threading.Lock() # parkrun results are converted on the scraper's threads
+
+def _get_category_aliases(con: sqlite3.Connection) -> CategoryAliases:
+    return _database_aliases.setdefault(database_key(con), CategoryAliases())
+
+def map_categories(category_strings : npt.ArrayLike, source: str = 'results', category_aliases: CategoryAliases = None) -> list:
+    """Normalise a column of categories, each distinct category only once.
+
+    Args:
+        category_strings (npt.ArrayLike): The categories from a results table.
+        source (str): Which normaliser to use, a key of CATEGORY_NORMALISERS.
+        category_aliases (CategoryAliases): The aliases of the database the results are for, from
+            load_category_aliases. Categories in its Category_Aliases table are mapped as the table says.
+
+    Returns:
+        list: The database category of each.
+    """
+    normalise = CATEGORY_NORMALISERS[source]
+    normalised = _normalised[source]
+    codes, uniques = pd.factorize(pd.Series(category_strings, dtype=object))
+    canonical = []
+    with _aliases_lock:
+        saved = category_aliases.saved[source] if category_aliases is not None else {}
+        for category_string in uniques:
+            if category_string in saved:
+                canonical.append(saved[category_string])
+                continue
+            if category_string not in normalised:
+                normalised[category_string] = normalise(category_string)
+            canonical.append(normalised[category_string])
+    canonical.append(normalise(None)) # factorize gives missing values a code of -1
+    return np.array(canonical, dtype=object)[codes].tolist()
+
+def load_category_aliases(con: sqlite3.Connection) -> CategoryAliases:
+    """The aliases of a database, with the categories saved in its Category_Aliases table, to convert its results with."""
+    saved = con.execute("SELECT Source, Raw_Name, Cat_Name FROM Category_Aliases").fetchall()
+    with _aliases_lock:
+        aliases = _get_category_aliases(con)
+        aliases.saved = {source: {} for source in CATEGORY_NORMALISERS}
+        for source, raw_name, cat_name in saved:
+            if source in aliases.saved:
+                aliases.saved[source][raw_name] = cat_name
+    return aliases
+
+def save_category_aliases(con: sqlite3.Connection) -> None:
+    """Add the categories normalised that a database doesn't have to its Category_Aliases table, without committing.
+
+    They are written again by the next save unless mark_category_aliases_saved is called once the
+    transaction is committed, so a rollback doesn't lose them.
+    """
+    with _aliases_lock:
+        aliases = _get_category_aliases(con)
+        aliases.saving = [
+            (source, raw_name, cat_name)
+            for source, normalised in _normalised.items()
+            for raw_name, cat_name in normalised.items()
+            if isinstance(raw_name, str) and raw_name not in aliases.saved[source]
+        ]
+        unsaved = list(aliases.saving)
+    con.executemany("INSERT OR IGNORE INTO Category_Aliases (Source, Raw_Name, Cat_Name) VALUES (?, ?, ?)", unsaved)
+
+def mark_category_aliases_saved(con: sqlite3.Connection) -> None:
+    """Record that the categories written by the last save_category_aliases have been committed."""
+    with _aliases_lock:
+        aliases = _get_category_aliases(con)
+        for source, raw_name, cat_name in aliases.saving:
+            aliases.saved[source].setdefault(raw_name, cat_name)
+        aliases.saving = []
 
 def clean_position_date(position_values : npt.ArrayLike) -> npt.ArrayLike:
     out=[]
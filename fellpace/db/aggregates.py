@@ -0,0 +1,70 @@
+"""Aggregate functions for the fellpace DB.
+
+XPercentile and std_dev are Python aggregates registered on the connection by setup_db. Python
+aggregates are called once per row, so where SQLite's own functions can do the job (see mean_std_sql)
+they should be preferred. benchmarks/bench_aggregates.py compares the options.
+"""
+import math
+
+
+class XPercentile:
+    percentile = 0.2
+    def __init__(self):
+        self.values = []
+        # Bind the list's append directly so SQLite calls straight into C for every row
+        # rather than through a Python method
+        self.step = self.values.append
+
+    def finalize(self):
+        self.values.sort()
+        upper_quartile_index = round(self.percentile * (len(self.values)))-1
+        return self.values[upper_quartile_index]
+
+class std_dev:
+    """Population standard deviation, streamed with Welford's algorithm to stay numerically stable."""
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.n == 0:
+            return None
+        return math.sqrt(self.m2 / self.n)
+
+
+def mean_std_sql(source: str, value: str, group: str = None) -> str:
+    """A query for the mean and population standard deviation of value using SQLite's own aggregates.
+
+    The variance is calculated in a single pass from values shifted by the overall mean,
+    avg((x - shift)^2) - avg(x - shift)^2, which avoids the loss of precision of the plain sum of
+    squares form when the mean is large compared to the spread (e.g. log times).
+    Needs sqrt, setup_db registers a fallback if SQLite was built without its math functions.
+
+    Args:
+        source (str): SQL for the rows to aggregate, a table name or a bracketed subquery. It appears
+            once in the query so any parameters it uses are only supplied once.
+        value (str): Column of source to aggregate.
+        group (str): Comma separated columns of source to group by. Defaults to None, a single group.
+
+    Returns:
+        str: SQL returning the group columns (if any), Mean and StdDev.
+    """
+    group_columns = f"{group}, " if group else ""
+    group_by = f"GROUP BY {group}" if group else ""
+    return f"""
+    WITH Mean_Std_Source AS (SELECT * FROM {source})
+    SELECT {group_columns}AVG({value}) AS Mean,
+        sqrt(max(AVG(({value} - Shift) * ({value} - Shift)) - (AVG({value}) - Shift) * (AVG({value}) - Shift), 0)) AS StdDev
+    FROM Mean_Std_Source, (SELECT AVG({value}) AS Shift FROM Mean_Std_Source)
+    WHERE {value} IS NOT NULL
+    {group_by}
+    """
@@ -1,40 +1,77 @@
 """This module loads the database file into a sqlite3 connection object and adds useful functions to the connection object."""
 import math
 import sqlite3
+import uuid
 from pathlib import Path
+from typing import Optional
 
+from fellpace.db.aggregates import XPercentile, std_dev
+from fellpace.db.migrations import CONNECTION_PRAGMAS, configure_connection, migrate
 
-class XPercentile:
-    percentile = 0.2
-    def __init__(self):
-        self.values = []
 
-    def step(self, value):
-        self.values.append(value)
+def has_math_functions(con: sqlite3.Connection) -> bool:
+    """Check whether SQLite was compiled with its built in math functions (ln, sqrt, ...)."""
+    try:
+        con.execute("SELECT ln(1), sqrt(1)")
+    except sqlite3.OperationalError:
+        return False
+    return True
 
-    def finalize(self):
-        self.values.sort()
-        upper_quartile_index = round(self.percentile * (len(self.values)))-1
-        return self.values[upper_quartile_index]
+def database_path(con: sqlite3.Connection) -> Optional[Path]:
+    """The file of the database behind a connection, None for an in-memory database."""
+    path = con.execute("PRAGMA database_list").fetchone()[2]
+    return Path(path) if path else None
 
-class std_dev:
-    def __init__(self):
-        self.n = 0
-        self.sum = 0
-        self.sq = 0
+def database_key(con: sqlite3.Connection) -> str:
+    """A key identifying the database behind a connection, for caching data calculated from it.
 
-    def step(self, value):
-        self.n += 1
-        self.sum += value
-        self.sq += value * value
+    The file path for file databases. In-memory databases get a random key, kept in a TEMP table so
+    it lives exactly as long as the database (id(con) is reused once a connection is closed).
+    """
+    path = database_path(con)
+    if path is not None:
+        return str(path)
+    try:
+        return con.execute("SELECT Database_Key FROM temp.FellPace_Database_Key").fetchone()[0]
+    except sqlite3.OperationalError:
+        key = f'memory:{uuid.uuid4().hex}'
+        # CREATE ... AS SELECT doesn't open a transaction, unlike an INSERT
+        con.execute(f"CREATE TEMP TABLE FellPace_Database_Key AS SELECT '{key}' AS Database_Key")
+        return key
 
-    def finalize(self):
-        return math.sqrt(self.sq/self.n - (self.sum/self.n * self.sum/self.n))
+# Statements sqlite3 keeps prepared per connection, enough for every query fellpace makes
+STATEMENT_CACHE_SIZE = 256
 
-def setup_db(path_to_db_file: Path) -> sqlite3.Connection:
-    """return a connection to the fellpace DB"""
-    
-    con = sqlite3.connect(path_to_db_file)
+def register_functions(con: sqlite3.Connection) -> None:
+    """Add the fellpace aggregates, and math functions if SQLite doesn't have them, to a connection."""
     con.create_aggregate("XPercentile", 1, XPercentile)
     con.create_aggregate('stddev', 1, std_dev)
-    return con
\ No newline at end of file
+    if not has_math_functions(con):
+        # Slower Python fallbacks, only needed on SQLite builds without the math functions
+        con.create_function("ln", 1, math.log, deterministic=True)
+        con.create_function("sqrt", 1, math.sqrt, deterministic=True)
+
+def setup_db(path_to_db_file: Path) -> sqlite3.Connection:
+    """return a connection to the fellpace DB, migrated to the latest schema"""
+    
+    con = sqlite3.connect(path_to_db_file, cached_statements=STATEMENT_CACHE_SIZE)
+    configure_connection(con)
+    register_functions(con)
+    migrate(con)
+    return con
+
+def connect_read_only(path_to_db_file: Path) -> sqlite3.Connection:
+    """Return a read only connection to an existing fellpace DB, which can be used from any thread.
+
+    The database isn't migrated (it can't be written), open it with setup_db first.
+    """
+    con = sqlite3.connect(
+        f'{Path(path_to_db_file).resolve().as_uri()}?mode=ro', uri=True,
+        cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False,
+    )
+    # journal_mode can't be changed on a read only connection, the database is already in WAL mode
+    con.execute("PRAGMA query_only = ON")
+    for pragma in ['temp_store', 'cache_size', 'mmap_size']:
+        con.execute(f"PRAGMA {pragma} = {CONNECTION_PRAGMAS[pragma]}")
+    register_functions(con)
+    return con
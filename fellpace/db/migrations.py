@@ -0,0 +1,249 @@
+"""Versioned schema for the fellpace DB.
+
+The schema version is kept in SQLite's user_version pragma. Each migration moves the database up one
+version and migrate applies any that a database hasn't had yet, so a new database is built from
+scratch and an existing one is brought up to date the next time it is opened with setup_db.
+Add new migrations to the end of MIGRATIONS, never edit one that has already been released.
+"""
+import sqlite3
+
+from loguru import logger
+
+# Settings applied to every connection. WAL lets the scrapers write while the CLI reads, and NORMAL
+# sync is safe in WAL mode (a power cut can lose the last transaction but not corrupt the file)
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -64000, # KiB, i.e. 64MB
+    'mmap_size': 268435456, # 256MB
+}
+
+SQL_CREATE_TABLES = """
+    CREATE TABLE IF NOT EXISTS Categories
+    (
+        Cat_ID INTEGER PRIMARY KEY,
+        Cat_Name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS Racers
+    (
+        Racer_ID INTEGER PRIMARY KEY,
+        Racer_Name TEXT,
+        Club TEXT
+    );
+    CREATE TABLE IF NOT EXISTS Race_Series
+    (
+        Series_ID INTEGER PRIMARY KEY,
+        Series_Name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS Races
+    (
+        Race_ID INTEGER PRIMARY KEY,
+        Race_Name TEXT,
+        Race_Date TEXT,
+        Race_Distance INTEGER,
+        Race_Climb INTEGER,
+        Series_ID INTEGER REFERENCES Race_Series (Series_ID)
+    );
+    CREATE TABLE IF NOT EXISTS Results
+    (
+        Result_ID INTEGER PRIMARY KEY,
+        Race_ID INTEGER REFERENCES Races (Race_ID),
+        Racer_ID INTEGER REFERENCES Racers (Racer_ID),
+        Time INTEGER,
+        Cat_ID INTEGER REFERENCES Categories (Cat_ID),
+        Position INTEGER,
+        ZScore REAL,
+        ZScore_log REAL,
+        Percentile REAL
+    );
+    CREATE TABLE IF NOT EXISTS Chases
+    (
+        Chase_ID INTEGER PRIMARY KEY,
+        Chase_Date TEXT
+    );
+    CREATE TABLE IF NOT EXISTS Results_Chase
+    (
+        ChaseR_ID INTEGER PRIMARY KEY,
+        Chase_ID INTEGER REFERENCES Chases (Chase_ID),
+        Racer_ID INTEGER REFERENCES Racers (Racer_ID),
+        Time INTEGER,
+        Cat_ID INTEGER REFERENCES Categories (Cat_ID),
+        Position INTEGER,
+        Handicap INTEGER,
+        ZScore REAL,
+        ZScore_log REAL,
+        Percentile REAL
+    );
+"""
+
+# Results carries everything the season scores need for a racer so those lookups never touch the table
+SQL_CREATE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS Results_Racer_ID ON Results (Racer_ID, Race_ID, Time, ZScore_log);
+    CREATE INDEX IF NOT EXISTS Results_Race_ID ON Results (Race_ID);
+    CREATE INDEX IF NOT EXISTS Results_Chase_Racer_ID ON Results_Chase (Racer_ID, Chase_ID);
+    CREATE INDEX IF NOT EXISTS Results_Chase_Chase_ID ON Results_Chase (Chase_ID);
+    CREATE INDEX IF NOT EXISTS Racers_Name_Lower ON Racers (lower(Racer_Name));
+    CREATE INDEX IF NOT EXISTS Races_Name_Date ON Races (Race_Name, Race_Date);
+"""
+
+# Parkrun events are stored with their event number, collapse them into one race per location.
+# Seasons run from June to May, so a spring race counts towards the previous year's season.
+# SQLite can't add a STORED generated column to an existing table, so these are VIRTUAL and stored
+# in the Races_Canonical_Season index, which covers the lookups that use them.
+SQL_ADD_RACE_COLUMNS = """
+    ALTER TABLE Races ADD COLUMN Canonical_Name TEXT GENERATED ALWAYS AS (
+        CASE
+        WHEN Race_Name LIKE 'Parkrun_endcliffe%' THEN 'PR_Endcliffe'
+        WHEN Race_Name LIKE 'Parkrun_hillsborough%' THEN 'PR_Hillsborough'
+        ELSE Race_Name
+        END
+    ) VIRTUAL;
+    ALTER TABLE Races ADD COLUMN Season INTEGER GENERATED ALWAYS AS (
+        CASE
+            WHEN CAST(strftime('%m',Race_Date) AS INTEGER) > 5
+            THEN CAST(strftime('%Y',Race_Date) AS INTEGER)
+            ELSE CAST(strftime('%Y',Race_Date) AS INTEGER) -1
+        END
+    ) VIRTUAL;
+    CREATE INDEX IF NOT EXISTS Races_Canonical_Season ON Races (Canonical_Name, Season, Race_ID);
+"""
+
+# Raw categories from results tables and the database category convert_tools normalised them to, by
+# normaliser (Source), so categories seen before are looked up rather than normalised again
+SQL_CREATE_CATEGORY_ALIASES = """
+    CREATE TABLE IF NOT EXISTS Category_Aliases
+    (
+        Source TEXT,
+        Raw_Name TEXT,
+        Cat_Name TEXT,
+        PRIMARY KEY (Source, Raw_Name)
+    ) WITHOUT ROWID;
+"""
+
+# The sufficient statistics of each race's model, the inlier (ZScore, HCScore) pairs it is fitted to,
+# with the fit and RMSE derived from them, so train_model only refits races whose data changed
+SQL_CREATE_RACE_MODELS = """
+    CREATE TABLE IF NOT EXISTS Race_Models
+    (
+        Race_Name TEXT PRIMARY KEY,
+        N INTEGER,
+        Sum_X REAL,
+        Sum_Y REAL,
+        Sum_XX REAL,
+        Sum_XY REAL,
+        Sum_YY REAL,
+        Residual_SS REAL,
+        Slope REAL,
+        Intercept REAL,
+        Var_Slope REAL,
+        Var_Intercept REAL,
+        Covar REAL,
+        RMSE REAL
+    ) WITHOUT ROWID;
+"""
+
+
+# Racer_Season_Scores as migration 4 created and filled it. Rebuilt later with the live SQL in
+# fellpace.db.season_scores, copied here so changes to that don't change what this migration does.
+SQL_CREATE_SEASON_SCORES = """
+    CREATE TABLE Racer_Season_Scores
+    (
+        Racer_ID INTEGER NOT NULL,
+        Race_Name TEXT NOT NULL,
+        Season INTEGER NOT NULL,
+        ZScore REAL,
+        Num_Results INTEGER,
+        PRIMARY KEY (Racer_ID, Race_Name, Season)
+    ) WITHOUT ROWID
+"""
+SQL_FILL_SEASON_SCORES = """
+    WITH Races_Rename AS MATERIALIZED
+    (
+        SELECT Canonical_Name AS Race_Name, Season, Race_ID
+        FROM Races
+    )
+    INSERT INTO Racer_Season_Scores (Racer_ID, Race_Name, Season, ZScore, Num_Results)
+    SELECT Res.Racer_ID, C.Race_Name, C.Season, XPercentile(Res.ZScore_log), COUNT(*)
+    FROM Results AS Res
+    JOIN Races_Rename AS C
+    ON C.Race_ID = Res.Race_ID
+    WHERE Res.Time IS NOT NULL
+    GROUP BY Res.Racer_ID, C.Race_Name, C.Season
+"""
+
+
+def _create_tables(con: sqlite3.Connection) -> None:
+    con.executescript(SQL_CREATE_TABLES)
+
+def _create_indexes(con: sqlite3.Connection) -> None:
+    con.executescript(SQL_CREATE_INDEXES)
+
+def _add_race_columns(con: sqlite3.Connection) -> None:
+    con.executescript(SQL_ADD_RACE_COLUMNS)
+
+def _create_season_scores(con: sqlite3.Connection) -> None:
+    # Databases from before the migrations may already have the table
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Racer_Season_Scores'").fetchone():
+        return
+    con.execute(SQL_CREATE_SEASON_SCORES)
+    con.execute(SQL_FILL_SEASON_SCORES)
+
+def _analyze(con: sqlite3.Connection) -> None:
+    # Give the query planner statistics for the new indexes
+    con.execute("ANALYZE")
+
+def _create_category_aliases(con: sqlite3.Connection) -> None:
+    con.executescript(SQL_CREATE_CATEGORY_ALIASES)
+
+def _create_race_models(con: sqlite3.Connection) -> None:
+    con.executescript(SQL_CREATE_RACE_MODELS)
+
+def _drop_race_models_rmse(con: sqlite3.Connection) -> None:
+    # The RMSE also depends on the chase times, it went stale when only they changed. The models are
+    # evaluated in full on every training instead
+    con.execute("ALTER TABLE Race_Models DROP COLUMN RMSE")
+
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _add_race_columns,
+    _create_season_scores,
+    _analyze,
+    _create_category_aliases,
+    _create_race_models,
+    _drop_race_models_rmse,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def configure_connection(con: sqlite3.Connection) -> None:
+    """Apply CONNECTION_PRAGMAS to a connection."""
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+
+def get_schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(con: sqlite3.Connection) -> int:
+    """Apply any migrations the database hasn't had yet.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database, set up with the fellpace
+            aggregates (see setup_db).
+
+    Raises:
+        RuntimeError: If the database was written by a newer version of fellpace.
+
+    Returns:
+        int: The schema version of the database.
+    """
+    version = get_schema_version(con)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema version {version} is newer than this version of fellpace supports ({SCHEMA_VERSION})')
+    for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f'Migrating database to schema version {version}: {migration.__name__.strip("_")}')
+        migration(con)
+        con.execute(f"PRAGMA user_version = {version}")
+        con.commit()
+    return get_schema_version(con)
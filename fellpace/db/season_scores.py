@@ -0,0 +1,77 @@
+"""Maintain the materialised Racer_Season_Scores table.
+
+Each row holds a racer's score for a race in a season, the XPercentile of their ZScore_log over all
+of their results for that (renamed) race within the season. Building it means grouping the whole of
+Results so it is kept up to date when results are inserted rather than calculated on every query.
+"""
+import json
+import sqlite3
+
+# Canonical_Name and Season are generated columns of Races, see fellpace.db.migrations
+RACES_RENAME_SQL = """
+    Races_Rename AS
+    (
+        SELECT Canonical_Name AS Race_Name, Season, Race_ID
+        FROM Races
+    )"""
+
+SQL_CREATE_SEASON_SCORES = """
+    CREATE TABLE IF NOT EXISTS Racer_Season_Scores
+    (
+        Racer_ID INTEGER NOT NULL,
+        Race_Name TEXT NOT NULL,
+        Season INTEGER NOT NULL,
+        ZScore REAL,
+        Num_Results INTEGER,
+        PRIMARY KEY (Racer_ID, Race_Name, Season)
+    ) WITHOUT ROWID
+"""
+
+# Materialise the renamed races so the generated Canonical_Name and Season are evaluated once per race, not once per result
+SQL_INSERT_SEASON_SCORES = f"""
+    WITH {RACES_RENAME_SQL.replace('Races_Rename AS', 'Races_Rename AS MATERIALIZED')}
+    INSERT OR REPLACE INTO Racer_Season_Scores (Racer_ID, Race_Name, Season, ZScore, Num_Results)
+    SELECT Res.Racer_ID, C.Race_Name, C.Season, XPercentile(Res.ZScore_log), COUNT(*)
+    FROM Results AS Res
+    JOIN Races_Rename AS C
+    ON C.Race_ID = Res.Race_ID
+    WHERE Res.Time IS NOT NULL
+    {{filter}}
+    GROUP BY Res.Racer_ID, C.Race_Name, C.Season
+"""
+
+# Only the racers in the new races, and only for the race/season groups those races belong to
+RACE_FILTER = """
+    AND (C.Race_Name, C.Season) IN
+        (SELECT Race_Name, Season FROM Races_Rename WHERE Race_ID IN (SELECT value FROM json_each(:race_ids)))
+    AND Res.Racer_ID IN
+        (SELECT Racer_ID FROM Results WHERE Race_ID IN (SELECT value FROM json_each(:race_ids)))
+"""
+RACER_FILTER = "AND Res.Racer_ID IN (SELECT value FROM json_each(:racer_ids))"
+
+
+def refresh_season_scores(con: sqlite3.Connection, race_ids: list = None, racer_ids: list = None) -> None:
+    """Recalculate rows of the Racer_Season_Scores table.
+
+    Provide race_ids after inserting new races, racer_ids after changing which racer results belong to
+    (e.g. merging duplicate racers). With neither the whole table is rebuilt.
+    The connection must have the XPercentile aggregate registered (see setup_db).
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+        race_ids (list): IDs of races whose results have been added.
+        racer_ids (list): IDs of racers whose results have changed.
+    """
+    con.execute(SQL_CREATE_SEASON_SCORES)
+    if race_ids is not None:
+        params = {'race_ids': json.dumps([int(race_id) for race_id in race_ids])}
+        con.execute(SQL_INSERT_SEASON_SCORES.format(filter=RACE_FILTER), params)
+    elif racer_ids is not None:
+        params = {'racer_ids': json.dumps([int(racer_id) for racer_id in racer_ids])}
+        con.execute("DELETE FROM Racer_Season_Scores WHERE Racer_ID IN (SELECT value FROM json_each(:racer_ids))", params)
+        con.execute(SQL_INSERT_SEASON_SCORES.format(filter=RACER_FILTER), params)
+    else:
+        con.execute("DELETE FROM Racer_Season_Scores")
+        con.execute(SQL_INSERT_SEASON_SCORES.format(filter=""))
+    con.commit()
+
@@ -0,0 +1,142 @@
+"""A session on the fellpace database, owning one connection for the life of a command.
+
+FellPaceDB opens (and migrates) the database once, the aggregates are registered once and sqlite3
+keeps the session's statements prepared, so helpers called many times don't pay for any of it
+again. Use it as a context manager so the connection is always closed:
+
+    with FellPaceDB() as db:
+        results = db.racers_results(racer_ID)
+
+The query methods wrap the functions in fellpace.extract, fellpace.analysis_tools and
+fellpace.parkrun, which still take a connection (db.con) for code that has one. Their modules are
+imported when first used, so a session doesn't slow the start of commands that don't need them.
+
+ReadOnlyPool hands out read only connections to threads, e.g. for predicting many racers at once.
+"""
+import queue
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import pandas as pd
+
+from fellpace.config import DB_PATH
+from fellpace.db.db_setup import connect_read_only, setup_db
+
+
+class FellPaceDB:
+    """A connection to the fellpace database, migrated to the latest schema.
+
+    Args:
+        path (Path): The database file. Defaults to DB_PATH.
+    """
+    def __init__(self, path: Path = DB_PATH):
+        self.path = Path(path)
+        self._con = setup_db(self.path)
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        if self._con is None:
+            raise sqlite3.ProgrammingError(f'The session on {self.path} is closed')
+        return self._con
+
+    @property
+    def closed(self) -> bool:
+        return self._con is None
+
+    def close(self) -> None:
+        """Close the connection, uncommitted changes are rolled back. Safe to call more than once."""
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def __enter__(self) -> 'FellPaceDB':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def racers_results(self, racer_ID: int, season: int = -1) -> pd.DataFrame:
+        from fellpace.extract.racers import get_racers_results
+        return get_racers_results(self.con, racer_ID, season)
+
+    def racers_results_many(self, racer_IDs: List[int], season: int = -1) -> pd.DataFrame:
+        from fellpace.extract.racers import get_racers_results_many
+        return get_racers_results_many(self.con, racer_IDs, season)
+
+    def find_racer_ID(self, name: str) -> Optional[int]:
+        from fellpace.extract.racers import find_racer_ID
+        return find_racer_ID(self.con, name)
+
+    def secure_racer_ID(self, racer_name: str) -> Optional[int]:
+        """The ID of a racer, asking which similar name was meant if there isn't an exact match."""
+        from fellpace.extract.racers import secure_racer_id
+        return secure_racer_id(self.con, racer_name)
+
+    def race_series_summary(self) -> pd.DataFrame:
+        from fellpace.extract.races import get_race_series_summary
+        return get_race_series_summary(self.con)
+
+    def chase_summary(self) -> pd.DataFrame:
+        from fellpace.extract.races import get_chase_summary
+        return get_chase_summary(self.con)
+
+    def previous_chase_results_many(self, racer_IDs: List[int]) -> pd.DataFrame:
+        from fellpace.extract.chase import get_previous_chase_results_many
+        return get_previous_chase_results_many(self.con, racer_IDs)
+
+    def zscore_data(self) -> pd.DataFrame:
+        """Every racer's race score alongside their following chase score, see extract_all_zscore_data."""
+        from fellpace.extract.zscores import extract_all_zscore_data
+        return extract_all_zscore_data(self.con)
+
+    def chase_log_stats(self):
+        """The cached ChaseLogStats of the database."""
+        from fellpace.analysis_tools import get_chase_log_stats
+        return get_chase_log_stats(self.con)
+
+    def parkrun_mean_std(self, season: int = -1) -> pd.DataFrame:
+        from fellpace.parkrun.stats import parkrun_mean_std
+        return parkrun_mean_std(self.con, season)
+
+
+class ReadOnlyPool:
+    """A fixed number of read only connections to the fellpace database, shared between threads.
+
+    Each thread borrows a connection for as long as it needs one, so at most size queries run at
+    once. The database is opened with setup_db first so it is migrated before being read.
+
+    Args:
+        path (Path): The database file. Defaults to DB_PATH.
+        size (int): The number of connections.
+    """
+    def __init__(self, path: Path = DB_PATH, size: int = 4):
+        self.path = Path(path)
+        setup_db(self.path).close()
+        self._connections = [connect_read_only(self.path) for _ in range(size)]
+        self._idle = queue.Queue()
+        for con in self._connections:
+            self._idle.put(con)
+
+    @contextmanager
+    def connection(self, timeout: float = None) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection, waiting up to timeout seconds (forever if None) for one to be free."""
+        if not self._connections:
+            raise sqlite3.ProgrammingError(f'The pool on {self.path} is closed')
+        con = self._idle.get(timeout=timeout)
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self) -> None:
+        for con in self._connections:
+            con.close()
+        self._connections = []
+
+    def __enter__(self) -> 'ReadOnlyPool':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
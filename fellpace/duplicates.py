@@ -0,0 +1,209 @@
+"""Find racers that have been entered into the database more than once and merge them.
+
+Comparing every racer's name with every other racer's doesn't scale to tens of thousands of
+parkrunners, so racers are first split into blocks that share a phonetic key of their surname, or of
+their first name and the initial of their surname. Only names within the same block are compared.
+The candidate pairs are ranked with the evidence from their results, how close their average ZScores
+are and whether they have ever run the same race (which one person can't do).
+"""
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import Levenshtein
+
+from fellpace.db.season_scores import refresh_season_scores
+
+SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'), **dict.fromkeys('cgjkqsxz', '2'), **dict.fromkeys('dt', '3'),
+    'l': '4', **dict.fromkeys('mn', '5'), 'r': '6',
+}
+CHUNK_SIZE = 100000 # Pairs per task when calculating edit distances over a process pool
+
+
+def soundex(word: str) -> str:
+    """The American Soundex code of a word, e.g. hamilton -> H543. Non-letters are ignored."""
+    letters = [c for c in word.lower() if c.isalpha()]
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = SOUNDEX_CODES.get(letters[0], '')
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter, '')
+        if digit and digit != previous:
+            code += digit
+        # h and w don't separate letters with the same code, vowels do
+        if letter not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+def get_blocking_keys(name: str) -> list:
+    """The blocks a racer's name belongs to, names are only compared with others in the same block."""
+    tokens = name.lower().split()
+    if not tokens:
+        return []
+    surname = tokens[-1]
+    keys = [f'S:{soundex(surname)}']
+    if len(tokens) > 1:
+        # Catches misspelt surnames as long as the first name and initial are right
+        keys.append(f'F:{soundex(tokens[0])}:{surname[0]}')
+    return keys
+
+
+def _edit_distance_chunk(names_a: list, names_b: list, max_distance: int = None) -> np.ndarray:
+    distance = partial(Levenshtein.distance, score_cutoff=max_distance)
+    return np.fromiter(map(distance, names_a, names_b), dtype=np.int64, count=len(names_a))
+
+def edit_distances(names_a, names_b, max_distance: int = None, workers: int = 1) -> np.ndarray:
+    """Levenshtein distances between each pair of names in names_a and names_b.
+
+    Args:
+        names_a: Names to compare.
+        names_b: Names to compare with, the same length as names_a.
+        max_distance (int): Distances above this are returned as max_distance + 1, which is quicker
+            to calculate. Defaults to None, exact distances.
+        workers (int): Number of processes to share the pairs between. Defaults to 1, no pool.
+
+    Returns:
+        np.ndarray: The distance of each pair.
+    """
+    names_a, names_b = list(names_a), list(names_b)
+    if workers <= 1 or len(names_a) <= CHUNK_SIZE:
+        return _edit_distance_chunk(names_a, names_b, max_distance)
+    starts = range(0, len(names_a), CHUNK_SIZE)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(
+            partial(_edit_distance_chunk, max_distance=max_distance),
+            [names_a[start:start + CHUNK_SIZE] for start in starts],
+            [names_b[start:start + CHUNK_SIZE] for start in starts],
+        )
+        return np.concatenate(list(chunks))
+
+
+def get_racer_evidence(con: sqlite3.Connection) -> pd.DataFrame:
+    """Every racer with their average ZScore_log and number of races."""
+    query = """
+    SELECT R.Racer_ID, R.Racer_Name, avg(Res.ZScore_log) AS ZScore, count(Res.ZScore_log) AS Races
+    FROM Racers AS R
+    LEFT JOIN Results AS Res
+    ON Res.Racer_ID = R.Racer_ID
+    WHERE R.Racer_Name IS NOT NULL
+    GROUP BY R.Racer_ID
+    ORDER BY R.Racer_ID
+    """
+    return pd.read_sql(query, con)
+
+def get_candidate_pairs(racers: pd.DataFrame, max_distance: int = 1) -> pd.DataFrame:
+    """Pairs of racers in the same block whose names are close enough in length to be within max_distance.
+
+    Args:
+        racers (pd.DataFrame): Racer_ID and Racer_Name of the racers, in Racer_ID order.
+        max_distance (int): The largest edit distance that will be considered a duplicate.
+
+    Returns:
+        pd.DataFrame: Positions a and b (a < b) of each pair in racers.
+    """
+    names = racers['Racer_Name'].str.lower().str.strip()
+    keys = [(position, key) for position, name in enumerate(names) for key in get_blocking_keys(name)]
+    key_positions = np.array([position for position, _ in keys], dtype=np.int64)
+    key_codes, _ = pd.factorize(pd.Series([key for _, key in keys], dtype=object))
+    # Sort the racers by block, then each block is a run of key_positions
+    order = np.argsort(key_codes, kind='stable')
+    key_positions, key_codes = key_positions[order], key_codes[order]
+    block_starts = np.flatnonzero(np.r_[True, key_codes[1:] != key_codes[:-1]])
+    block_sizes = np.diff(np.r_[block_starts, len(key_codes)])
+    pairs = []
+    for start, size in zip(block_starts[block_sizes > 1], block_sizes[block_sizes > 1]):
+        positions = key_positions[start:start + size]
+        a, b = np.triu_indices(size, k=1)
+        pairs.append(np.column_stack([positions[a], positions[b]]))
+    if not pairs:
+        return pd.DataFrame({'a': pd.Series(dtype=np.int64), 'b': pd.Series(dtype=np.int64)})
+    pairs = np.concatenate(pairs)
+    lengths = names.str.len().values
+    pairs = pairs[np.abs(lengths[pairs[:, 0]] - lengths[pairs[:, 1]]) <= max_distance]
+    # A pair can share more than one block, de-duplicate them as single integers (much quicker than rows)
+    pair_codes = np.unique(pairs[:, 0] * len(names) + pairs[:, 1])
+    return pd.DataFrame({'a': pair_codes // len(names), 'b': pair_codes % len(names)})
+
+def _count_shared_races(con: sqlite3.Connection, pairs: pd.DataFrame) -> np.ndarray:
+    racer_ids = pd.unique(pairs[['Racer_ID_a', 'Racer_ID_b']].values.ravel())
+    query = """
+    SELECT DISTINCT Racer_ID, Race_ID FROM Results
+    WHERE Racer_ID IN (SELECT value FROM json_each(?))
+    """
+    races = pd.read_sql(query, con, params=(json.dumps([int(racer_id) for racer_id in racer_ids]),))
+    shared = (
+        pairs[['Racer_ID_a', 'Racer_ID_b']].reset_index()
+        .merge(races.rename(columns={'Racer_ID': 'Racer_ID_a'}), on='Racer_ID_a')
+        .merge(races.rename(columns={'Racer_ID': 'Racer_ID_b'}), on=['Racer_ID_b', 'Race_ID'])
+        .groupby('index').size()
+    )
+    return shared.reindex(pairs.index, fill_value=0).values
+
+def find_duplicate_racers(con: sqlite3.Connection, max_distance: int = 1, workers: int = 1) -> pd.DataFrame:
+    """Find pairs of racers whose names are so similar they may be the same person.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+        max_distance (int): The largest edit distance between names to count as a possible duplicate.
+        workers (int): Number of processes to calculate the edit distances with.
+
+    Returns:
+        pd.DataFrame: One row per pair, the racer with the lower Racer_ID is a. Ranked with the most
+            likely duplicates first: closest names, then fewest races run together, then closest ZScores.
+    """
+    racers = get_racer_evidence(con)
+    positions = get_candidate_pairs(racers, max_distance)
+    names = racers['Racer_Name'].str.lower().str.strip().values
+    distances = edit_distances(names[positions['a']], names[positions['b']], max_distance, workers)
+    positions = positions.loc[distances <= max_distance]
+
+    pairs = pd.concat([
+        racers.iloc[positions['a']].add_suffix('_a').reset_index(drop=True),
+        racers.iloc[positions['b']].add_suffix('_b').reset_index(drop=True),
+    ], axis=1)
+    pairs['Distance'] = distances[distances <= max_distance]
+    pairs['ZScore_Diff'] = (pairs['ZScore_a'] - pairs['ZScore_b']).abs()
+    pairs['Shared_Races'] = _count_shared_races(con, pairs) if not pairs.empty else pd.Series(dtype=np.int64)
+    return pairs.sort_values(
+        ['Distance', 'Shared_Races', 'ZScore_Diff', 'Racer_ID_a', 'Racer_ID_b'], na_position='last'
+    ).reset_index(drop=True)
+
+
+def merge_racers(con: sqlite3.Connection, merges) -> None:
+    """Merge duplicate racers, moving all of their results to the racer being kept.
+
+    All of the merges, and the refresh of the affected season scores, are applied in one transaction.
+    Chains are followed, so merging b into a and then c into b moves c's results to a.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+        merges: (Racer_ID to keep, Racer_ID to remove) pairs.
+    """
+    replacements = {} # removed Racer_ID: kept Racer_ID
+    for keep_ID, remove_ID in merges:
+        keep_ID, remove_ID = int(keep_ID), int(remove_ID)
+        keep_ID = replacements.get(keep_ID, keep_ID)
+        if keep_ID == remove_ID or remove_ID in replacements:
+            continue
+        for removed_ID, kept_ID in replacements.items():
+            if kept_ID == remove_ID:
+                replacements[removed_ID] = keep_ID
+        replacements[remove_ID] = keep_ID
+    if not replacements:
+        return
+
+    updates = [(keep_ID, remove_ID) for remove_ID, keep_ID in replacements.items()]
+    try:
+        con.executemany("UPDATE Results SET Racer_ID = ? WHERE Racer_ID = ?", updates)
+        con.executemany("UPDATE Results_Chase SET Racer_ID = ? WHERE Racer_ID = ?", updates)
+        con.executemany("DELETE FROM Racers WHERE Racer_ID = ?", [(remove_ID,) for remove_ID in replacements])
+        # Commits the transaction once the season scores are up to date
+        refresh_season_scores(con, racer_ids=set(replacements) | set(replacements.values()))
+    except Exception:
+        con.rollback()
+        raise
@@ -1,15 +1,24 @@
 from fellpace.FellPace_tools import get_table_from_URL
 from fellpace.modelling.training import load_models
-from fellpace.modelling.prediction import get_racers_results, get_prediction_with_uncertainty_many, make_chase_prediction, get_prediction_from_parkrun_time
-from fellpace.extract.racers import secure_racer_id
+from fellpace.modelling.prediction import (
+    DEFAULT_PARAMETERS, PredictionParameters, get_racers_results, get_prediction_with_uncertainty_many, make_chase_prediction, get_predictions_from_parkrun_times,
+)
+from fellpace.extract.racers import secure_racer_id, secure_racer_id_many, get_racers_results_many
 from fellpace.analysis_tools import identify_outliers_in_predictions, convert_Chase_ZScore_logs_avg
 from fellpace.filter import filter_race_results
-from fellpace.extract.chase import get_previous_chase_results, extract_result_for_year
+from fellpace.extract.chase import get_previous_chase_results, get_previous_chase_results_many, extract_result_for_year
 from fellpace.convert_tools import seconds_to_time_string
 from fellpace.plotting.racetimes import plot_racer_entry
 
-from fellpace.config import ENTRIES_PATH
+from fellpace.db.db_setup import database_path
+from fellpace.db.session import ReadOnlyPool
+
+from fellpace.config import DB_PATH, ENTRIES_PATH
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
 import pandas as pd
 from tabulate import tabulate
 
@@ -136,57 +145,214 @@ def process_results_for_racer(con: Connection,coeffs, covar, racer_name: str = N
         return prepare_chase_results_for_prediction(chase_results, racer_name), chase_results  
     
     racer_results_with_predictions = get_prediction_with_uncertainty_many(coeffs, covar, racer_results)
+    return filter_results_for_racer(racer_results_with_predictions, chase_results, racer_name), chase_results
+
+def filter_results_for_racer(racer_results_with_predictions: pd.DataFrame, chase_results: pd.DataFrame, racer_name: str = None, outlier_threshold: float = DEFAULT_PARAMETERS.outlier_threshold) -> pd.DataFrame:
+    """
+    Combine a racer's predicted results with their chase results and flag which to include in the prediction.
     
+    Args:
+        racer_results_with_predictions (pd.DataFrame): The racer's results with Zpred_mu and Zpred_sig.
+        chase_results (pd.DataFrame): The racer's previous chase results.
+        racer_name (str): Name of the racer, only used for logging. Defaults to None.
+        outlier_threshold (float): Threshold for identify_outliers_in_predictions, in IQRs.
+        
+    Returns:
+        pd.DataFrame: All results with 'outlier' and 'include' columns.
+    """
     if chase_results.empty:
         logger.warning(f"{racer_name} has no chase results.")
         all_results = racer_results_with_predictions
     else:
         all_results = combine_results_with_chase_results(racer_results_with_predictions, chase_results)
-    all_results['outlier'] = identify_outliers_in_predictions(all_results['Zpred_mu'], threshold=1.2)
+    all_results['outlier'] = identify_outliers_in_predictions(all_results['Zpred_mu'], threshold=outlier_threshold)
     filter_race_results(all_results)
-    return all_results, chase_results
+    return all_results
+
+# Columns of the frame predict_many returns, Predicted_Time is in seconds
+PREDICTION_COLUMNS = ['Racer_ID', 'Racer_Name', 'Num_results_used', 'Num_excluded_results', 'chase_mu', 'chase_sig', 'Predicted_Time']
 
-def process_entries(entries: pd.DataFrame, con: Connection,year_of_entry: int, with_parkrun: bool = False, plot: bool = False) -> pd.DataFrame:
+def predict_racers(con: Connection, coeffs, covar, racer_ids, year: int, verbose: bool = False, parameters: PredictionParameters = DEFAULT_PARAMETERS) -> Tuple[List[dict], List[pd.DataFrame]]:
+    """
+    Predict the chase in a year for a group of racers, from the results they had before it.
+    
+    The racers' results and chase history are each fetched with one query and every result is
+    predicted in one operation, only the filtering and the final prediction are made per racer.
+    Results of races without a model are skipped, racers without any results before the year are left out.
+    
+    Args:
+        con (Connection): Connection to the fellpace database.
+        coeffs (pd.Series): Coefficients for the model.
+        covar (pd.Series): Covariance matrix for the model.
+        racer_ids (list): IDs of the racers.
+        year (int): Year of the chase to predict.
+        verbose (bool): Log the results used by each prediction and their weights.
+        parameters (PredictionParameters): The weights, decay and outlier threshold of the predictions.
+        
+    Returns:
+        Tuple[List[dict], List[pd.DataFrame]]: A row of PREDICTION_COLUMNS (but Predicted_Time) for
+        each racer predicted, in the order of racer_ids, and the results each prediction used with
+        their 'include' column.
+    """
+    racer_ids = [int(racer_id) for racer_id in racer_ids]
+    all_results = get_racers_results_many(con, racer_ids)
+    all_results = all_results.loc[all_results['Season'] < year]
+    all_chase_results = get_previous_chase_results_many(con, racer_ids)
+    all_chase_results = all_chase_results.loc[all_chase_results['Season'] < year]
+    # Races without a model (new since the models were trained, or too few results) can't be predicted from
+    modelled = all_results['Race_Name'].isin(coeffs.index)
+    if not modelled.all():
+        logger.debug(f"No model for races: {sorted(set(all_results.loc[~modelled, 'Race_Name']))}")
+        all_results = all_results.loc[modelled]
+    predictions, racer_results_list = [], []
+    if all_results.empty:
+        return predictions, racer_results_list
+    
+    all_results = get_prediction_with_uncertainty_many(coeffs, covar, all_results)
+    chase_by_racer = {racer_id: results.reset_index(drop=True) for racer_id, results in all_chase_results.groupby('Racer_ID')}
+    results_by_racer = dict(tuple(all_results.groupby('Racer_ID')))
+    for racer_id in racer_ids:
+        if racer_id not in results_by_racer:
+            continue
+        racer_results = results_by_racer[racer_id]
+        racer_name = racer_results['Racer_Name'].iloc[0]
+        chase_results = chase_by_racer.get(racer_id, all_chase_results.iloc[0:0].copy())
+        racer_results = filter_results_for_racer(racer_results.reset_index(drop=True), chase_results, racer_name, parameters.outlier_threshold)
+        included = racer_results.loc[racer_results['include']]
+        if verbose:
+            logger.info(f"Including {len(included)} in calculation for {racer_name}:\n {tabulate(included, headers='keys', tablefmt='rounded_outline')}")
+            if len(included) < len(racer_results):
+                logger.info(f"Excluded results:\n {tabulate(racer_results.loc[~racer_results['include']], headers='keys', tablefmt='rounded_outline')}")
+        chase_mu, chase_sig = make_chase_prediction(included, prediction_year=year, verbose=verbose, parameters=parameters)
+        predictions.append({
+            'Racer_ID': int(racer_id),
+            'Racer_Name': racer_name,
+            'Num_results_used': len(included),
+            'Num_excluded_results': len(racer_results) - len(included),
+            'chase_mu': chase_mu,
+            'chase_sig': chase_sig,
+        })
+        racer_results_list.append(racer_results)
+    return predictions, racer_results_list
+
+def _collect_predictions(con: Connection, shard_outputs) -> pd.DataFrame:
+    """The predictions of every shard as one frame of PREDICTION_COLUMNS, with their Predicted_Time."""
+    predictions = pd.DataFrame(
+        [prediction for shard_predictions, _ in shard_outputs for prediction in shard_predictions],
+        columns=PREDICTION_COLUMNS[:-1],
+    )
+    predictions['Predicted_Time'] = np.asarray(
+        convert_Chase_ZScore_logs_avg(con, (predictions['chase_mu'] - (1.96 * predictions['chase_sig'])).to_numpy(dtype=float))
+    )
+    return predictions
+
+def predict_many(racer_ids, year: int = date.today().year, workers: int = 1, path: Path = DB_PATH, coeffs=None, covar=None, verbose: bool = False, with_results: bool = False, parameters: PredictionParameters = DEFAULT_PARAMETERS, con: Connection = None):
+    """
+    Predict the chase in a year for many racers, sharing them between threads.
+    
+    The racers are split into a shard per worker and each worker predicts its shard with
+    predict_racers on its own read only connection (see ReadOnlyPool). The workers share the model
+    arrays, loaded once by load_models.
+    
+    Given a connection and one worker, the racers are predicted on that connection, so they see
+    its uncommitted changes. With more workers the pool is opened on the connection's database file,
+    which only has what has been committed, and an in-memory database can't be shared.
+    
+    Args:
+        racer_ids (list): IDs of the racers, None (not found) and repeated IDs are skipped.
+        year (int): Year of the chase to predict. Defaults to this year.
+        workers (int): Number of threads. Defaults to 1, no pool.
+        path (Path): The database file. Defaults to DB_PATH.
+        coeffs (pd.Series): Coefficients for the model. Defaults to load_models.
+        covar (pd.Series): Covariance matrix for the model, needed if coeffs is given.
+        verbose (bool): Log the results used by each prediction and their weights.
+        with_results (bool): Also return the results each prediction used.
+        parameters (PredictionParameters): The weights, decay and outlier threshold of the predictions.
+        con (Connection): A connection to predict on instead of path, see above.
+        
+    Returns:
+        pd.DataFrame: PREDICTION_COLUMNS for each racer with results before the year, in the order of
+        racer_ids. With with_results, a tuple of this and a list of each racer's results.
+    """
+    if coeffs is None:
+        coeffs, covar = load_models()
+    racer_ids = list(dict.fromkeys(int(racer_id) for racer_id in racer_ids if racer_id is not None))
+    workers = max(1, workers)
+    
+    if con is not None and workers == 1:
+        shard_outputs = [predict_racers(con, coeffs, covar, racer_ids, year, verbose, parameters)] if racer_ids else []
+        predictions = _collect_predictions(con, shard_outputs)
+    else:
+        if con is not None:
+            path = database_path(con)
+            if path is None:
+                raise ValueError(f"Can't predict on {workers} workers from an in-memory database, use workers=1")
+        shards = [shard for shard in np.array_split(np.array(racer_ids, dtype=int), workers) if len(shard)]
+        with ReadOnlyPool(path, size=workers) as pool:
+            def predict_shard(shard):
+                with pool.connection() as pool_con:
+                    return predict_racers(pool_con, coeffs, covar, shard, year, verbose, parameters)
+            if workers > 1 and len(shards) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    shard_outputs = list(executor.map(predict_shard, shards))
+            else:
+                shard_outputs = [predict_shard(shard) for shard in shards]
+            with pool.connection() as pool_con:
+                predictions = _collect_predictions(pool_con, shard_outputs)
+    if with_results:
+        return predictions, [results for _, shard_results in shard_outputs for results in shard_results]
+    return predictions
+
+def process_entries(entries: pd.DataFrame, con: Connection,year_of_entry: int, with_parkrun: bool = False, plot: bool = False, workers: int = 1, verbose: bool = True) -> pd.DataFrame:
     """
     Process entries DataFrame to get predicted times and previous results.
     
+    All entrants are predicted as a batch by predict_many. With one worker they are predicted on con,
+    with more on a pool of read only connections to its database file (not an in-memory database).
+    
     Args:
         entries (pd.DataFrame): DataFrame containing the entries.
+        workers (int): Number of threads to predict the entrants on. Defaults to 1.
+        verbose (bool): Log the results used by each entrant's prediction.
         
     Returns:
         pd.DataFrame: Processed DataFrame with necessary columns.
     """
     coeffs, covar = load_models()
-    processed_entries = pd.DataFrame()
-    all_racer_results = pd.DataFrame()
-    all_racer_predictions = pd.DataFrame()
     this_year = date.today().year
-    for i, entry in entries.iterrows():
-        racer_name = entry['Name']
-        logger.info(f"Processing entry for {racer_name}")
-        
-        if with_parkrun:
-            PR_time = entry.get('PR_time', None)
-            if PR_time is not None:
-                pr_prediction_t = get_prediction_from_parkrun_time(con, PR_time, coeffs['PR_Endcliffe'], covar['PR_Endcliffe'])
-                logger.info(f"PR time for {racer_name}: {seconds_to_time_string(pr_prediction_t)}")
-                pr_prediction_str = seconds_to_time_string(pr_prediction_t)
-            else:
-                pr_prediction_str = "N/A"
+    racer_names = list(entries['Name'])
+    
+    racer_ids = secure_racer_id_many(con, racer_names)
+    found_ids = sorted({int(racer_id) for racer_id in racer_ids if racer_id is not None})
+    
+    all_racer_predictions, racer_results_list = predict_many(
+        found_ids, year_of_entry, workers=workers, con=con,
+        coeffs=coeffs, covar=covar, verbose=verbose, with_results=True,
+    )
+    predictions_by_racer = all_racer_predictions.set_index('Racer_ID')
+    all_chase_results = get_previous_chase_results_many(con, found_ids)
+    chase_by_racer = {racer_id: results.reset_index(drop=True) for racer_id, results in all_chase_results.groupby('Racer_ID')}
+    
+    if with_parkrun and 'PR_time' in entries.columns:
+        pr_predictions = get_predictions_from_parkrun_times(con, entries['PR_time'], coeffs['PR_Endcliffe'], covar['PR_Endcliffe'])
+    else:
+        pr_predictions = [np.nan] * len(entries)
+    
+    processed_entries = []
+    for racer_name, racer_id, pr_prediction_t in zip(racer_names, racer_ids, pr_predictions):
+        if np.isnan(pr_prediction_t):
+            pr_prediction_str = "N/A"
+        else:
+            logger.info(f"PR time for {racer_name}: {seconds_to_time_string(pr_prediction_t)}")
+            pr_prediction_str = seconds_to_time_string(pr_prediction_t)
         
-        racer_id = secure_racer_id(con, racer_name.lower().strip())        
         if racer_id is None:
             logger.warning(f"Racer {racer_name} not found in database.")
-            racer_results = None
-            excluded_results = None
-            chase_results = None
-        else:
-
-            racer_results, chase_results = process_results_for_racer(con, coeffs, covar, racer_id = racer_id)
-        
-        if racer_results is None:
+        elif int(racer_id) not in predictions_by_racer.index:
+            logger.warning(f"{racer_name} has not run in any valid races.")
+        if racer_id is None or int(racer_id) not in predictions_by_racer.index:
             logger.warning(f"Creating blank entry for {racer_name} as racer not found.")
-            entry_series = pd.Series({
+            processed_entries.append({
             'Name': racer_name,
             'Num_results_used': 0,
             'Num_excluded_results': 0,
@@ -196,57 +362,28 @@ def process_entries(entries: pd.DataFrame, con: Connection,year_of_entry: int, w
             f'Chase {this_year-2}': "N/A",
             f'Chase {this_year-3}': "N/A"
             })
-            processed_entries = pd.concat([processed_entries, entry_series.to_frame().T], ignore_index=True)
             continue
-       
-        logger.info(f"Including {len(racer_results)} in calculation:\n {tabulate(racer_results, headers='keys', tablefmt='rounded_outline')}")
-        all_racer_results = pd.concat([all_racer_results, racer_results], ignore_index=True)
-            
-        if (~racer_results['include']).any():
-            logger.info(f"Excluded results:\n {tabulate(racer_results.loc[~racer_results['include']], headers='keys', tablefmt='rounded_outline')}")
-
-        if racer_results.empty:
-            prediction_str = 'N/A'
-        else:
-            # Subtracting 1 from the year of entry as year before race is most recent possible
-            chase_mu, chase_sig = make_chase_prediction(racer_results.loc[racer_results['include']],prediction_year = year_of_entry,  verbose=True)   
-            prediction = chase_mu - (1.96 * chase_sig)
-            prediction_t = convert_Chase_ZScore_logs_avg(con, prediction)[0]
-            prediction_str = seconds_to_time_string(prediction_t)
-            all_racer_predictions = pd.concat(
-                [
-                    all_racer_predictions,
-                    pd.DataFrame(
-                        [{
-                            'Racer_Name': racer_name,
-                            'chase_mu': chase_mu,
-                            'chase_sig': chase_sig
-                        }]
-                    )
-                ],
-                ignore_index=True
-            )
-
-            if plot:
-                plot_racer_entry(con, racer_results, excluded_results,chase_mu, chase_sig, prediction_t, racer_name, prediction_year=this_year)
-
-        # Create a series for this racer's entry
-        # Add last three years of chase results too
-        
         
-        entry_series = pd.Series({
+        prediction = predictions_by_racer.loc[int(racer_id)]
+        chase_results = chase_by_racer.get(int(racer_id), all_chase_results.iloc[0:0].copy())
+        # Add last three years of chase results too
+        processed_entries.append({
             'Name': racer_name,
-            'Num_results_used': len(racer_results.loc[racer_results['include']]),
-            'Num_excluded_results': len(racer_results.loc[~racer_results['include']]),
-            'Predicted_Time': prediction_str,
+            'Num_results_used': prediction['Num_results_used'],
+            'Num_excluded_results': prediction['Num_excluded_results'],
+            'Predicted_Time': seconds_to_time_string(prediction['Predicted_Time']),
             'Given PR time': pr_prediction_str,
             f'Chase {this_year-1}': extract_result_for_year(chase_results, this_year - 1),
             f'Chase {this_year-2}': extract_result_for_year(chase_results, this_year - 2),
             f'Chase {this_year-3}': extract_result_for_year(chase_results, this_year - 3),
         })
-        processed_entries = pd.concat([processed_entries, entry_series.to_frame().T], ignore_index=True)
-        
-        
+
+    processed_entries = pd.DataFrame(processed_entries)
+    all_racer_results = pd.concat(racer_results_list, ignore_index=True) if racer_results_list else pd.DataFrame()
+    
+    if plot:
+        for racer_results, prediction in zip(racer_results_list, all_racer_predictions.itertuples()):
+            plot_racer_entry(con, racer_results, prediction.chase_mu, prediction.chase_sig, prediction.Predicted_Time, prediction.Racer_Name, prediction_year=this_year)
 
     logger.info(f"Processed entries:\n {tabulate(processed_entries, headers='keys', tablefmt='rounded_outline')}")
     entries_filepath = ENTRIES_PATH / f"processed_entries_{year_of_entry}.csv"
@@ -1,6 +1,8 @@
 "Tools to extract chase related data from the database."
+import json
 import pandas as pd
 from sqlite3 import Connection
+from loguru import logger
 
 from fellpace.convert_tools import seconds_to_time_string
 from fellpace.extract.racers import secure_racer_id
@@ -40,6 +42,32 @@ def get_previous_chase_results(con: Connection, racer_id: int = None, racer_name
     racer_id = int(racer_id)  # Ensure racer_id is an integer
     return pd.read_sql(sql, con, params=(racer_id,))
 
+def get_previous_chase_results_many(con: Connection, racer_ids) -> pd.DataFrame:
+    """
+    Get previous chase results for many racers in a single query.
+    
+    Args:
+        con (Connection): SQLite connection object.
+        racer_ids (list): IDs of the racers.
+        
+    Returns:
+        pd.DataFrame: Same columns as get_previous_chase_results, ordered by racer then most recent chase first.
+    """
+    sql = """
+    SELECT 
+        C.Racer_ID,
+        "Hallam Chase" AS Race_Name,
+        C.Time,
+        C.ZScore_log AS Zpred_mu,
+        CAST(strftime('%Y', CH.Chase_Date) AS INTEGER) AS Season
+    FROM Results_Chase AS C
+    JOIN Chases AS CH ON C.Chase_ID = CH.Chase_ID
+    WHERE C.Racer_ID IN (SELECT value FROM json_each(?))
+    ORDER BY C.Racer_ID, CH.Chase_Date DESC
+    """
+    racer_ids = json.dumps([int(racer_id) for racer_id in racer_ids])
+    return pd.read_sql(sql, con, params=(racer_ids,))
+
 def extract_result_for_year(results: pd.DataFrame, year: int) -> pd.DataFrame:
     """
     Extract results for a specific year.
@@ -0,0 +1,149 @@
+"""Fuzzy racer name lookups without scanning the Racers table.
+
+NameIndex is an inverted index of the q-grams (pairs of neighbouring characters) in each racer's name.
+A single edit can only remove Q distinct q-grams from a name, so any name within max_distance edits of
+the one being looked up shares all but Q * max_distance of its distinct q-grams. Counting the shared
+q-grams through the index narrows the racers down to a handful of candidates, and only those have
+their Levenshtein distance calculated.
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import Levenshtein
+
+from fellpace.db.db_setup import database_key
+
+Q = 2
+
+
+def get_qgrams(name: str) -> set:
+    """The distinct q-grams of a name, padded so the first and last characters are in Q of them."""
+    padded = '^' * (Q - 1) + name + '$' * (Q - 1)
+    return {padded[i:i + Q] for i in range(len(padded) - Q + 1)}
+
+
+class NameIndex:
+    """An index of lower case racer names for finding those within max_distance edits of a name.
+
+    Args:
+        max_distance (int): The default Levenshtein distance for lookup.
+    """
+    def __init__(self, max_distance: int = 2):
+        self.max_distance = max_distance
+        self.racer_IDs = []
+        self.racer_names = []
+        self.lower_names = []
+        self.name_lengths = []
+        self.qgrams = {} # q-gram: positions (in the lists above) of the names containing it
+        self._arrays = {} # numpy copies of the q-gram positions and name lengths, made when needed
+        self.last_racer_ID = 0
+        self.table_size = (0, 0) # rows and last Racer_ID of the Racers table when last updated
+
+    @property
+    def num_racers(self) -> int:
+        return len(self.racer_IDs)
+
+    def add(self, racer_ID: int, racer_name: str) -> None:
+        racer_ID = int(racer_ID)
+        name = racer_name.lower()
+        position = len(self.racer_IDs)
+        self.racer_IDs.append(racer_ID)
+        self.racer_names.append(racer_name)
+        self.lower_names.append(name)
+        self.name_lengths.append(len(name))
+        for qgram in get_qgrams(name):
+            self.qgrams.setdefault(qgram, []).append(position)
+            self._arrays.pop(qgram, None)
+        self._arrays.pop('name_lengths', None)
+        self.last_racer_ID = max(self.last_racer_ID, racer_ID)
+
+    def add_racers(self, racers: pd.DataFrame) -> None:
+        """Add the Racer_ID and Racer_Name columns of racers to the index."""
+        for racer_ID, racer_name in zip(racers['Racer_ID'], racers['Racer_Name']):
+            self.add(racer_ID, racer_name)
+
+    def _array(self, key: str, values: list) -> np.ndarray:
+        if key not in self._arrays:
+            self._arrays[key] = np.array(values, dtype=np.int64)
+        return self._arrays[key]
+
+    def matches(self, name: str, max_distance: int = None) -> list:
+        """Find the racers whose names are within max_distance edits of name (ignoring case).
+
+        Args:
+            name (str): The name to look up.
+            max_distance (int): Defaults to the max_distance of the index.
+
+        Returns:
+            list: (Racer_ID, Racer_Name, distance) of each match, ordered by Racer_ID.
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        name = name.lower()
+        qgrams = get_qgrams(name)
+        shared_qgrams = np.zeros(self.num_racers, dtype=np.int64)
+        for qgram in qgrams:
+            if qgram in self.qgrams:
+                shared_qgrams[self._array(qgram, self.qgrams[qgram])] += 1
+        name_lengths = self._array('name_lengths', self.name_lengths)
+        candidates = np.flatnonzero(
+            (shared_qgrams >= len(qgrams) - Q * max_distance)
+            & (np.abs(name_lengths - len(name)) <= max_distance)
+        )
+
+        matches = []
+        for position in candidates:
+            # Distances over the cutoff come back as cutoff + 1
+            distance = Levenshtein.distance(name, self.lower_names[position], score_cutoff=max_distance)
+            if distance <= max_distance:
+                matches.append((self.racer_IDs[position], self.racer_names[position], distance))
+        matches.sort()
+        return matches
+
+    def lookup(self, name: str, max_distance: int = None) -> pd.DataFrame:
+        """The same as matches but as a DataFrame with Racer_ID, Racer_Name and distance columns."""
+        return pd.DataFrame(self.matches(name, max_distance), columns=['Racer_ID', 'Racer_Name', 'distance'])
+
+
+# Name indexes for each database, kept up to date by update_name_index
+_name_indexes = {}
+
+def _get_racers(con: sqlite3.Connection, after_racer_ID: int = 0) -> pd.DataFrame:
+    query = "SELECT Racer_ID, Racer_Name FROM Racers WHERE Racer_ID > ? ORDER BY Racer_ID"
+    return pd.read_sql(query, con, params=(after_racer_ID,))
+
+def update_name_index(con: sqlite3.Connection) -> NameIndex:
+    """Get the name index for a database, bringing it up to date with the Racers table.
+
+    Racers added since the index was last updated are added to it. If racers have been removed
+    (e.g. merged duplicates) it is rebuilt. Renamed racers aren't noticed, use clear_name_index_cache.
+
+    Args:
+        con (sqlite3.Connection): A connection to the fellpace database.
+
+    Returns:
+        NameIndex: The index of the database's racer names.
+    """
+    key = database_key(con)
+    # Cheap to check, COUNT uses the smallest index and MAX the primary key
+    num_rows, last_racer_ID = con.execute("SELECT COUNT(*), IFNULL(MAX(Racer_ID), 0) FROM Racers").fetchone()
+    name_index = _name_indexes.get(key)
+    if name_index is not None and name_index.table_size == (num_rows, last_racer_ID):
+        return name_index
+
+    new_racers = None if name_index is None else _get_racers(con, name_index.last_racer_ID)
+    if new_racers is None or name_index.table_size[0] + len(new_racers) != num_rows:
+        name_index = NameIndex()
+        new_racers = _get_racers(con)
+    name_index.add_racers(new_racers.dropna(subset=['Racer_Name']))
+    name_index.table_size = (num_rows, last_racer_ID)
+    name_index.last_racer_ID = last_racer_ID
+    _name_indexes[key] = name_index
+    return name_index
+
+def clear_name_index_cache(con: sqlite3.Connection = None) -> None:
+    """Forget the name index of a database (after renaming racers), or of all databases if con is None."""
+    if con is None:
+        _name_indexes.clear()
+    else:
+        _name_indexes.pop(database_key(con), None)
@@ -1,7 +1,9 @@
+import json
 import pandas as pd
-import Levenshtein
 from loguru import logger
 
+from fellpace.extract.name_index import update_name_index
+
 
 def find_racer_ID(con, name):
     racer_ID_query = """
@@ -14,62 +16,61 @@ def find_racer_ID(con, name):
         return None
     return racer_match["Racer_ID"].values[0]
 
+def find_racer_ID_many(con, names) -> pd.Series:
+    """Exact (case-insensitive) lookup of many racer names in one query.
+
+    Returns a Series of Racer_IDs indexed by the lower case name, names not in the DB are missing.
+    """
+    racer_ID_query = """
+    SELECT lower(Racer_Name) AS Name, Racer_ID FROM Racers
+    WHERE lower(Racer_Name) IN (SELECT value FROM json_each(?))
+    ORDER BY Racer_ID
+    """
+    names = json.dumps(sorted({name.lower() for name in names}))
+    racer_matches = pd.read_sql(racer_ID_query, con, params=(names,))
+    # Same as find_racer_ID, the first racer with the name wins
+    racer_matches = racer_matches.drop_duplicates(subset='Name')
+    return racer_matches.set_index('Name')['Racer_ID']
+
 def find_similar_name(con, name:str):
-    #Get a list of the racers and racer_ids from the database
+    """Find the racers whose names are within 2 edits of name, using the cached name index."""
     assert name.lower() == name, "Lower case names only"
-    
-    Get_racer_query = """
-    SELECT Racer_ID, Racer_Name
-    FROM Racers
-    """
-    racers = pd.read_sql_query(Get_racer_query,con)
-    racers['distance'] = racers.apply(lambda r: Levenshtein.distance(name, r["Racer_Name"].lower()) ,axis = 1)
-    return racers[racers['distance'] <= 2].reset_index(drop=True)
+    return update_name_index(con).lookup(name, max_distance=2)
 
 
-def get_racers_results(con, racer_ID, season: int = -1) -> pd.DataFrame:
-    season_filter = "" if season == -1 else "AND Season = ?"
-    query = f"""
-    WITH Racers_Results AS
-    (
-        SELECT Racer_ID, ZScore_log, Race_ID, Time
-        FROM Results
-    ),
-    Races_Rename AS
-    (
-        SELECT CASE
-        WHEN Race_Name LIKE "Parkrun_endcliffe%" THEN "PR_Endcliffe"
-        WHEN Race_Name LIKE "Parkrun_hillsborough%" THEN "PR_Hillsborough"
-        ELSE Race_Name
-        END  AS Race_Name,
-        CASE
-            WHEN CAST(strftime("%m",Race_Date) AS INTEGER) > 5
-            THEN CAST(strftime("%Y",Race_Date) AS INTEGER)
-            ELSE CAST(strftime("%Y",Race_Date) AS INTEGER) -1
-        END AS Season,
-        Race_ID
-        FROM Races
-    ),
-    Results_joined AS
-    (
-        SELECT R.Racer_ID, R.Racer_Name, C.Race_Name, C.Season, XPercentile(ZScore_log) as ZScore, C.Race_ID
-        FROM Racers_Results
-        LEFT JOIN Races_Rename as C
-        ON C.Race_ID = Racers_Results.Race_ID
-        JOIN Racers AS R
-        ON R.Racer_ID = Racers_Results.Racer_ID
-        WHERE Time IS NOT NULL
-        GROUP BY R.Racer_ID, C.Race_Name, C.Season
-    )
-    SELECT R.Racer_ID,R.Racer_Name, R.Race_Name, R.Season, R.ZScore
-    FROM Results_joined as R
-    WHERE R.Racer_ID = ?
+# Scores per racer, race and season are materialised in Racer_Season_Scores (see fellpace.db.season_scores)
+RACERS_RESULTS_SQL = """
+    SELECT S.Racer_ID, R.Racer_Name, S.Race_Name, S.Season, S.ZScore
+    FROM Racer_Season_Scores AS S
+    JOIN Racers AS R
+    ON R.Racer_ID = S.Racer_ID
+    WHERE {racer_filter}
     {season_filter}
+    ORDER BY S.Racer_ID, S.Race_Name, S.Season
     """
-    query_params = (str(racer_ID),) if season == -1 else (str(racer_ID), season)
+
+def get_racers_results(con, racer_ID, season: int = -1) -> pd.DataFrame:
+    season_filter = "" if season == -1 else "AND S.Season = ?"
+    query = RACERS_RESULTS_SQL.format(racer_filter="S.Racer_ID = ?", season_filter=season_filter)
+    query_params = (int(racer_ID),) if season == -1 else (int(racer_ID), season)
     racer_results = pd.read_sql(query, con, params=query_params)
     return racer_results
 
+def get_racers_results_many(con, racer_IDs, season: int = -1) -> pd.DataFrame:
+    """Get the results for many racers in a single query.
+
+    Returns the same columns as get_racers_results, ordered by Racer_ID so each racer's
+    results can be split back out with a groupby.
+    """
+    season_filter = "" if season == -1 else "AND S.Season = ?"
+    query = RACERS_RESULTS_SQL.format(
+        racer_filter="S.Racer_ID IN (SELECT value FROM json_each(?))",
+        season_filter=season_filter
+    )
+    racer_IDs = json.dumps([int(racer_ID) for racer_ID in racer_IDs])
+    query_params = (racer_IDs,) if season == -1 else (racer_IDs, season)
+    return pd.read_sql(query, con, params=query_params)
+
 if __name__ == "__main__":
     from fellpace.db.db_setup import setup_db
     from fellpace.config import DB_PATH
@@ -96,3 +97,19 @@ def secure_racer_id(con, racer_name: str):
             return
         racer_id = names.iloc[selected_index]['Racer_ID']
     return racer_id
+
+def secure_racer_id_many(con, racer_names) -> list:
+    """Resolve a list of racer names to IDs.
+
+    Exact matches are found with a single query, only the misses fall back to secure_racer_id
+    and its similar name search. The returned list is aligned with racer_names, None where no racer was found.
+    """
+    racer_names = [racer_name.lower().strip() for racer_name in racer_names]
+    exact_ids = find_racer_ID_many(con, racer_names)
+    racer_ids = []
+    for racer_name in racer_names:
+        if racer_name in exact_ids.index:
+            racer_ids.append(exact_ids[racer_name])
+        else:
+            racer_ids.append(secure_racer_id(con, racer_name))
+    return racer_ids
@@ -0,0 +1,174 @@
+"""Replay past Hallam Chases to measure how well the predictions would have done.
+
+For each chase year the race models are trained only on the race and chase scores known before that
+chase, every finisher is predicted from their results before it with predict_many, and the
+predictions are compared with what actually happened:
+
+- the chase ZScore_log the racer ran against the predicted distribution (calibration: how often it
+  falls in the 68% and 95% intervals, and the spread of the standardised errors, 1 if calibrated)
+- the predicted time against their actual time, in seconds (the chase stats are those of the earlier
+  chases, as they would have been)
+- the order of the predictions against the order they finished (Spearman's rank correlation)
+
+Training a year is the slow part, so each year's models are saved to BACKTEST_CACHE_PATH with a hash
+of the data they were trained on and reused while it hasn't changed. Years are run on a process pool.
+"""
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy.stats import spearmanr
+
+from fellpace.analysis_tools import get_chase_log_stats
+from fellpace.config import BACKTEST_CACHE_PATH, DB_PATH
+from fellpace.db.db_setup import connect_read_only
+from fellpace.entries import predict_many
+from fellpace.extract.zscores import extract_all_zscore_data
+from fellpace.modelling.prediction import DEFAULT_PARAMETERS, PredictionParameters
+from fellpace.modelling.ransac import RANSAC_SEED, add_inliers
+from fellpace.modelling.training import (
+    MODEL_FORMAT_VERSION, fit_from_stats, get_sufficient_stats, load_model_file, models_to_series, save_model_file,
+)
+
+# The fewest inliers a race needs for a model with an uncertainty (np.polyfit needs more points than coefficients)
+MIN_RACE_INLIERS = 3
+
+BACKTEST_METRICS = ['N', 'RMSE', 'MAE', 'Bias', 'Spearman', 'Coverage_68', 'Coverage_95', 'Z_Std']
+
+def get_chase_years(con: sqlite3.Connection) -> List[int]:
+    return [year for year, in con.execute(
+        "SELECT DISTINCT CAST(strftime('%Y', Chase_Date) AS INTEGER) AS Year FROM Chases ORDER BY Year"
+    )]
+
+def get_chase_finishers(con: sqlite3.Connection, year: int) -> pd.DataFrame:
+    """The Racer_ID, Time and ZScore_log of every finisher of the chase in a year."""
+    sql = """
+    SELECT C.Racer_ID, C.Time, C.ZScore_log
+    FROM Results_Chase AS C
+    JOIN Chases AS CH ON C.Chase_ID = CH.Chase_ID
+    WHERE CAST(strftime('%Y', CH.Chase_Date) AS INTEGER) = ?
+    AND C.Time IS NOT NULL AND C.Racer_ID IS NOT NULL
+    """
+    return pd.read_sql(sql, con, params=(year,))
+
+def get_training_data(data_Zs: pd.DataFrame, year: int) -> pd.DataFrame:
+    """The race and chase scores known before the chase in a year, a season's scores pair with the next year's chase."""
+    return data_Zs.loc[data_Zs['Season'] + 1 < year].reset_index(drop=True)
+
+def get_training_key(training_Zs: pd.DataFrame) -> str:
+    """A hash of everything the models trained on some data depend on."""
+    key = hashlib.sha1(f'{MODEL_FORMAT_VERSION}|{RANSAC_SEED}|{MIN_RACE_INLIERS}'.encode())
+    training_Zs = training_Zs.sort_values(['Race_Name', 'Season', 'Racer_ID'])
+    key.update('|'.join(training_Zs['Race_Name']).encode())
+    for column in ['ZScore', 'HCScore']:
+        key.update(training_Zs[column].to_numpy(dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+def train_year_models(training_Zs: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
+    """Fit the race models to the inliers of some training data, leaving out races with too few."""
+    stats = get_sufficient_stats(add_inliers(training_Zs, cache_path=None))
+    models = fit_from_stats(stats.loc[stats['N'] >= MIN_RACE_INLIERS])
+    return models_to_series(models)
+
+def load_year_models(training_Zs: pd.DataFrame, year: int, cache_dir: Path = BACKTEST_CACHE_PATH) -> Tuple[pd.Series, pd.Series]:
+    """The models for a year's chase, from the cache if they were trained on the same data before."""
+    key = get_training_key(training_Zs)
+    path = None if cache_dir is None else Path(cache_dir) / f'{year}.npz'
+    if path is not None and path.exists():
+        model_file = load_model_file(path)
+        if model_file.metadata.get('training_key') == key:
+            return model_file.to_series()
+    coeffs, covar = train_year_models(training_Zs)
+    if path is not None:
+        save_model_file(coeffs, covar, {'training_key': key, 'year': year, 'rows': len(training_Zs)}, path)
+    return coeffs, covar
+
+def backtest_year(year: int, path: Path = DB_PATH, cache_dir: Path = BACKTEST_CACHE_PATH, parameters: PredictionParameters = DEFAULT_PARAMETERS) -> pd.DataFrame:
+    """
+    Predict every finisher of a year's chase as it would have been predicted before the chase.
+
+    Args:
+        year (int): Year of the chase.
+        path (Path): The database file.
+        cache_dir (Path): Where each year's models are cached, None to always train them.
+        parameters (PredictionParameters): The parameters of the predictions.
+
+    Returns:
+        pd.DataFrame: A row for each finisher with a prediction, the predict_many columns with the
+        actual Time and ZScore_log and the Predicted_Time from the earlier chases' stats.
+    """
+    con = connect_read_only(path)
+    try:
+        training_Zs = get_training_data(extract_all_zscore_data(con), year)
+        finishers = get_chase_finishers(con, year)
+        chase_stats = get_chase_log_stats(con).yearly
+    finally:
+        con.close()
+    chase_stats = chase_stats.loc[chase_stats.index < year]
+    if training_Zs.empty or finishers.empty or chase_stats.empty:
+        logger.info(f'Nothing to backtest for {year}')
+        return pd.DataFrame()
+
+    coeffs, covar = load_year_models(training_Zs, year, cache_dir)
+    predictions = predict_many(finishers['Racer_ID'], year, path=path, coeffs=coeffs, covar=covar, parameters=parameters)
+    predictions = predictions.merge(finishers, on='Racer_ID')
+    # The time of the predicted (mean) score as the earlier chases would have converted it
+    mn, sd = chase_stats['mn'].mean(), chase_stats['sd'].mean()
+    predictions['Predicted_Time'] = np.exp(mn + sd * predictions['chase_mu'])
+    predictions.insert(0, 'Year', year)
+    return predictions
+
+def summarise_backtest(predictions: pd.DataFrame, by='Year') -> pd.DataFrame:
+    """BACKTEST_METRICS of backtest predictions grouped by a column, with an 'All' row for all of them."""
+    def metrics(group: pd.DataFrame) -> pd.Series:
+        residuals = group['Predicted_Time'] - group['Time']
+        z_errors = (group['ZScore_log'] - group['chase_mu']) / group['chase_sig']
+        return pd.Series({
+            'N': len(group),
+            'RMSE': np.sqrt(np.mean(residuals ** 2)),
+            'MAE': residuals.abs().mean(),
+            'Bias': residuals.mean(),
+            'Spearman': spearmanr(group['chase_mu'], group['Time']).statistic if len(group) > 1 else np.nan,
+            'Coverage_68': (z_errors.abs() <= 1).mean(),
+            'Coverage_95': (z_errors.abs() <= 1.96).mean(),
+            'Z_Std': z_errors.std(),
+        })
+    summary = pd.DataFrame({key: metrics(group) for key, group in predictions.groupby(by)}).T
+    summary.loc['All'] = metrics(predictions)
+    summary['N'] = summary['N'].astype(int)
+    return summary[BACKTEST_METRICS]
+
+def run_backtest(years: List[int] = None, workers: int = 1, path: Path = DB_PATH, cache_dir: Path = BACKTEST_CACHE_PATH, parameters: PredictionParameters = DEFAULT_PARAMETERS) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Backtest the chase predictions for each year.
+
+    Args:
+        years (List[int]): The chase years to replay. Defaults to every chase in the database.
+        workers (int): Number of processes to run the years on. Defaults to 1, no pool.
+        path (Path): The database file.
+        cache_dir (Path): Where each year's models are cached, None to always train them.
+        parameters (PredictionParameters): The parameters of the predictions, see fellpace.modelling.sweep.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The prediction for every finisher of every year (see
+        backtest_year) and their summary by year (see summarise_backtest).
+    """
+    if years is None:
+        con = connect_read_only(path)
+        years = get_chase_years(con)
+        con.close()
+    if workers > 1 and len(years) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            year_predictions = list(pool.map(backtest_year, years, [path] * len(years), [cache_dir] * len(years), [parameters] * len(years)))
+    else:
+        year_predictions = [backtest_year(year, path, cache_dir, parameters) for year in years]
+    year_predictions = [predictions for predictions in year_predictions if not predictions.empty]
+    if not year_predictions:
+        return pd.DataFrame(), pd.DataFrame(columns=BACKTEST_METRICS)
+    predictions = pd.concat(year_predictions, ignore_index=True)
+    return predictions, summarise_backtest(predictions)
@@ -47,9 +47,11 @@ def calculate_recency_weights(year_to_predict: int, season: np.ndarray, initial_
     return initial_weights * np.exp(-lambda_decay * time_since_race)
 
 
-def recency_weighted_bayesian(prior_mu, prior_sigma, observed_mu, observed_sigma, weights, race_names = None, lambda_decay=0.25):
+def recency_weighted_bayesian(prior_mu, prior_sigma, observed_mu, observed_sigma, weights, race_names = None, lambda_decay=0.25, dispersion_weight=0.5):
     """
     Compute the posterior mean and standard deviation using a recency-weighted Bayesian approach.
+    
+    The posterior variance is widened by dispersion_weight times the weighted variance of the observed means.
     """
 
     precisions = weights / (observed_sigma ** 2)
@@ -67,7 +69,7 @@ def recency_weighted_bayesian(prior_mu, prior_sigma, observed_mu, observed_sigma
 
     posterior_mu = (np.sum(precisions * observed_mu) + prior_precision * prior_mu) / (np.sum(precisions) + prior_precision)
     # Adjust posterior variance calculation to scale dispersion variance
-    posterior_variance = 1 / (np.sum(precisions) + prior_precision) + (dispersion_variance/2)
+    posterior_variance = 1 / (np.sum(precisions) + prior_precision) + (dispersion_weight * dispersion_variance)
     posterior_sigma = np.sqrt(posterior_variance)
 
     return posterior_mu, posterior_sigma
@@ -4,6 +4,7 @@ from fellpace.extract.racers import get_racers_results
 from fellpace.modelling.bayesian import calculate_initial_weights, calculate_recency_weights ,recency_weighted_bayesian
 from fellpace.parkrun.stats import parkrun_mean_std
 
+from dataclasses import dataclass
 from typing import Dict, Tuple
 from datetime import date
 
@@ -11,24 +12,90 @@ import numpy as np
 import pandas as pd
 
 
+@dataclass(frozen=True)
+class PredictionParameters:
+    """
+    The tunable parameters of a chase prediction, fellpace.modelling.sweep searches for the best.
+    
+    Args:
+        lambda_decay (float): Decay rate of the weights with the seasons since a race, see calculate_recency_weights.
+        lower_weight (float): Initial weight of parkrun results, see calculate_initial_weights.
+        heavier_weight (float): Initial weight of previous chase results.
+        outlier_threshold (float): IQRs above the upper quartile a result is an outlier, see identify_outliers_in_predictions.
+        dispersion_weight (float): Fraction of the spread of the results added to the posterior variance.
+    """
+    lambda_decay: float = 0.25
+    lower_weight: float = 0.8
+    heavier_weight: float = 1.2
+    outlier_threshold: float = 1.2
+    dispersion_weight: float = 0.5
+
+DEFAULT_PARAMETERS = PredictionParameters()
+
 def get_predicted_times(con, coeffs: pd.DataFrame, racer_ID: int, season: int = -1) -> pd.DataFrame:
 
     racer_results = get_racers_results(con, racer_ID, season)
     if racer_results.empty:
         return pd.DataFrame()
-    racer_results['PredZ'] = racer_results.apply(lambda x: np.polyval(coeffs[x['Race_Name']], x['ZScore']), axis=1)
+    races, coeff_array, _ = stack_model_arrays(coeffs)
+    race_idx = get_race_indices(races, racer_results['Race_Name'])
+    x_vectors = np.vander(racer_results['ZScore'].to_numpy(dtype=float), coeff_array.shape[1])
+    racer_results['PredZ'] = np.einsum('ij,ij->i', x_vectors, coeff_array[race_idx])
     racer_results['Predicted Time'] = convert_Chase_ZScore_logs_avg(con, racer_results['PredZ'])
     
     return racer_results[['Racer_Name', 'Race_Name', 'Season', 'ZScore', 'PredZ', 'Predicted Time']].sort_values(['Season','Race_Name'])
 
+def stack_model_arrays(coeffs, cov_matrices = None) -> Tuple[pd.Index, np.ndarray, np.ndarray]:
+    """
+    Stack the per-race model coefficients and covariance matrices into arrays.
+    
+    Args:
+        coeffs: Coefficients for each race, indexed by race name (output of np.polyfit).
+        cov_matrices: Covariance matrix for each race, indexed by race name. Optional.
+        
+    Returns:
+        Tuple[pd.Index, np.ndarray, np.ndarray]: The race names, a (races, degree + 1) coefficient array
+        and a (races, degree + 1, degree + 1) covariance array (None if no covariances given).
+    """
+    races = pd.Index(coeffs.index)
+    coeff_array = np.array([np.asarray(coeffs[race], dtype=float) for race in races])
+    if cov_matrices is None:
+        return races, coeff_array, None
+    cov_array = np.array([np.asarray(cov_matrices[race], dtype=float) for race in races])
+    return races, coeff_array, cov_array
+
+def get_race_indices(races: pd.Index, race_names: pd.Series) -> np.ndarray:
+    """Get the position of each race name in the stacked model arrays, raising a KeyError for unmodelled races."""
+    race_idx = races.get_indexer(race_names)
+    if (race_idx < 0).any():
+        missing = sorted(set(race_names[race_idx < 0]))
+        raise KeyError(f"No model for races: {missing}")
+    return race_idx
+
 def get_prediction_with_uncertainty_many(coeffs, cov_matrices, racer_results):
-    def calculate_uncertainty(row):
-        race = row['Race_Name']
-        ZScore = row['ZScore']
-        row['Zpred_mu'], row['Zpred_sig'] = get_prediction_with_uncertainty(coeffs[race], cov_matrices[race], ZScore)
-        return row
+    """
+    Calculates the predicted value and its uncertainty for every result in a DataFrame.
+    
+    This is the vectorised form of get_prediction_with_uncertainty, the model for each result is
+    looked up from arrays stacked by race so all results are calculated in one operation.
 
-    racer_results_modified = racer_results.apply(calculate_uncertainty, axis=1)
+    Args:
+        coeffs: Coefficients for each race, indexed by race name.
+        cov_matrices: Covariance matrix for each race, indexed by race name.
+        racer_results (pd.DataFrame): Results with 'Race_Name' and 'ZScore' columns.
+
+    Returns:
+        pd.DataFrame: A copy of racer_results with 'Zpred_mu' and 'Zpred_sig' columns added.
+    """
+    races, coeff_array, cov_array = stack_model_arrays(coeffs, cov_matrices)
+    race_idx = get_race_indices(races, racer_results['Race_Name'])
+    # Rows of [x, 1] for a linear model, matching the order of the np.polyfit coefficients
+    x_vectors = np.vander(racer_results['ZScore'].to_numpy(dtype=float), coeff_array.shape[1])
+    
+    racer_results_modified = racer_results.copy()
+    racer_results_modified['Zpred_mu'] = np.einsum('ij,ij->i', x_vectors, coeff_array[race_idx])
+    variance = np.einsum('ij,ijk,ik->i', x_vectors, cov_array[race_idx], x_vectors)
+    racer_results_modified['Zpred_sig'] = np.sqrt(variance)
     return racer_results_modified
         
 
@@ -52,7 +119,7 @@ def get_prediction_with_uncertainty(coeffs, cov_matrix, x):
 
     return mean_prediction, std_dev
 
-def make_chase_prediction(racer_result_with_predictions, prediction_year: int = None, verbose: bool = False) -> Tuple[float, float]:
+def make_chase_prediction(racer_result_with_predictions, prediction_year: int = None, verbose: bool = False, parameters: PredictionParameters = DEFAULT_PARAMETERS) -> Tuple[float, float]:
     """
     Make a single prediction for the chase based on a series of individual predictions.
     
@@ -65,6 +132,8 @@ def make_chase_prediction(racer_result_with_predictions, prediction_year: int =
         racer_result_with_predictions (pd.DataFrame): DataFrame containing the results with predictions.
         prediction_year (int): The year for which the prediction is made. Defaults to current year.
         verbose (bool): If True, prints additional information about the prediction process.
+        parameters (PredictionParameters): The weights and decay to use. The outlier threshold isn't
+            used here, outliers are flagged before (see filter_results_for_racer).
     
     Returns:
         Tuple[float, float]: The predicted mean and standard deviation of the chase ZScore.
@@ -78,7 +147,9 @@ def make_chase_prediction(racer_result_with_predictions, prediction_year: int =
     prior_sigma = 1
     
     # Calculate initial weights for each race
-    racer_result_with_predictions['Initial_Weight'] = calculate_initial_weights(racer_result_with_predictions)
+    racer_result_with_predictions['Initial_Weight'] = calculate_initial_weights(
+        racer_result_with_predictions, parameters.lower_weight, parameters.heavier_weight
+    )
     
     # Update the weights based on recency
     initial_weights = racer_result_with_predictions['Initial_Weight'].values
@@ -86,7 +157,8 @@ def make_chase_prediction(racer_result_with_predictions, prediction_year: int =
     racer_result_with_predictions['Recency_Weight'] = calculate_recency_weights(
         prediction_year,
         season,
-        initial_weights
+        initial_weights,
+        parameters.lambda_decay
     )
     
     # Extract values from the DataFrame
@@ -98,10 +170,45 @@ def make_chase_prediction(racer_result_with_predictions, prediction_year: int =
         race_names = (racer_result_with_predictions['Race_Name'] + ' ' + racer_result_with_predictions['Season'].astype(str)).values
     else:
         race_names = None
-    predicted_mu, predicted_sigma = recency_weighted_bayesian(prior_mu, prior_sigma, mu_values, sigma_values, weights, race_names=race_names) 
+    predicted_mu, predicted_sigma = recency_weighted_bayesian(
+        prior_mu, prior_sigma, mu_values, sigma_values, weights, race_names=race_names, dispersion_weight=parameters.dispersion_weight
+    )
     return predicted_mu, predicted_sigma
     
 
+def get_distribution_grid(a = -3, b = 3, step=0.01) -> np.ndarray:
+    """The points in [a, b], step apart, that probability distributions are evaluated at.
+
+    The points are calculated from their index rather than by repeatedly adding step so they don't
+    drift away from the exact values.
+    """
+    # The small tolerance keeps b in the grid when (b - a) / step is a whole number give or take rounding
+    num_points = int(np.floor((b - a) / step + 1e-9)) + 1
+    return a + step * np.arange(num_points)
+
+def get_probability_distributions(means, std_devs, a = -3, b = 3, step=0.01) -> np.ndarray:
+    """
+    Calculates the probability distributions of many predictions at once, see get_probability_distribution.
+
+    Args:
+        means: Means of the normal distributions.
+        std_devs: Standard deviations of the normal distributions, the same length as means.
+        a: Lower bound of the range (inclusive).
+        b: Upper bound of the range (inclusive).
+        step: Step size for the range.
+
+    Returns:
+        A 2D array with a row of probabilities for each (mean, std_dev) pair and a column for each point
+        of get_distribution_grid(a, b, step).
+    """
+    means = np.asarray(means, dtype=float).reshape(-1, 1)
+    std_devs = np.asarray(std_devs, dtype=float).reshape(-1, 1)
+    grid = get_distribution_grid(a, b, step)
+    # Each point takes the probability between the edges half a step either side of it,
+    # neighbouring points share an edge so the CDF only needs evaluating once per edge
+    edges = np.append(grid - step / 2, grid[-1] + step / 2)
+    return np.diff(norm.cdf(edges, loc=means, scale=std_devs), axis=1)
+
 def get_probability_distribution(mean, std_dev, a = -3, b = 3, step=0.01):
     """
     Calculates the probability distribution of predictions within bounds [a, b],
@@ -115,22 +222,10 @@ def get_probability_distribution(mean, std_dev, a = -3, b = 3, step=0.01):
         step: Step size for the range (default is 1 second).
 
     Returns:
-        A dictionary where keys are seconds in the range [a, b] and values are probabilities.
+        A series where the index is the points in the range [a, b] and values are probabilities.
     """
-
-    # Create a probability distribution for each second in the range [a, b]
-    probabilities = {}
-    current = a
-    while current <= b:
-        # Calculate the probability of the prediction being within this range
-        prob = (
-                norm.cdf(current + step / 2, loc=mean, scale=std_dev) -
-                norm.cdf(current - step / 2, loc=mean, scale=std_dev)
-               )
-        probabilities[current] = prob
-        current += step
-
-    return pd.Series(probabilities)
+    probabilities = get_probability_distributions([mean], [std_dev], a, b, step)[0]
+    return pd.Series(probabilities, index=get_distribution_grid(a, b, step))
 
 
 def get_prediction_from_parkrun_time(con, parkrun_time: str, coeffs: pd.DataFrame, cov_matrices: Dict[str, np.ndarray]) -> pd.DataFrame:
@@ -146,22 +241,43 @@ def get_prediction_from_parkrun_time(con, parkrun_time: str, coeffs: pd.DataFram
     Returns:
         pd.DataFrame: DataFrame with predicted times.
     """
-    # Convert parkrun time to seconds
-    parkrun_seconds = sum(int(x) * 60 ** i for i, x in enumerate(reversed(parkrun_time.split(':'))))
+    return get_predictions_from_parkrun_times(con, [parkrun_time], coeffs, cov_matrices)[0]
+
+def get_predictions_from_parkrun_times(con, parkrun_times, coeffs: pd.DataFrame, cov_matrices: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Get the predicted chase times for many parkrun times at once.
+    
+    The parkrun and chase statistics are only queried once for the whole batch.
+    
+    Args:
+        con: Database connection.
+        parkrun_times (list): Parkrun times in HH:MM:SS format, missing times can be None.
+        coeffs (pd.DataFrame): Coefficients for the prediction model.
+        cov_matrices (Dict[str, np.ndarray]): Covariance matrices for the prediction model.
+        
+    Returns:
+        np.ndarray: Predicted times in seconds, NaN where no parkrun time was given.
+    """
+    # Convert parkrun times to seconds
+    parkrun_seconds = np.array([
+        np.nan if pd.isna(parkrun_time) else
+        sum(int(x) * 60 ** i for i, x in enumerate(reversed(parkrun_time.split(':'))))
+        for parkrun_time in parkrun_times
+    ], dtype=float)
     
     log_seconds = np.log(parkrun_seconds)
     
     stats = parkrun_mean_std(con, season = (date.today().year)-1)
     
-    z_score = ((log_seconds - stats['Mean']) / stats['StdDev']).squeeze()
-    
-    mean, std = get_prediction_with_uncertainty(coeffs, cov_matrices, z_score)
+    z_scores = (log_seconds - stats['Mean'].iloc[0]) / stats['StdDev'].iloc[0]
     
-    pr_prediction = mean - (1.96 * std) 
+    means = np.polyval(coeffs, z_scores)
+    x_vectors = np.stack([z_scores, np.ones_like(z_scores)], axis=1)
+    stds = np.sqrt(np.einsum('ij,jk,ik->i', x_vectors, np.asarray(cov_matrices), x_vectors))
     
-    pr_prediction_t = convert_Chase_ZScore_logs_avg(con, pr_prediction)[0]
+    pr_predictions = means - (1.96 * stds)
     
-    return pr_prediction_t
+    return np.asarray(convert_Chase_ZScore_logs_avg(con, pr_predictions))
     
 if __name__ == "__main__":
     # This is just a placeholder to prevent execution when imported
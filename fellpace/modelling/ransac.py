@@ -1,26 +1,98 @@
+"""Find the inliers of each race's ZScore against HCScore with RANSAC, to train the models on.
+
+Each race is fitted with its own seed, derived from RANSAC_SEED and the race name, so the inliers are
+the same every time. The inlier mask of each race is cached under a hash of the race's data, so after
+adding results only the races that changed are fitted again. Races can be fitted on a process pool.
+"""
+import hashlib
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 from sklearn import linear_model
 
+from fellpace.config import INLIERS_CACHE_PATH
+
 # Some of the more relaxed races find poor models
 # If the race name is in the list below, limit the fit of the model to 1st coeff > 1
 # This is inline with the more relaxed races
 modify_races = ['PR_Endcliffe']
+RANSAC_SEED = 0
 
 def force_over_1(fit, *args):
     return fit.coef_[0][0] > 1
 
-def find_inliers(group):
-    X = group.ZScore.values.reshape([-1,1])
-    y = group.HCScore.values.reshape([-1,1])
-    if group.name in modify_races:
-        ransac = linear_model.RANSACRegressor(is_model_valid=force_over_1, max_trials=1000)
+def get_race_seed(race_name: str, seed: int = RANSAC_SEED) -> int:
+    """The random state for a race, the same in every process (unlike hash)."""
+    return (zlib.crc32(race_name.encode()) + seed) % 2**32
+
+def fit_inliers(race_name: str, ZScore: np.ndarray, HCScore: np.ndarray, seed: int = RANSAC_SEED) -> np.ndarray:
+    """The inlier mask of RANSAC fitted to a race's data."""
+    X = ZScore.reshape([-1,1])
+    y = HCScore.reshape([-1,1])
+    random_state = get_race_seed(race_name, seed)
+    if race_name in modify_races:
+        ransac = linear_model.RANSACRegressor(is_model_valid=force_over_1, max_trials=1000, random_state=random_state)
     else:
-        ransac = linear_model.RANSACRegressor()
-        
+        ransac = linear_model.RANSACRegressor(random_state=random_state)
     ransac.fit(X, y)
-    return pd.Series(ransac.inlier_mask_)
+    return ransac.inlier_mask_
+
+def get_group_key(race_name: str, ZScore: np.ndarray, HCScore: np.ndarray, seed: int = RANSAC_SEED) -> str:
+    """The cache key of a race's inliers, changes if anything that affects the fit does."""
+    key = hashlib.sha1()
+    key.update(f'{race_name}|{seed}|{race_name in modify_races}'.encode())
+    key.update(np.ascontiguousarray(ZScore, dtype=np.float64).tobytes())
+    key.update(np.ascontiguousarray(HCScore, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+def load_inlier_cache(cache_path: Path = INLIERS_CACHE_PATH) -> dict:
+    if cache_path is None or not Path(cache_path).exists():
+        return {}
+    with np.load(cache_path) as cached:
+        return {key: cached[key] for key in cached.files}
+
+def save_inlier_cache(cache: dict, cache_path: Path = INLIERS_CACHE_PATH) -> None:
+    if cache_path is None:
+        return
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(cache_path, **cache)
+
+
+def add_inliers(data_Zs: pd.DataFrame, workers: int = 1, seed: int = RANSAC_SEED, cache_path: Path = INLIERS_CACHE_PATH) -> pd.DataFrame:
+    """Add an inlier column to the race and chase scores, from RANSAC fitted to each race.
+
+    Args:
+        data_Zs (pd.DataFrame): Race_Name, ZScore and HCScore of every racer, see extract_all_zscore_data.
+        workers (int): Number of processes to fit the races on. Defaults to 1, no pool.
+        seed (int): Seed the seed of each race is derived from.
+        cache_path (Path): File of cached inlier masks, None to fit every race without a cache.
 
+    Returns:
+        pd.DataFrame: data_Zs with the inlier column.
+    """
+    cache = load_inlier_cache(cache_path)
+    groups = {
+        race_name: (group.index, group['ZScore'].to_numpy(dtype=float), group['HCScore'].to_numpy(dtype=float))
+        for race_name, group in data_Zs.groupby('Race_Name', sort=True)
+    }
+    keys = {race_name: get_group_key(race_name, ZScore, HCScore, seed) for race_name, (_, ZScore, HCScore) in groups.items()}
+    to_fit = [race_name for race_name, key in keys.items() if key not in cache]
+    if to_fit:
+        arguments = ([groups[race_name][1] for race_name in to_fit], [groups[race_name][2] for race_name in to_fit])
+        if workers > 1 and len(to_fit) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                masks = list(pool.map(fit_inliers, to_fit, *arguments, [seed] * len(to_fit)))
+        else:
+            masks = [fit_inliers(race_name, ZScore, HCScore, seed) for race_name, ZScore, HCScore in zip(to_fit, *arguments)]
+        cache.update({keys[race_name]: mask for race_name, mask in zip(to_fit, masks)})
 
-def add_inliers(data_Zs):
-    data_Zs['inlier'] = data_Zs.groupby('Race_Name', group_keys=False, sort=True, as_index=False).apply(find_inliers).values
-    return data_Zs
\ No newline at end of file
+    data_Zs['inlier'] = False
+    for race_name, (index, _, _) in groups.items():
+        data_Zs.loc[index, 'inlier'] = cache[keys[race_name]]
+    # Only keep the races still in the data, so the cache doesn't grow with every change
+    if to_fit or len(cache) != len(keys):
+        save_inlier_cache({key: cache[key] for key in keys.values()}, cache_path)
+    return data_Zs
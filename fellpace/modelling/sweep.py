@@ -0,0 +1,294 @@
+"""Search the prediction parameters for the ones that would have predicted past chases best.
+
+A chase prediction has a few hand picked constants (PredictionParameters): how fast the weight of a
+result decays with its age, the initial weights of parkrun and chase results, the outlier threshold
+and how much of the spread of the results is added to the uncertainty. Backtesting each candidate
+with run_backtest would fetch and predict every result again for each one, so instead:
+
+1. get_sweep_inputs backtests once and keeps the results every finisher's prediction was made from
+   (their Zpred_mu, Zpred_sig, season and kind of race) with the ZScore_log they actually ran. This
+   is the only part that reads the database or trains models (cached like run_backtest's).
+2. evaluate_parameters makes the predictions of a block of candidates at once, with arrays of
+   candidates by results summed per finisher by np.add.reduceat. Outliers only depend on the
+   threshold, so they are found once for each threshold in the candidates.
+3. The candidates are ranked by SWEEP_LOSS, the mean negative log likelihood of the actual chase
+   scores under the predicted distributions, which rewards both an accurate mean and a calibrated
+   sigma.
+
+Thousands of candidates take seconds once the inputs are gathered, see benchmarks/bench_sweep.py.
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from fellpace.config import BACKTEST_CACHE_PATH, DB_PATH
+from fellpace.db.db_setup import connect_read_only
+from fellpace.entries import predict_many
+from fellpace.extract.zscores import extract_all_zscore_data
+from fellpace.filter import filter_race_results
+from fellpace.modelling.backtest import get_chase_finishers, get_chase_years, get_training_data, load_year_models
+from fellpace.modelling.prediction import DEFAULT_PARAMETERS, PredictionParameters
+
+PARAMETERS = [parameter.name for parameter in fields(PredictionParameters)]
+
+SWEEP_METRICS = ['NLL', 'RMSE', 'MAE', 'Bias', 'Coverage_68', 'Coverage_95', 'Z_Std']
+SWEEP_LOSS = 'NLL'
+
+DEFAULT_GRID = {
+    'lambda_decay': [0.0, 0.1, 0.25, 0.5, 1.0],
+    'lower_weight': [0.5, 0.8, 1.0],
+    'heavier_weight': [1.0, 1.2, 1.5, 2.0],
+    'outlier_threshold': [0.75, 1.2, 1.5, 3.0],
+    'dispersion_weight': [0.0, 0.25, 0.5, 1.0],
+}
+
+# (low, high) of each parameter for a random search
+DEFAULT_RANGES = {
+    'lambda_decay': (0.0, 1.5),
+    'lower_weight': (0.2, 1.5),
+    'heavier_weight': (0.5, 3.0),
+    'outlier_threshold': (0.5, 3.0),
+    'dispersion_weight': (0.0, 1.5),
+}
+
+# Random outlier thresholds are rounded to this, so candidates share their outliers
+THRESHOLD_STEP = 0.05
+
+# Candidates by results cells evaluated at once, bounds the memory of a block
+BLOCK_CELLS = 4_000_000
+
+# The prior of make_chase_prediction, a standard normal
+PRIOR_MU, PRIOR_SIGMA = 0.0, 1.0
+
+def parameter_grid(grid: Dict[str, Sequence[float]] = DEFAULT_GRID) -> pd.DataFrame:
+    """Every combination of the values in grid, parameters not in it keep their default."""
+    defaults = {name: getattr(DEFAULT_PARAMETERS, name) for name in PARAMETERS}
+    combinations = itertools.product(*grid.values())
+    return pd.DataFrame([{**defaults, **dict(zip(grid, values))} for values in combinations], columns=PARAMETERS)
+
+def random_parameters(n: int, ranges: Dict[str, Tuple[float, float]] = DEFAULT_RANGES, seed: int = 0) -> pd.DataFrame:
+    """n candidates drawn uniformly from ranges, parameters not in it keep their default."""
+    rng = np.random.default_rng(seed)
+    parameters = pd.DataFrame({name: np.full(n, getattr(DEFAULT_PARAMETERS, name)) for name in PARAMETERS})
+    for name, (low, high) in ranges.items():
+        parameters[name] = rng.uniform(low, high, n)
+    parameters['outlier_threshold'] = (parameters['outlier_threshold'] / THRESHOLD_STEP).round() * THRESHOLD_STEP
+    return parameters
+
+@dataclass
+class SweepInputs:
+    """
+    What the predictions of the finishers of past chases are made from.
+
+    Args:
+        results (pd.DataFrame): The Finisher (row of finishers), Year, Race_Name, Season, Zpred_mu and
+            Zpred_sig of each result the finishers' predictions use, and whether filter_race_results
+            includes it before outliers are removed (include). Each finisher's results are together.
+        finishers (pd.DataFrame): The Year, Racer_ID and actual ZScore_log of each finisher.
+    """
+    results: pd.DataFrame
+    finishers: pd.DataFrame
+    _outliers: Dict[float, np.ndarray] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        finisher = self.results['Finisher'].to_numpy()
+        self.starts = np.flatnonzero(np.r_[True, finisher[1:] != finisher[:-1]])
+        self.finisher = finisher
+        self.n_results = np.diff(np.r_[self.starts, len(finisher)])
+        self.mu = self.results['Zpred_mu'].to_numpy(dtype=float)
+        self.inv_var = 1 / self.results['Zpred_sig'].to_numpy(dtype=float) ** 2
+        self.age = ((self.results['Year'] - 1) - self.results['Season']).to_numpy(dtype=float)
+        self.is_parkrun = self.results['Race_Name'].str.contains('PR_').to_numpy()
+        self.is_chase = self.results['Race_Name'].str.contains('Hallam Chase').to_numpy()
+        self.include = self.results['include'].to_numpy(dtype=bool)
+        self.actual = self.finishers['ZScore_log'].to_numpy(dtype=float)
+
+    def outliers(self, threshold: float) -> np.ndarray:
+        """identify_outliers_in_predictions of every finisher's results at once, cached per threshold."""
+        if threshold not in self._outliers:
+            mu = pd.Series(self.mu)
+            outliers = np.zeros(len(mu), dtype=bool)
+            for _ in range(2):
+                kept = mu.loc[~outliers].groupby(self.finisher[~outliers])
+                q1 = kept.quantile(0.25).reindex(range(len(self.starts)))
+                q3 = kept.quantile(0.75).reindex(range(len(self.starts)))
+                fence = (q3 + threshold * (q3 - q1)).to_numpy()
+                outliers = self.mu > fence[self.finisher]
+            # Fewer than 4 results don't give a stable inter-quartile range
+            outliers &= self.n_results[self.finisher] >= 4
+            self._outliers[threshold] = outliers
+        return self._outliers[threshold]
+
+def get_year_inputs(year: int, path: Path = DB_PATH, cache_dir: Path = BACKTEST_CACHE_PATH) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """The results and finishers of SweepInputs for the chase in a year, with Finisher counting from 0."""
+    con = connect_read_only(path)
+    try:
+        training_Zs = get_training_data(extract_all_zscore_data(con), year)
+        finishers = get_chase_finishers(con, year)
+    finally:
+        con.close()
+    if training_Zs.empty or finishers.empty:
+        logger.info(f'Nothing to sweep for {year}')
+        return pd.DataFrame(), pd.DataFrame()
+
+    coeffs, covar = load_year_models(training_Zs, year, cache_dir)
+    predictions, racers_results = predict_many(finishers['Racer_ID'], year, path=path, coeffs=coeffs, covar=covar, with_results=True)
+    year_results = []
+    for finisher, racer_results in enumerate(racers_results):
+        # Outliers depend on the threshold being swept, flag what's included without them
+        racer_results = racer_results.drop(columns=['outlier', 'include'])
+        filter_race_results(racer_results)
+        racer_results['Finisher'] = finisher
+        year_results.append(racer_results[['Finisher', 'Race_Name', 'Season', 'Zpred_mu', 'Zpred_sig', 'include']])
+    results = pd.concat(year_results, ignore_index=True)
+    results.insert(1, 'Year', year)
+    finishers = predictions[['Racer_ID']].merge(finishers[['Racer_ID', 'ZScore_log']], on='Racer_ID', how='left')
+    finishers.insert(0, 'Year', year)
+    return results, finishers
+
+def get_sweep_inputs(years: List[int] = None, workers: int = 1, path: Path = DB_PATH, cache_dir: Path = BACKTEST_CACHE_PATH) -> SweepInputs:
+    """
+    Gather the inputs of the predictions of every finisher of past chases.
+
+    Args:
+        years (List[int]): The chase years. Defaults to every chase in the database.
+        workers (int): Number of processes to gather the years on. Defaults to 1, no pool.
+        path (Path): The database file.
+        cache_dir (Path): Where each year's models are cached (shared with run_backtest), None to always train them.
+
+    Returns:
+        SweepInputs: The inputs of every year, in order.
+    """
+    if years is None:
+        con = connect_read_only(path)
+        years = get_chase_years(con)
+        con.close()
+    if workers > 1 and len(years) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            year_inputs = list(pool.map(get_year_inputs, years, [path] * len(years), [cache_dir] * len(years)))
+    else:
+        year_inputs = [get_year_inputs(year, path, cache_dir) for year in years]
+    year_inputs = [(results, finishers) for results, finishers in year_inputs if not finishers.empty]
+    if not year_inputs:
+        raise ValueError(f'No chase in {years} has finishers that could be predicted')
+
+    all_results, all_finishers, offset = [], [], 0
+    for results, finishers in year_inputs:
+        all_results.append(results.assign(Finisher=results['Finisher'] + offset))
+        all_finishers.append(finishers)
+        offset += len(finishers)
+    return SweepInputs(pd.concat(all_results, ignore_index=True), pd.concat(all_finishers, ignore_index=True))
+
+def _block_posteriors(inputs: SweepInputs, include: np.ndarray, block: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """make_chase_prediction of every finisher (columns) for a block of candidates (rows) with the same outliers."""
+    def per_finisher(values):
+        return np.add.reduceat(values, inputs.starts, axis=-1)
+
+    initial_weights = np.where(
+        inputs.is_parkrun,
+        block[['lower_weight']].to_numpy(),
+        np.where(inputs.is_chase, block[['heavier_weight']].to_numpy(), 1.0),
+    )
+    weights = initial_weights * np.exp(-block[['lambda_decay']].to_numpy() * inputs.age) * include
+    precisions = weights * inputs.inv_var
+    total_weight = per_finisher(weights)
+    total_precision = per_finisher(precisions) + 1 / PRIOR_SIGMA ** 2
+    posterior_mu = (per_finisher(precisions * inputs.mu) + PRIOR_MU / PRIOR_SIGMA ** 2) / total_precision
+
+    # The weighted spread of the results about their (unweighted) mean, 0 for a finisher without any
+    n_included = per_finisher(include.astype(float))
+    mean_mu = np.divide(per_finisher(include * inputs.mu), n_included, out=np.zeros_like(n_included), where=n_included > 0)
+    spread = per_finisher(weights * (inputs.mu - mean_mu[inputs.finisher]) ** 2)
+    dispersion = np.divide(spread, total_weight, out=np.zeros_like(spread), where=total_weight > 0)
+    posterior_variance = 1 / total_precision + block[['dispersion_weight']].to_numpy() * dispersion
+    return posterior_mu, np.sqrt(posterior_variance)
+
+def _blocks(inputs: SweepInputs, parameters: pd.DataFrame):
+    """The candidates in blocks of at most BLOCK_CELLS cells, with the results each block includes."""
+    block_size = max(1, BLOCK_CELLS // max(1, len(inputs.mu)))
+    for threshold, candidates in parameters.groupby('outlier_threshold', sort=False):
+        include = inputs.include & ~inputs.outliers(threshold)
+        for start in range(0, len(candidates), block_size):
+            yield include, candidates.iloc[start:start + block_size]
+
+def get_posteriors(inputs: SweepInputs, parameters: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The predicted chase_mu and chase_sig of every finisher for each candidate.
+
+    Args:
+        inputs (SweepInputs): The inputs of the predictions.
+        parameters (pd.DataFrame): A candidate per row, with a column for each of PARAMETERS.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Arrays of candidates (in the order of parameters) by finishers.
+    """
+    posterior_mu = np.empty((len(parameters), len(inputs.finishers)))
+    posterior_sigma = np.empty_like(posterior_mu)
+    positions = pd.Series(np.arange(len(parameters)), index=parameters.index)
+    for include, block in _blocks(inputs, parameters):
+        rows = positions[block.index].to_numpy()
+        posterior_mu[rows], posterior_sigma[rows] = _block_posteriors(inputs, include, block)
+    return posterior_mu, posterior_sigma
+
+def score_posteriors(posterior_mu: np.ndarray, posterior_sigma: np.ndarray, actual: np.ndarray) -> pd.DataFrame:
+    """SWEEP_METRICS of each candidate's (row's) predictions of the actual chase scores."""
+    errors = posterior_mu - actual
+    z_errors = errors / posterior_sigma
+    return pd.DataFrame({
+        'NLL': np.mean(0.5 * np.log(2 * np.pi) + np.log(posterior_sigma) + 0.5 * z_errors ** 2, axis=1),
+        'RMSE': np.sqrt(np.mean(errors ** 2, axis=1)),
+        'MAE': np.mean(np.abs(errors), axis=1),
+        'Bias': np.mean(errors, axis=1),
+        'Coverage_68': np.mean(np.abs(z_errors) <= 1, axis=1),
+        'Coverage_95': np.mean(np.abs(z_errors) <= 1.96, axis=1),
+        'Z_Std': np.std(z_errors, axis=1, ddof=1),
+    })
+
+def evaluate_parameters(inputs: SweepInputs, parameters: pd.DataFrame) -> pd.DataFrame:
+    """
+    Backtest each candidate and rank them by SWEEP_LOSS.
+
+    The scores are of the chase ZScore_log, so they don't depend on the time conversion. Finishers
+    whose score is unknown are left out.
+
+    Args:
+        inputs (SweepInputs): The inputs of the predictions.
+        parameters (pd.DataFrame): A candidate per row, with a column for each of PARAMETERS.
+
+    Returns:
+        pd.DataFrame: The PARAMETERS and SWEEP_METRICS of each candidate, best first.
+    """
+    known = ~np.isnan(inputs.actual)
+    scores = []
+    for include, block in _blocks(inputs, parameters):
+        posterior_mu, posterior_sigma = _block_posteriors(inputs, include, block)
+        block_scores = score_posteriors(posterior_mu[:, known], posterior_sigma[:, known], inputs.actual[known])
+        scores.append(block_scores.set_axis(block.index))
+    evaluated = pd.concat([parameters[PARAMETERS], pd.concat(scores)], axis=1)
+    return evaluated.sort_values(SWEEP_LOSS, kind='stable').reset_index(drop=True)
+
+def run_sweep(parameters: pd.DataFrame = None, years: List[int] = None, workers: int = 1, path: Path = DB_PATH, cache_dir: Path = BACKTEST_CACHE_PATH) -> pd.DataFrame:
+    """
+    Rank prediction parameters by how well they would have predicted past chases.
+
+    Args:
+        parameters (pd.DataFrame): The candidates, see parameter_grid and random_parameters. Defaults to parameter_grid().
+        years (List[int]): The chase years to replay. Defaults to every chase in the database.
+        workers (int): Number of processes to gather the years on. Defaults to 1, no pool.
+        path (Path): The database file.
+        cache_dir (Path): Where each year's models are cached, None to always train them.
+
+    Returns:
+        pd.DataFrame: The candidates ranked by evaluate_parameters.
+    """
+    if parameters is None:
+        parameters = parameter_grid()
+    inputs = get_sweep_inputs(years, workers, path, cache_dir)
+    logger.info(f'Evaluating {len(parameters)} candidates on {len(inputs.finishers)} finishers and {len(inputs.mu)} results')
+    return evaluate_parameters(inputs, parameters)
@@ -1,15 +1,93 @@
+import json
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Tuple
+
 import numpy as np
 import pandas as pd
-from fellpace.analysis_tools import convert_Chase_ZScore_logs
-from fellpace.db.db_setup import setup_db
-from fellpace.config import DB_PATH, COEFFS_FILE_PATH, COVAR_FILE_PATH
+from fellpace.analysis_tools import get_chase_log_stats
+from fellpace.modelling.prediction import stack_model_arrays, get_race_indices
+from fellpace.db.session import FellPaceDB
+from fellpace.config import DB_PATH, COEFFS_FILE_PATH, COVAR_FILE_PATH, MODEL_FILE_PATH
+from loguru import logger
+
+# Bump when the layout of the model file changes, load_model_file refuses files from newer versions
+MODEL_FORMAT_VERSION = 1
+
+@dataclass(frozen=True)
+class ModelFile:
+    """The trained race models as arrays, the contents of MODEL_FILE_PATH.
+
+    Args:
+        races (np.ndarray): The race names, in the order of the other arrays.
+        coeffs (np.ndarray): (races, degree + 1) coefficients, highest power first as np.polyfit.
+        covars (np.ndarray): (races, degree + 1, degree + 1) covariance of the coefficients.
+        metadata (dict): Details of the training, when it was run and on what.
+    """
+    races: np.ndarray
+    coeffs: np.ndarray
+    covars: np.ndarray
+    metadata: dict
+
+    def to_series(self) -> Tuple[pd.Series, pd.Series]:
+        """The coeffs and covar series train_models returns, each value a view of the arrays."""
+        index = pd.Index(self.races)
+        return (
+            pd.Series(list(self.coeffs), index=index, dtype=object),
+            pd.Series(list(self.covars), index=index, dtype=object),
+        )
+
+def save_model_file(coeffs: pd.Series, covar: pd.Series, metadata: dict = None, path: Path = MODEL_FILE_PATH) -> None:
+    """Save the race models as a single uncompressed npz file, see ModelFile."""
+    races, coeff_array, cov_array = stack_model_arrays(coeffs, covar)
+    metadata = {'format_version': MODEL_FORMAT_VERSION, 'saved': datetime.now().isoformat(timespec='seconds'), **(metadata or {})}
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Strings are saved as unicode arrays so the file loads without pickle
+    np.savez(
+        path,
+        races=np.array(races, dtype=str),
+        coeffs=coeff_array,
+        covars=cov_array,
+        metadata=np.array(json.dumps(metadata, default=str)),
+    )
+    _model_files.pop(str(path), None)
+
+# Model files loaded in this process by path, with the modified time they were loaded at
+_model_files = {}
+
+def load_model_file(path: Path = MODEL_FILE_PATH) -> ModelFile:
+    """Load a model file, once per process unless the file changes. The arrays are shared, so read only.
+
+    Raises:
+        RuntimeError: If the file was written by a newer version of fellpace.
+    """
+    path = Path(path)
+    modified = path.stat().st_mtime_ns
+    cached = _model_files.get(str(path))
+    if cached is None or cached[0] != modified:
+        with np.load(path) as arrays:
+            metadata = json.loads(arrays['metadata'].item())
+            if metadata['format_version'] > MODEL_FORMAT_VERSION:
+                raise RuntimeError(f'Model file format version {metadata["format_version"]} is newer than this version of fellpace supports ({MODEL_FORMAT_VERSION})')
+            model_file = ModelFile(arrays['races'], arrays['coeffs'], arrays['covars'], metadata)
+        for array in (model_file.races, model_file.coeffs, model_file.covars):
+            array.setflags(write=False)
+        _model_files[str(path)] = (modified, model_file)
+    return _model_files[str(path)][1]
 
 def load_models():
+    if MODEL_FILE_PATH.exists():
+        return load_model_file(MODEL_FILE_PATH).to_series()
+    # Models trained before the model file, read every time as they are only a fallback
     if COEFFS_FILE_PATH.exists() and COVAR_FILE_PATH.exists():
         coeffs = pd.read_json(COEFFS_FILE_PATH, orient='index', typ='series')
         covar = pd.read_json(COVAR_FILE_PATH, orient='index', typ='series')
     else:
         print("No model files found. Please train the models first.")
+        raise FileNotFoundError(MODEL_FILE_PATH)
     return coeffs, covar
         
 
@@ -22,25 +100,180 @@ def train_models(data_Zs, use_inliers=True):
     covar = fit_results.apply(lambda c: c[1])
     return coeffs, covar
 
-def get_rmse_in_seconds(data_Zs: pd.DataFrame, coeffs, evaluate_inliers_only = True):
-    if evaluate_inliers_only:
+# Everything a straight line fit of HCScore (y) against ZScore (x) needs, see get_sufficient_stats
+SUFFICIENT_STATS = ['N', 'Sum_X', 'Sum_Y', 'Sum_XX', 'Sum_XY', 'Sum_YY']
+MODEL_COLUMNS = ['Residual_SS', 'Slope', 'Intercept', 'Var_Slope', 'Var_Intercept', 'Covar']
+
+def get_sufficient_stats(data_Zs: pd.DataFrame, use_inliers=True) -> pd.DataFrame:
+    """Sum the statistics a straight line fit needs for each race, in one pass over the data.
+
+    Args:
+        data_Zs (pd.DataFrame): Race_Name, ZScore and HCScore of every racer (and inlier if use_inliers).
+        use_inliers (bool): Only use the inliers found by add_inliers, as train_models does.
+
+    Returns:
+        pd.DataFrame: SUFFICIENT_STATS indexed by Race_Name.
+    """
+    if use_inliers:
         data_Zs = data_Zs.loc[data_Zs['inlier'] == True]
-    data_Zs.set_index(['Race_Name','Season', 'Racer_ID'], inplace=True)
-    data_Zs['predicted_Z'] = (
-        data_Zs.groupby(['Race_Name','Season', 'Racer_ID'], sort=False)
-        .apply(
-            lambda x: 
-                np.polyval(coeffs[x.name[0]], x['ZScore'])[0])
-        )
-    con = setup_db(DB_PATH)
+    x = data_Zs['ZScore'].to_numpy(dtype=float)
+    y = data_Zs['HCScore'].to_numpy(dtype=float)
+    terms = pd.DataFrame({
+        'N': 1, 'Sum_X': x, 'Sum_Y': y, 'Sum_XX': x * x, 'Sum_XY': x * y, 'Sum_YY': y * y,
+    }, index=data_Zs.index)
+    return terms.groupby(data_Zs['Race_Name'], sort=True).sum()
 
-    predicted_times = (data_Zs.groupby(['Race_Name','Season'], sort=False, group_keys=False)
-    .apply(
-        lambda x: convert_Chase_ZScore_logs(con, x['predicted_Z'], year = x.name[1] + 1)
-        )
-        
+def fit_from_stats(stats: pd.DataFrame) -> pd.DataFrame:
+    """Fit each race's line from its sufficient statistics.
+
+    Matches np.polyfit(x, y, 1, cov=True), the covariance is the inverse of the normal equations
+    scaled by the residual sum of squares over N - 2.
+
+    Args:
+        stats (pd.DataFrame): SUFFICIENT_STATS for each race, see get_sufficient_stats.
+
+    Returns:
+        pd.DataFrame: MODEL_COLUMNS for each race.
+    """
+    n = stats['N'].to_numpy(dtype=float)
+    Sx, Sy = stats['Sum_X'].to_numpy(), stats['Sum_Y'].to_numpy()
+    Sxx, Sxy, Syy = stats['Sum_XX'].to_numpy(), stats['Sum_XY'].to_numpy(), stats['Sum_YY'].to_numpy()
+    # Centre the sums, the determinant of the normal equations is n * Sxx_c
+    Sxx_c = Sxx - Sx * Sx / n
+    Sxy_c = Sxy - Sx * Sy / n
+    Syy_c = Syy - Sy * Sy / n
+    slope = Sxy_c / Sxx_c
+    intercept = (Sy - slope * Sx) / n
+    residual_SS = np.maximum(Syy_c - slope * Sxy_c, 0)
+    scale = residual_SS / (n - 2) / (n * Sxx_c)
+    return pd.DataFrame({
+        'Residual_SS': residual_SS,
+        'Slope': slope,
+        'Intercept': intercept,
+        'Var_Slope': n * scale,
+        'Var_Intercept': Sxx * scale,
+        'Covar': -Sx * scale,
+    }, index=stats.index)
+
+def models_to_series(models: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
+    """Convert a table of models to the coeffs and covar series train_models returns."""
+    coeffs = pd.Series(list(models[['Slope', 'Intercept']].to_numpy()), index=models.index, dtype=object)
+    covar = pd.Series(
+        list(models[['Var_Slope', 'Covar', 'Covar', 'Var_Intercept']].to_numpy().reshape(-1, 2, 2)),
+        index=models.index, dtype=object,
     )
-    
-    data_Zs['residuals'] = predicted_times - data_Zs['HCTime']
-    RMSE = data_Zs.groupby('Race_Name').apply(lambda x: np.sqrt(np.mean(x['residuals']**2)))
-    return RMSE
\ No newline at end of file
+    return coeffs, covar
+
+def load_race_models(con: sqlite3.Connection) -> pd.DataFrame:
+    """The stored statistics and fit of each race's model, indexed by Race_Name."""
+    return pd.read_sql("SELECT * FROM Race_Models", con, index_col='Race_Name')
+
+def train_models_incremental(con: sqlite3.Connection, data_Zs: pd.DataFrame, use_inliers=True) -> Tuple[pd.Series, pd.Series]:
+    """Train the race models, refitting only the races whose data has changed since the last training.
+
+    The sufficient statistics of each race are compared with those stored in Race_Models, races that
+    are new or have changed are refitted from their statistics, races no longer in the data are
+    removed. The same statistics always give the same fit so nothing else needs refitting. The models
+    aren't evaluated here, evaluate_models is cheap enough to run on every race.
+
+    Args:
+        con (sqlite3.Connection): Connection to the fellpace database.
+        data_Zs (pd.DataFrame): Output of extract_all_zscore_data with the inlier column added.
+        use_inliers (bool): Fit the inliers only.
+
+    Returns:
+        Tuple[pd.Series, pd.Series]: The coeffs and covar of every race.
+    """
+    stats = get_sufficient_stats(data_Zs, use_inliers)
+    stored = load_race_models(con)
+    previous = stored.reindex(stats.index)[SUFFICIENT_STATS]
+    unchanged = np.isclose(stats.to_numpy(dtype=float), previous.to_numpy(dtype=float), rtol=1e-12, atol=0).all(axis=1)
+    changed = stats.index[~unchanged]
+    removed = stored.index.difference(stats.index)
+
+    if len(changed) or len(removed):
+        models = stats.loc[changed].join(fit_from_stats(stats.loc[changed]))
+        columns = SUFFICIENT_STATS + MODEL_COLUMNS
+        con.executemany(
+            "DELETE FROM Race_Models WHERE Race_Name = ?", [(race_name,) for race_name in removed]
+        )
+        con.executemany(
+            f"INSERT OR REPLACE INTO Race_Models (Race_Name, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+            models[columns].astype(object).where(models[columns].notna(), None).itertuples(name=None),
+        )
+        con.commit()
+        stored = load_race_models(con)
+    logger.info(f'Trained {len(changed)} of {len(stats)} race models, removed {len(removed)}')
+
+    return models_to_series(stored)
+
+# Residuals are predicted minus actual chase times, so a positive Bias is a model predicting too slow
+EVALUATION_METRICS = ['N', 'RMSE', 'MAE', 'Bias']
+
+def get_residuals_in_seconds(con: sqlite3.Connection, data_Zs: pd.DataFrame, coeffs, evaluate_inliers_only=True) -> pd.DataFrame:
+    """Predict every racer's chase time from their race score and compare it with their actual time.
+
+    The model of each row is looked up from the stacked coefficients and the stats of the chase that
+    followed the season are joined by year, so every prediction is made in one array operation.
+
+    Args:
+        con (sqlite3.Connection): Connection to the fellpace database, for the chase stats.
+        data_Zs (pd.DataFrame): Output of extract_all_zscore_data (with the inlier column if evaluate_inliers_only).
+        coeffs: Coefficients for each race, indexed by race name.
+        evaluate_inliers_only (bool): Only evaluate the inliers found by add_inliers.
+
+    Returns:
+        pd.DataFrame: Race_Name, Season, Racer_ID, predicted_Z, Predicted_Time and Residual of each row.
+    """
+    if evaluate_inliers_only:
+        data_Zs = data_Zs.loc[data_Zs['inlier'] == True]
+    races, coeff_array, _ = stack_model_arrays(coeffs)
+    race_idx = get_race_indices(races, data_Zs['Race_Name'])
+    x_vectors = np.vander(data_Zs['ZScore'].to_numpy(dtype=float), coeff_array.shape[1])
+    predicted_Z = np.einsum('ij,ij->i', x_vectors, coeff_array[race_idx])
+
+    # A season's scores are compared with the chase at the end of it, in the following year
+    chase_stats = get_chase_log_stats(con).yearly.reindex(data_Zs['Season'].to_numpy() + 1)
+    predicted_times = np.exp(chase_stats['mn'].to_numpy() + chase_stats['sd'].to_numpy() * predicted_Z)
+    return pd.DataFrame({
+        'Race_Name': data_Zs['Race_Name'],
+        'Season': data_Zs['Season'],
+        'Racer_ID': data_Zs['Racer_ID'],
+        'predicted_Z': predicted_Z,
+        'Predicted_Time': predicted_times,
+        'Residual': predicted_times - data_Zs['HCTime'].to_numpy(dtype=float),
+    }, index=data_Zs.index)
+
+def summarise_residuals(residuals: pd.DataFrame, by='Race_Name') -> pd.DataFrame:
+    """EVALUATION_METRICS of the residuals grouped by a column (or list of columns), missing residuals are left out."""
+    residual = residuals['Residual']
+    terms = pd.DataFrame({
+        'N': residual.notna(),
+        'Squared': residual ** 2,
+        'Absolute': residual.abs(),
+        'Bias': residual,
+    })
+    grouped = terms.groupby([residuals[column] for column in np.atleast_1d(by)])
+    means = grouped[['Squared', 'Absolute', 'Bias']].mean()
+    return pd.DataFrame({
+        'N': grouped['N'].sum(),
+        'RMSE': np.sqrt(means['Squared']),
+        'MAE': means['Absolute'],
+        'Bias': means['Bias'],
+    })
+
+def evaluate_models(con: sqlite3.Connection, data_Zs: pd.DataFrame, coeffs, evaluate_inliers_only=True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Evaluate the race models against the chase times they predict.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The EVALUATION_METRICS of each race and of each season.
+    """
+    residuals = get_residuals_in_seconds(con, data_Zs, coeffs, evaluate_inliers_only)
+    return summarise_residuals(residuals, 'Race_Name'), summarise_residuals(residuals, 'Season')
+
+def get_rmse_in_seconds(data_Zs: pd.DataFrame, coeffs, evaluate_inliers_only = True, con: sqlite3.Connection = None):
+    if con is None:
+        with FellPaceDB(DB_PATH) as db:
+            return get_rmse_in_seconds(data_Zs, coeffs, evaluate_inliers_only, db.con)
+    residuals = get_residuals_in_seconds(con, data_Zs, coeffs, evaluate_inliers_only)
+    return summarise_residuals(residuals, 'Race_Name')['RMSE']
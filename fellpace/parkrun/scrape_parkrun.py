@@ -1,7 +1,15 @@
 import fellpace.FellPace_tools as FellPace_tools
 import sqlite3
+import threading
 import toml
-from typing import Literal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Literal, Tuple
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import fellpace.convert_tools as convert_tools
 from fellpace.parkrun.settings import PRSettings
 from re import search
@@ -21,44 +29,164 @@ headers = {
 "Sec-Fetch-Site": "same-origin",
 "Sec-Fetch-User": "?1"}
 parkrun: Literal['hillsborough','endcliffe'] = 'endcliffe'
-parkrun_climbs = {'hillsborough':53,'endcliffe':47}
-
-def scrape_parkruns(settings: PRSettings, con: sqlite3.Connection):
-    
-    for parkrun, these_settings in settings.__dict__.items():
-        continue_scrape = True
-        PR_id = these_settings.start_ID
-        while continue_scrape:
-            URL = f'https://www.parkrun.org.uk/{parkrun}/results/{PR_id}/'
-            try:
-                table, resp_text = FellPace_tools.get_table_from_URL(URL, headers=headers)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
-                continue_scrape = False
-                these_settings.start_ID = PR_id
-                print(f'No more parkruns found for {parkrun} at ID {PR_id}')
-                with open('settings.toml', 'w') as f:
-                    f.write(toml.dumps(settings.model_dump()))
-                continue
-            #Going to use regular expressions to get date rather than beautiful soup as only need to do once
-            matches = search("(?<=class=\"format-date\">)[0-9/]+",resp_text)
-            if not matches:
-                date = ""
-            else:
-                date = matches.group()
-                (day,month,year) = date.split("/")
-                date = "-".join((year,month,day))
-            #Create the race metadata for the entry
-            this_parkrun = FellPace_tools.race_meta()
-            this_parkrun.race_distance = 5000
-            this_parkrun.race_climb = parkrun_climbs[parkrun]
-            this_parkrun.race_date = date
-            this_parkrun.race_name = f"Parkrun_{parkrun}_{PR_id}" #Parkrun name has the ID appended to the back so can easily parse in future if want to update
-            print(f'adding {this_parkrun.race_name}')
-            ParkRun = convert_tools.ParkRunConverter(table)
-            FellPace_tools.append_to_DB(con,ParkRun.entries.data,this_parkrun,check=False)
-            PR_id += 1
-            time.sleep(2)
+
+PARKRUN_URL = 'https://www.parkrun.org.uk/{parkrun}/results/{PR_id}/'
+
+
+class TokenBucket:
+    """Rate limiter shared between threads, allows bursts of up to capacity requests then rate per second.
+
+    Args:
+        rate (float): Requests allowed per second on average.
+        capacity (float): The largest burst of requests allowed.
+    """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait until a request is allowed."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class EventNotFound(Exception):
+    """There's no results table for a parkrun event, usually because it hasn't happened yet."""
+
+
+def make_session(pool_size: int = 4) -> requests.Session:
+    """A session re-using connections to the parkrun site, retrying dropped connections and server errors."""
+    session = requests.Session()
+    session.headers.update(headers)
+    retries = Retry(total=3, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_parkrun(session: requests.Session, bucket: TokenBucket, parkrun: str, PR_id: int, climb: int,
+                  category_aliases: convert_tools.CategoryAliases = None) -> Tuple[FellPace_tools.race_meta, pd.DataFrame]:
+    """Fetch and parse the results of a parkrun event.
+
+    Raises:
+        EventNotFound: If the event has no results page or table.
+
+    Returns:
+        Tuple[race_meta, pd.DataFrame]: The race metadata and entries ready for append_many_to_DB.
+    """
+    URL = PARKRUN_URL.format(parkrun=parkrun, PR_id=PR_id)
+    bucket.acquire()
+    response = session.get(URL, timeout=30)
+    if response.status_code == 404:
+        raise EventNotFound(URL)
+    response.raise_for_status()
+    try:
+        tables = pd.read_html(StringIO(response.text))
+    except ValueError as e: # No tables on the page
+        raise EventNotFound(URL) from e
+    if len(tables) != 1:
+        raise EventNotFound(f'{URL} has {len(tables)} tables, expected 1')
+
+    #Going to use regular expressions to get date rather than beautiful soup as only need to do once
+    matches = search("(?<=class=\"format-date\">)[0-9/]+",response.text)
+    if not matches:
+        date = ""
+    else:
+        date = matches.group()
+        (day,month,year) = date.split("/")
+        date = "-".join((year,month,day))
+    #Create the race metadata for the entry
+    this_parkrun = FellPace_tools.race_meta()
+    this_parkrun.race_distance = 5000
+    this_parkrun.race_climb = climb
+    this_parkrun.race_date = date
+    this_parkrun.race_name = f"Parkrun_{parkrun}_{PR_id}" #Parkrun name has the ID appended to the back so can easily parse in future if want to update
+    ParkRun = convert_tools.ParkRunConverter(tables[0], category_aliases)
+    return this_parkrun, ParkRun.entries.data
+
+def save_settings(settings: PRSettings, settings_path: str = 'settings.toml') -> None:
+    with open(settings_path, 'w') as f:
+        f.write(toml.dumps(settings.model_dump()))
+
+def scrape_parkruns(
+    settings: PRSettings,
+    con: sqlite3.Connection,
+    batch_size: int = 10,
+    workers: int = 4,
+    requests_per_second: float = 0.5,
+    settings_path: str = 'settings.toml'
+):
+    """Scrape new events for every parkrun location in settings, starting from their start_ID.
+
+    Events are fetched and parsed on a pool of threads, all locations at once, through one session and
+    rate limiter for the parkrun site. Each location's events are written to the database in order, in
+    batches of one transaction, and its start_ID is saved to settings_path after every batch so an interrupted scrape
+    carries on from the last event written.
+
+    Args:
+        settings (PRSettings): The parkrun locations and the ID of the next event of each to scrape.
+        con (sqlite3.Connection): A connection to the fellpace database.
+        batch_size (int): Events written between checkpoints.
+        workers (int): Events fetched at once.
+        requests_per_second (float): Limit on the rate of requests to the parkrun site.
+        settings_path (str): Where to save the updated settings.
+    """
+    category_aliases = convert_tools.load_category_aliases(con)
+    session = make_session(workers)
+    bucket = TokenBucket(requests_per_second)
+    locations = dict(settings.__dict__)
+    pending = {parkrun: deque() for parkrun in locations} # (PR_id, future) in ID order
+    next_ids = {parkrun: these_settings.start_ID for parkrun, these_settings in locations.items()}
+    batches = {parkrun: [] for parkrun in locations}
+
+    def write_batch(parkrun: str) -> None:
+        batch = batches[parkrun]
+        if not batch:
+            return
+        FellPace_tools.append_many_to_DB(con, [(this_parkrun, entries) for _, this_parkrun, entries in batch])
+        locations[parkrun].start_ID = batch[-1][0] + 1
+        save_settings(settings, settings_path)
+        batch.clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while any(queue is not None for queue in pending.values()):
+                for parkrun, these_settings in locations.items():
+                    if pending[parkrun] is None:
+                        continue
+                    # Keep each location's window of events in flight full
+                    while len(pending[parkrun]) < workers:
+                        PR_id = next_ids[parkrun]
+                        future = pool.submit(fetch_parkrun, session, bucket, parkrun, PR_id, these_settings.climb, category_aliases)
+                        pending[parkrun].append((PR_id, future))
+                        next_ids[parkrun] += 1
+                    PR_id, future = pending[parkrun].popleft()
+                    try:
+                        this_parkrun, entries = future.result()
+                    except EventNotFound:
+                        print(f'No more parkruns found for {parkrun} at ID {PR_id}')
+                        for _, later_future in pending[parkrun]:
+                            later_future.cancel()
+                        pending[parkrun] = None
+                        write_batch(parkrun)
+                        continue
+                    batches[parkrun].append((PR_id, this_parkrun, entries))
+                    if len(batches[parkrun]) >= batch_size:
+                        write_batch(parkrun)
+        finally:
+            # Events after the last checkpoint are fetched again next time
+            for queue in pending.values():
+                for _, future in queue or ():
+                    future.cancel()
 
 if __name__ == "__main__":
     from fellpace.config import DB_PATH
@@ -67,4 +195,4 @@ if __name__ == "__main__":
     con = setup_db(DB_PATH)
     settings = PRSettings.load_toml_settings('settings.toml')
     scrape_parkruns(settings,con)
-    con.close()
\ No newline at end of file
+    con.close()
@@ -1,4 +1,4 @@
-from fellpace.modelling.prediction import get_probability_distribution
+from fellpace.modelling.prediction import get_probability_distribution, get_probability_distributions, get_distribution_grid
 from fellpace.analysis_tools import convert_Chase_ZScore_logs_avg
 from fellpace.convert_tools import seconds_to_time_string
 from matplotlib import pyplot as plt
@@ -32,10 +32,13 @@ def plot_racers_results(racer_results: pd.DataFrame, con: sqlite3.Connection, li
     Plot all racer results as normal distributions.
     Optionally save the plot to a file if save_path is provided.
     """
-    for _, result in racer_results.iterrows():
-        season = result['Season']
-        race = result['Race_Name']
-        plot_time_normal(con, result['Zpred_mu'], result['Zpred_sig'], f'{race}: {season}', ax, alpha = 1/(1+2024-season), linestyle=linestyle)
+    if racer_results.empty:
+        return
+    # Work out every distribution, and the times they're plotted against, in one go
+    distributions = get_probability_distributions(racer_results['Zpred_mu'], racer_results['Zpred_sig'])
+    times = convert_Chase_ZScore_logs_avg(con, get_distribution_grid())
+    for p, season, race in zip(distributions, racer_results['Season'], racer_results['Race_Name']):
+        ax.plot(times, p, label=f'{race}: {season}', alpha = 1/(1+2024-season), linestyle=linestyle)
 
         
         
@@ -15,7 +15,8 @@ def process_chase_csv(file: str, date: str, con):
     # Actual Correct: Actual Time
     # Finish: Position -- This is the position after Handicap has been applied
 
-    Categories = convert_tools.convert_categories(data['Class'].values)
+    category_aliases = convert_tools.load_category_aliases(con)
+    Categories = convert_tools.convert_categories(data['Class'].values, category_aliases)
     HTime = convert_tools.time_string_to_seconds(data['Time Correct'].values)
     ATime = convert_tools.time_string_to_seconds(data['Actual Correct'].values)
     Handicap = HTime - ATime
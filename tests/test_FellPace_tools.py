@@ -0,0 +1,54 @@
+import pandas as pd
+import fellpace.FellPace_tools as FellPace_tools
+from fellpace.db.db_setup import setup_db
+
+def make_race(name: str, date: str, racers: list) -> tuple:
+    meta = FellPace_tools.race_meta()
+    meta.race_name, meta.race_date, meta.race_distance, meta.race_climb = name, date, 5000, 50
+    entries = FellPace_tools.race_entries(len(racers))
+    entries.data = pd.DataFrame({
+        'Racer_Name': [racer for racer, _ in racers],
+        'Club': 'Totley AC',
+        'Time': [time for _, time in racers],
+        'Position': range(1, len(racers) + 1),
+        'Cat_Name': 'MV40',
+    })
+    return meta, entries
+
+def test_append_many_matches_append_to_DB(tmp_path):
+    races = [
+        make_race('Tigger Tor', '2023-09-10', [('Nick Hamilton', 3000), ('Pat Goodall', 3300), ('Jo Smith', 4000)]),
+        make_race('Lantern Pike', '2024-01-14', [('Pat Goodall', 2500), ('Al Brown', 2600), ('Nick Hamilton', 2700)]),
+    ]
+    tables = []
+    for name, add in [('one', None), ('many', FellPace_tools.append_many_to_DB)]:
+        con = setup_db(tmp_path / f'{name}.db')
+        con.execute("INSERT INTO Categories (Cat_Name) VALUES ('MV40')")
+        con.executemany("INSERT INTO Race_Series (Series_Name) VALUES (?)", [('Tigger Tor',), ('Lantern Pike',)])
+        con.commit()
+        if add is None:
+            for meta, entries in races:
+                FellPace_tools.append_to_DB(con, entries.data, meta, check=False)
+        else:
+            assert add(con, races) == [1, 2]
+            # Races already in the database are skipped
+            assert add(con, races[:1]) == []
+        tables.append([
+            pd.read_sql(f'SELECT * FROM {table}', con)
+            for table in ('Racers', 'Races', 'Results', 'Racer_Season_Scores')
+        ])
+        con.close()
+    for one, many in zip(*tables):
+        pd.testing.assert_frame_equal(one, many)
+
+def test_racer_ID_map_per_in_memory_database():
+    def racer_IDs(racers):
+        con = setup_db(':memory:')
+        con.executemany("INSERT INTO Racers (Racer_Name) VALUES (?)", [(racer,) for racer in racers])
+        con.commit()
+        ids = dict(FellPace_tools.get_racer_ID_map(con).ids)
+        con.close()
+        return ids
+    # Each connection is freed before the next is opened, so they can share an id(con)
+    for racers in [('Nick Hamilton', 'Pat Goodall'), ('Jo Smith', 'Al Brown')] * 3:
+        assert racer_IDs(racers) == {racers[0]: 1, racers[1]: 2}
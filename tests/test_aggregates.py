@@ -0,0 +1,29 @@
+import sqlite3
+import numpy as np
+from fellpace.db.aggregates import XPercentile, std_dev, mean_std_sql
+
+def test_xpercentile_matches_sorted_index():
+    rng = np.random.default_rng(0)
+    for n in (1, 2, 3, 7, 50):
+        values = rng.normal(size=n).tolist()
+        aggregate = XPercentile()
+        for value in values:
+            aggregate.step(value)
+        assert aggregate.finalize() == sorted(values)[round(0.2 * n) - 1]
+
+def test_std_dev_and_mean_std_sql():
+    rng = np.random.default_rng(1)
+    values = np.log(rng.integers(900, 9000, 500))
+    con = sqlite3.connect(':memory:')
+    con.create_aggregate('stddev', 1, std_dev)
+    con.execute('CREATE TABLE T (Grp INTEGER, Value REAL)')
+    con.executemany('INSERT INTO T VALUES (?, ?)', [(i % 3, float(v)) for i, v in enumerate(values)])
+    con.execute('INSERT INTO T VALUES (0, NULL)')
+
+    assert np.isclose(con.execute('SELECT stddev(Value) FROM T').fetchone()[0], np.std(values))
+    mean, sd = con.execute(mean_std_sql('T', 'Value')).fetchone()
+    assert np.isclose(mean, np.mean(values))
+    assert np.isclose(sd, np.std(values))
+    for grp, mean, sd in con.execute(mean_std_sql('T', 'Value', 'Grp')).fetchall():
+        assert np.isclose(mean, np.mean(values[grp::3]))
+        assert np.isclose(sd, np.std(values[grp::3]))
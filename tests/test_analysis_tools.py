@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import zscore, percentileofscore
+from fellpace.db.db_setup import setup_db
+from fellpace.analysis_tools import (
+    convert_Chase_ZScore_logs, convert_Chase_ZScore_logs_avg, clear_chase_log_stats_cache, get_chase_log_stats,
+    calculate_position_stats, calculate_position_stats_grouped,
+)
+
+def test_chase_log_stats_cache(tmp_path):
+    con = setup_db(tmp_path / 'fellpace.db')
+    con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (1, '2023-05-20')")
+    times = np.array([3000, 3300, 3600, 4200])
+    con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (1, ?)", [(int(t),) for t in times])
+    con.commit()
+
+    Zscore_logs = pd.Series([-1.0, 0.0, 1.5])
+    expected = np.exp(np.log(times).mean() + np.log(times).std() * Zscore_logs)
+    assert np.allclose(convert_Chase_ZScore_logs(con, Zscore_logs, 2023), expected)
+    assert np.allclose(convert_Chase_ZScore_logs_avg(con, 0.0)[0], expected[1])
+
+    # A new chase isn't seen until the cache is cleared
+    con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (2, '2024-05-18')")
+    con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (2, ?)", [(int(t),) for t in times * 2])
+    con.commit()
+    assert len(convert_Chase_ZScore_logs(con, 0.0, 2024)) == 0
+    clear_chase_log_stats_cache(con)
+    assert np.allclose(convert_Chase_ZScore_logs(con, 0.0, 2024), 2 * expected[1])
+
+def test_chase_log_stats_per_in_memory_database():
+    def chase_years(year):
+        con = setup_db(':memory:')
+        con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (1, ?)", (f'{year}-05-20',))
+        con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (1, ?)", [(3000,), (3600,)])
+        con.commit()
+        years = list(get_chase_log_stats(con).by_year)
+        con.close()
+        return years
+    # Each connection is freed before the next is opened, so they can share an id(con)
+    for year in range(2015, 2021):
+        assert chase_years(year) == [year]
+
+def test_position_stats_match_scipy():
+    rng = np.random.default_rng(0)
+    times = rng.integers(1000, 1100, 500).astype(float) # plenty of ties
+    times[::50] = np.nan
+    zscores, zscores_log, percentiles = calculate_position_stats(pd.array(times, dtype='Int64'))
+    valid = ~np.isnan(times)
+    assert np.allclose(zscores[valid], zscore(times[valid]))
+    assert np.allclose(zscores_log[valid], zscore(np.log(times[valid])))
+    assert np.allclose(percentiles[valid], percentileofscore(times[valid], times[valid]))
+    assert np.isnan(zscores[~valid]).all() and np.isnan(percentiles[~valid]).all()
+
+    data = pd.DataFrame({'Race_ID': rng.integers(1, 4, 500), 'Time': times}).sample(frac=1, random_state=1)
+    stats = calculate_position_stats_grouped(data)
+    for _, race in data.groupby('Race_ID'):
+        expected = calculate_position_stats(race['Time'].values)
+        for column, values in zip(['ZScore', 'ZScore_log', 'Percentile'], expected):
+            assert np.allclose(stats.loc[race.index, column], values, equal_nan=True)
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import fellpace.modelling.backtest as backtest
+from fellpace.analysis_tools import calculate_position_stats
+from fellpace.db.db_setup import setup_db
+from test_entries import make_database
+
+def add_chase(path, chase_ID: int, chase_date: str, racer_ids, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    times = rng.normal(3500, 300, len(racer_ids)).astype(int)
+    _, zscores_log, _ = calculate_position_stats(times)
+    con = setup_db(path)
+    con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (?, ?)", (chase_ID, chase_date))
+    con.executemany(
+        "INSERT INTO Results_Chase (Chase_ID, Racer_ID, Time, ZScore_log) VALUES (?, ?, ?, ?)",
+        [(chase_ID, int(racer_ID), int(t), float(z)) for racer_ID, t, z in zip(racer_ids, times, zscores_log)],
+    )
+    con.commit()
+    con.close()
+
+def test_backtest(tmp_path, monkeypatch):
+    path = tmp_path / 'fellpace.db'
+    make_database(path)
+    add_chase(path, 2, '2024-05-18', range(1, 31))
+
+    trained = []
+    train_year_models = backtest.train_year_models
+    monkeypatch.setattr(backtest, 'train_year_models', lambda training_Zs: trained.append(len(training_Zs)) or train_year_models(training_Zs))
+    cache_dir = tmp_path / 'backtest'
+    predictions, summary = backtest.run_backtest(path=path, cache_dir=cache_dir)
+    # Nothing was known before the first chase, the 2024 chase is predicted from 2022 season scores only
+    assert predictions['Year'].unique().tolist() == [2024]
+    assert len(trained) == 1 and trained[0] > 0
+    assert len(predictions) == 30 and predictions['chase_sig'].gt(0).all()
+    assert list(summary.index) == [2024, 'All'] and list(summary.columns) == backtest.BACKTEST_METRICS
+    assert summary.loc['All', 'N'] == 30
+    assert 0 <= summary.loc['All', 'Coverage_68'] <= summary.loc['All', 'Coverage_95'] <= 1
+
+    # The year's models come from the cache the second time
+    cached_predictions, _ = backtest.run_backtest([2024], path=path, cache_dir=cache_dir)
+    assert len(trained) == 1
+    pd.testing.assert_frame_equal(cached_predictions, predictions)
+    pooled_predictions, _ = backtest.run_backtest([2023, 2024], workers=2, path=path, cache_dir=None)
+    pd.testing.assert_frame_equal(pooled_predictions, predictions)
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import toml
+import fellpace.FellPace_tools as FellPace_tools
+from fellpace.analysis_tools import calculate_position_stats
+from fellpace.column_profiles import get_profile, apply_profile, append_csv_directory, append_csv_streaming
+from fellpace.db.db_setup import setup_db
+
+def test_profiles_and_detection():
+    racetek = pd.DataFrame({
+        'No.': [12, 7], 'First Name': ['nick', 'pat'], 'Surname': ['hamilton', 'goodall'], 'Gender': ['M', 'F'],
+        'Age Cat': ['V40', 'Sen'], 'Course': ['', ''], 'Club': ['Totley', 'DPFR'], 'Time': ['45:10', '1:02:03'], '': [None, None],
+        'Position': [0, 1],
+    })
+    name, profile = get_profile(racetek, profiles=None)
+    assert name == 'racetek'
+    entries = apply_profile(racetek, profile).data
+    assert entries['Racer_Name'].tolist() == ['Nick Hamilton', 'Pat Goodall']
+    assert entries['Cat_Name'].tolist() == ['M40', 'FSENIOR']
+    assert entries['Time'].tolist() == [2710, 3723]
+
+    layout = pd.DataFrame({
+        'Pl': [1, 2, 3], 'Bib': [301, 7, 45], 'Runner': ['Nick Hamilton', 'Pat Goodall', "Jo O'Neil"],
+        'Club/Team': ['Totley', None, 'DPFR'], 'Finish': ['00:45:10', '00:50:02', '01:02:03'],
+    })
+    name, profile = get_profile(layout, profiles={})
+    assert name == 'detected'
+    assert profile == {'Racer_Name': ['Runner'], 'Club': ['Club/Team'], 'Time': ['Finish'], 'Position': ['Pl']}
+
+    assert get_profile(pd.DataFrame({'a': [1, 5], 'b': ['x', 'y']}), profiles={}) == (None, None)
+
+def test_append_csv_directory(tmp_path):
+    pd.DataFrame({
+        'Pos': [1, 2, 3], 'Name': ['Nick Hamilton', 'Pat Goodall', 'Jo Smith'], 'Cat': ['MV40', 'F', 'M'],
+        'Club': ['Totley', 'DPFR', None], 'Time': ['45:10', '50:02', None],
+    }).to_csv(tmp_path / 'Totley Moor 2024.csv', index=False)
+    meta = {'race_name': 'Totley Moor', 'race_date': '2024-05-21', 'race_distance': '10500', 'race_climb': '440'}
+    with open(tmp_path / 'Totley Moor 2024.toml', 'w') as toml_file:
+        toml.dump(meta, toml_file)
+    pd.DataFrame({'Name': ['No Details']}).to_csv(tmp_path / 'Skipped.csv', index=False)
+
+    con = setup_db(tmp_path / 'fellpace.db')
+    con.execute("INSERT INTO Race_Series (Series_Name) VALUES ('Totley Moor')")
+    con.commit()
+    assert append_csv_directory(con, tmp_path) == [1]
+    results = pd.read_sql("SELECT Racer_Name, Time FROM Results JOIN Racers USING (Racer_ID)", con)
+    assert results.values.tolist() == [['Nick Hamilton', 2710], ['Pat Goodall', 3002]]
+
+def test_append_csv_streaming(tmp_path):
+    rng = np.random.default_rng(0)
+    times = rng.integers(2400, 5000, 250)
+    times[::25] = 0 # DNFs
+    pd.DataFrame({
+        'Pos': range(1, 251), 'Name': [f'Runner {i}' for i in range(250)], 'Club': 'Totley',
+        'Time': [f'{t // 60}:{t % 60:02d}' if t else 'DNF' for t in times],
+    }).to_csv(tmp_path / 'big.csv', index=False)
+    meta = FellPace_tools.assign_race_meta(
+        {'race_name': 'Big Race', 'race_date': '2024-05-21', 'race_distance': '10000', 'race_climb': '100'}
+    )
+    con = setup_db(tmp_path / 'fellpace.db')
+    assert append_csv_streaming(con, tmp_path / 'big.csv', meta, chunksize=40) == 1
+    results = pd.read_sql("SELECT Time, ZScore, ZScore_log, Percentile FROM Results ORDER BY Result_ID", con)
+    assert len(results.index) == 240
+    expected = calculate_position_stats(results['Time'].values)
+    for column, values in zip(['ZScore', 'ZScore_log', 'Percentile'], expected):
+        assert np.allclose(results[column], values)
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import fellpace.convert_tools as convert_tools
+from fellpace.convert_tools import time_string_to_seconds, convert_categories, ParkRunConverter
+from fellpace.db.db_setup import setup_db
+
+def legacy_time_string_to_seconds(duration_strings):
+    """time_string_to_seconds as it was, parsing each string in turn."""
+    ftr = [3600,60,1]
+    out =[]
+    for duration_string in duration_strings:
+        try:
+            hrsminssecs = duration_string.split(':')
+            if len(hrsminssecs) < 3:
+                hrsminssecs.insert(0,'00')
+            hrsminssecs[2] = hrsminssecs[2].rsplit('.')[0]
+            out.append(sum([a*b for a,b in zip(ftr, [int(i) for i in hrsminssecs])]))
+        except:
+            try:
+                out.append(int(float(duration_string)*60))
+            except:
+                out.append(None)
+    return out
+
+def make_times(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    h, m, s, f = rng.integers(0, 3, n), rng.integers(0, 60, n), rng.integers(0, 60, n), rng.integers(0, 10, n)
+    formats = [
+        lambda i: f'{h[i]}:{m[i]:02d}:{s[i]:02d}', lambda i: f'{m[i]}:{s[i]:02d}', lambda i: f'{m[i]:02d}:{s[i]:02d}.{f[i]}',
+        lambda i: f'{m[i] + f[i] / 10}', lambda i: float(m[i]), lambda i: None, lambda i: np.nan, lambda i: 'DNF',
+        lambda i: f' {h[i]}:{m[i]:02d}:{s[i]:02d} ', lambda i: f'{m[i]}:', lambda i: '',
+    ]
+    return np.array([formats[i % len(formats)](i) for i in rng.permutation(n)], dtype=object)
+
+def test_time_string_to_seconds_matches_legacy():
+    times = make_times(5000)
+    expected = pd.array(legacy_time_string_to_seconds(times), dtype='Int64')
+    result = time_string_to_seconds(times)
+    assert result.dtype == 'Int64'
+    pd.testing.assert_extension_array_equal(result, expected)
+
+def test_convert_PR_time():
+    times = ['18:02', '18:02PB', '1:02:03', 'New PB!', np.nan, '']
+    result = ParkRunConverter.convert_PR_time(None, times)
+    pd.testing.assert_extension_array_equal(result, pd.array([1082, 1082, 3723, None, None, None], dtype='Int64'))
+
+@pytest.fixture
+def category_aliases(monkeypatch):
+    """Fresh category aliases, so those a test normalises or loads don't leak into others."""
+    monkeypatch.setattr(convert_tools, '_normalised', {source: {} for source in convert_tools.CATEGORY_NORMALISERS})
+    monkeypatch.setattr(convert_tools, '_database_aliases', {})
+
+def get_aliases(con) -> list:
+    return con.execute("SELECT Raw_Name, Cat_Name FROM Category_Aliases WHERE Source = 'results' ORDER BY Raw_Name").fetchall()
+
+def test_categories_saved_and_loaded(tmp_path, category_aliases):
+    con = setup_db(tmp_path / 'fellpace.db')
+    assert convert_categories(['MV45', 'Open', None, 'MV45', 'lsen']) == ['M40', 'SENIOR', 'UNC', 'M40', 'FSENIOR']
+    convert_tools.save_category_aliases(con)
+    aliases = get_aliases(con)
+    assert ('MV45', 'M40') in aliases and ('Open', 'SENIOR') in aliases
+    # A corrected category in the table is used from then on
+    con.execute("UPDATE Category_Aliases SET Cat_Name = 'M45' WHERE Source = 'results' AND Raw_Name = 'MV45'")
+    con.commit()
+    convert_tools.mark_category_aliases_saved(con)
+    assert convert_categories(['MV45'], convert_tools.load_category_aliases(con)) == ['M45']
+    # Without the database's aliases only the normaliser is used
+    assert convert_categories(['MV45']) == ['M40']
+
+    # Another database has its own aliases, and is given the ones it doesn't have
+    other = setup_db(tmp_path / 'other.db')
+    assert convert_categories(['MV45'], convert_tools.load_category_aliases(other)) == ['M40']
+    convert_tools.save_category_aliases(other)
+    assert ('MV45', 'M40') in get_aliases(other)
+
+def test_category_aliases_saved_again_after_rollback(tmp_path, category_aliases):
+    con = setup_db(tmp_path / 'fellpace.db')
+    convert_categories(['MV45', 'Open'], convert_tools.load_category_aliases(con))
+    convert_tools.save_category_aliases(con)
+    con.rollback()
+    assert get_aliases(con) == []
+    convert_tools.save_category_aliases(con)
+    con.commit()
+    convert_tools.mark_category_aliases_saved(con)
+    assert get_aliases(con) == [('MV45', 'M40'), ('Open', 'SENIOR')]
+    # Once committed they aren't written again
+    convert_tools.save_category_aliases(con)
+    assert convert_tools._get_category_aliases(con).saving == []
@@ -0,0 +1,29 @@
+import pandas as pd
+from fellpace.db.db_setup import setup_db
+from fellpace.duplicates import soundex, find_duplicate_racers, merge_racers
+
+def test_soundex():
+    assert [soundex(w) for w in ['Robert', 'Rupert', 'Ashcraft', 'Tymczak', 'Pfister', "O'Neil"]] == \
+        ['R163', 'R163', 'A261', 'T522', 'P236', 'O540']
+
+def test_find_and_merge_duplicates(tmp_path):
+    con = setup_db(tmp_path / 'fellpace.db')
+    con.executemany("INSERT INTO Racers (Racer_ID, Racer_Name) VALUES (?, ?)",
+                    [(1, 'Nick Hamilton'), (2, 'Nick Hamiltn'), (3, 'Nikc Hamilton'), (4, 'Pat Goodall')])
+    con.execute("INSERT INTO Races (Race_ID, Race_Name, Race_Date) VALUES (1, 'Tigger Tor', '2023-09-10')")
+    con.execute("INSERT INTO Races (Race_ID, Race_Name, Race_Date) VALUES (2, 'Tigger Tor', '2024-09-08')")
+    con.executemany("INSERT INTO Results (Race_ID, Racer_ID, Time, ZScore_log) VALUES (?, ?, ?, ?)",
+                    [(1, 1, 3000, -0.5), (2, 2, 3100, -0.4), (1, 3, 3500, 0.2), (1, 4, 4000, 1.0)])
+    con.commit()
+
+    pairs = find_duplicate_racers(con, max_distance=1)
+    assert list(zip(pairs['Racer_ID_a'], pairs['Racer_ID_b'])) == [(1, 2)]
+    assert pairs['Shared_Races'][0] == 0
+    pairs = find_duplicate_racers(con, max_distance=2)
+    assert list(zip(pairs['Racer_ID_a'], pairs['Racer_ID_b'])) == [(1, 2), (1, 3)]
+    assert pairs['Shared_Races'].tolist() == [0, 1]
+
+    merge_racers(con, [(1, 2)])
+    assert con.execute("SELECT Racer_ID FROM Racers ORDER BY Racer_ID").fetchall() == [(1,), (3,), (4,)]
+    scores = pd.read_sql("SELECT Season, Num_Results FROM Racer_Season_Scores WHERE Racer_ID = 1 ORDER BY Season", con)
+    assert scores.values.tolist() == [[2023, 1], [2024, 1]]
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+import fellpace.entries as entries
+import fellpace.FellPace_tools as FellPace_tools
+from fellpace.db.db_setup import setup_db
+from fellpace.entries import predict_many, PREDICTION_COLUMNS
+from test_FellPace_tools import make_race
+
+COEFFS = pd.Series({'Tigger Tor': np.array([1.1, 0.1]), 'Lantern Pike': np.array([0.9, -0.1])})
+COVAR = pd.Series({race_name: np.diag([0.01, 0.005]) for race_name in COEFFS.index})
+
+def make_database(path, n_racers: int = 30, seed: int = 0):
+    con = setup_db(path)
+    fill_database(con, n_racers, seed)
+    con.close()
+
+def fill_database(con, n_racers: int = 30, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    racers = [f'Racer {i}' for i in range(n_racers)]
+    races = [
+        make_race(name, race_date, [(racer, int(t)) for racer, t in zip(racers, rng.normal(3000, 300, n_racers))])
+        for name, race_date in [
+            ('Tigger Tor', '2022-09-11'), ('Lantern Pike', '2023-01-15'),
+            ('Tigger Tor', '2023-09-10'), ('Lantern Pike', '2024-01-14'),
+            ('Tigger Tor', '2024-09-08'), # after the 2024 chase
+        ]
+    ]
+    con.execute("INSERT INTO Categories (Cat_Name) VALUES ('MV40')")
+    con.executemany("INSERT INTO Race_Series (Series_Name) VALUES (?)", [('Tigger Tor',), ('Lantern Pike',)])
+    con.commit()
+    FellPace_tools.append_many_to_DB(con, races)
+    con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (1, '2023-05-20')")
+    con.executemany(
+        "INSERT INTO Results_Chase (Chase_ID, Racer_ID, Time, ZScore_log) VALUES (1, ?, ?, ?)",
+        [(racer_ID, int(3000 * np.exp(0.1 * z)), float(z)) for racer_ID, z in zip(range(1, n_racers + 1, 2), rng.normal(size=n_racers))],
+    )
+    con.commit()
+
+def test_predict_many(tmp_path):
+    path = tmp_path / 'fellpace.db'
+    make_database(path)
+    coeffs, covar = COEFFS, COVAR
+    racer_ids = [5, None, 3, 1, 3, 99] + list(range(6, 31))
+
+    predictions, results = predict_many(racer_ids, 2024, path=path, coeffs=coeffs, covar=covar, with_results=True)
+    assert list(predictions.columns) == PREDICTION_COLUMNS
+    # Unknown and repeated racers are skipped, the rest keep their order
+    assert predictions['Racer_ID'].tolist() == [5, 3, 1] + list(range(6, 31))
+    assert all((racer_results['Season'] < 2024).all() for racer_results in results)
+    assert predictions['Predicted_Time'].notna().all()
+
+    sharded = predict_many(racer_ids, 2024, workers=4, path=path, coeffs=coeffs, covar=covar)
+    pd.testing.assert_frame_equal(sharded, predictions)
+
+@pytest.fixture
+def entries_setup(tmp_path, monkeypatch):
+    monkeypatch.setattr(entries, 'load_models', lambda: (COEFFS, COVAR))
+    monkeypatch.setattr(entries, 'ENTRIES_PATH', tmp_path)
+    return pd.DataFrame({'Name': ['Racer 4', 'Nobody Known', 'Racer 2']})
+
+def test_process_entries_in_memory(entries_setup, monkeypatch):
+    monkeypatch.setattr(entries, 'secure_racer_id', lambda con, racer_name: None)
+    con = setup_db(':memory:')
+    fill_database(con)
+    processed = entries.process_entries(entries_setup, con, 2024, verbose=False)
+    assert processed['Name'].tolist() == ['Racer 4', 'Nobody Known', 'Racer 2']
+    assert processed['Predicted_Time'].tolist()[1] == 'N/A'
+    assert (processed['Num_results_used'].to_numpy()[[0, 2]] > 0).all()
+    # An in-memory database can't be shared with a pool of connections
+    with pytest.raises(ValueError):
+        entries.process_entries(entries_setup, con, 2024, workers=2, verbose=False)
+    con.close()
+
+def test_process_entries_sees_uncommitted_changes(entries_setup, tmp_path, monkeypatch):
+    monkeypatch.setattr(entries, 'secure_racer_id', lambda con, racer_name: None)
+    path = tmp_path / 'fellpace.db'
+    make_database(path)
+    con = setup_db(path)
+    racer_ID = con.execute("SELECT Racer_ID FROM Racers WHERE lower(Racer_Name) = 'racer 2'").fetchone()[0]
+    con.execute("DELETE FROM Racer_Season_Scores WHERE Racer_ID = ?", (racer_ID,))
+    processed = entries.process_entries(entries_setup, con, 2024, verbose=False)
+    assert processed['Predicted_Time'].tolist()[2] == 'N/A'
+    # The pool only sees what was committed
+    processed = entries.process_entries(entries_setup, con, 2024, workers=2, verbose=False)
+    assert processed['Predicted_Time'].tolist()[2] != 'N/A'
+    con.close()
@@ -0,0 +1,41 @@
+import sqlite3
+import fellpace.db.season_scores as season_scores
+from fellpace.db.db_setup import register_functions, setup_db
+from fellpace.db.migrations import MIGRATIONS, SCHEMA_VERSION, get_schema_version, migrate
+
+def test_new_database_is_migrated(tmp_path):
+    con = setup_db(tmp_path / 'fellpace.db')
+    assert get_schema_version(con) == SCHEMA_VERSION
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    # Running again is a no-op
+    assert migrate(con) == SCHEMA_VERSION
+
+    con.executemany(
+        "INSERT INTO Races (Race_Name, Race_Date) VALUES (?, ?)",
+        [('Parkrun_endcliffe_412', '2021-03-06'), ('Parkrun_hillsborough_12', '2021-06-05'), ('Tigger Tor', '2021-09-12')]
+    )
+    races = con.execute("SELECT Canonical_Name, Season FROM Races ORDER BY Race_ID").fetchall()
+    assert races == [('PR_Endcliffe', 2020), ('PR_Hillsborough', 2021), ('Tigger Tor', 2021)]
+
+    plan = con.execute("EXPLAIN QUERY PLAN SELECT Racer_ID FROM Racers WHERE lower(Racer_Name) = ?", ('a',)).fetchall()
+    assert 'Racers_Name_Lower' in plan[0][-1]
+
+def test_season_scores_migration_is_frozen(monkeypatch):
+    con = sqlite3.connect(':memory:')
+    register_functions(con)
+    for migration in MIGRATIONS[:3]:
+        migration(con)
+    con.execute("PRAGMA user_version = 3")
+    con.executemany("INSERT INTO Races (Race_ID, Race_Name, Race_Date) VALUES (?, ?, ?)",
+                    [(1, 'Tigger Tor', '2021-09-12'), (2, 'Tigger Tor', '2022-01-09'), (3, 'Parkrun_endcliffe_412', '2021-03-06')])
+    con.executemany("INSERT INTO Results (Race_ID, Racer_ID, Time, ZScore_log) VALUES (?, ?, ?, ?)",
+                    [(1, 1, 3000, -0.5), (2, 1, 3100, 0.2), (1, 2, 3500, 0.5), (3, 2, 1200, 0.1), (3, 1, None, None)])
+    con.commit()
+    # Migration 4 doesn't use the live season score SQL, which later versions are free to change
+    monkeypatch.setattr(season_scores, 'SQL_INSERT_SEASON_SCORES', 'Not SQL')
+    assert migrate(con) == SCHEMA_VERSION
+    migrated = con.execute("SELECT * FROM Racer_Season_Scores ORDER BY Racer_ID, Race_Name").fetchall()
+    assert [row[:3] for row in migrated] == [(1, 'Tigger Tor', 2021), (2, 'PR_Endcliffe', 2020), (2, 'Tigger Tor', 2021)]
+    monkeypatch.undo()
+    season_scores.refresh_season_scores(con)
+    assert con.execute("SELECT * FROM Racer_Season_Scores ORDER BY Racer_ID, Race_Name").fetchall() == migrated
@@ -0,0 +1,22 @@
+import numpy as np
+import Levenshtein
+from fellpace.extract.name_index import NameIndex
+
+def test_name_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    letters = list('abcdehilmnorst ')
+    names = sorted({''.join(rng.choice(letters, rng.integers(1, 14))).title() for _ in range(2000)})
+    name_index = NameIndex()
+    for racer_ID, name in enumerate(names, start=1):
+        name_index.add(racer_ID, name)
+
+    queries = [''.join(rng.choice(letters, rng.integers(0, 14))) for _ in range(100)]
+    queries += [name.lower()[1:] + 'x' for name in names[::50]]
+    for query in queries:
+        for max_distance in (1, 2):
+            expected = [
+                (racer_ID, name, Levenshtein.distance(query, name.lower()))
+                for racer_ID, name in enumerate(names, start=1)
+                if Levenshtein.distance(query, name.lower()) <= max_distance
+            ]
+            assert name_index.matches(query, max_distance) == expected
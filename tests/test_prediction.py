@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from fellpace.modelling.prediction import get_prediction_with_uncertainty, get_prediction_with_uncertainty_many
+from fellpace.modelling.prediction import get_probability_distribution, get_probability_distributions
+
+def test_prediction_with_uncertainty_many():
+    coeffs = pd.Series({'Race A': [1.1, 0.2], 'Race B': [0.9, -0.1]})
+    covar = pd.Series({
+        'Race A': [[0.003, 0.001], [0.001, 0.002]],
+        'Race B': [[0.004, -0.0005], [-0.0005, 0.003]]
+    })
+    results = pd.DataFrame({
+        'Race_Name': ['Race A', 'Race B', 'Race A', 'Race B'],
+        'ZScore': [-1.2, 0.0, 0.5, 2.3]
+    })
+    predictions = get_prediction_with_uncertainty_many(coeffs, covar, results)
+
+    assert 'Zpred_mu' not in results.columns
+    for _, row in predictions.iterrows():
+        mu, sig = get_prediction_with_uncertainty(coeffs[row['Race_Name']], np.array(covar[row['Race_Name']]), row['ZScore'])
+        assert np.isclose(row['Zpred_mu'], mu)
+        assert np.isclose(row['Zpred_sig'], sig)
+
+def test_probability_distributions():
+    means, std_devs = [0.0, 0.4, -1.1], [1.0, 0.2, 0.05]
+    distributions = get_probability_distributions(means, std_devs)
+    assert distributions.shape == (3, 601)
+    for row, mean, std_dev in zip(distributions, means, std_devs):
+        p = get_probability_distribution(mean, std_dev)
+        assert np.allclose(p.values, row)
+        assert p.index[0] == -3 and np.isclose(p.index[-1], 3)
+        # Probability of the point nearest to the mean, a step wide
+        x = p.index[np.argmin(abs(p.index - mean))]
+        assert np.isclose(p[x], norm.cdf(x + 0.005, mean, std_dev) - norm.cdf(x - 0.005, mean, std_dev))
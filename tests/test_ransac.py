@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import fellpace.modelling.ransac as ransac
+
+def make_data_Zs(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    races = []
+    for race_name in ['Tigger Tor', 'PR_Endcliffe', 'Lantern Pike']:
+        ZScore = rng.normal(size=60)
+        HCScore = 1.2 * ZScore + rng.normal(scale=0.1, size=60)
+        outlier = np.arange(60) < 6
+        HCScore[outlier] += 3
+        races.append(pd.DataFrame({'Race_Name': race_name, 'ZScore': ZScore, 'HCScore': HCScore, 'outlier': outlier}))
+    return pd.concat(races, ignore_index=True).sort_values('Race_Name')
+
+def test_add_inliers_seeded_and_cached(tmp_path, monkeypatch):
+    cache_path = tmp_path / 'inliers.npz'
+    data_Zs = ransac.add_inliers(make_data_Zs(), cache_path=cache_path)
+    assert not data_Zs.loc[data_Zs['outlier'], 'inlier'].any()
+    assert data_Zs['inlier'].sum() > 150
+    # Seeded, so the same without the cache and over a process pool
+    assert ransac.add_inliers(make_data_Zs(), workers=2, cache_path=None)['inlier'].equals(data_Zs['inlier'])
+
+    fitted = []
+    fit_inliers = ransac.fit_inliers
+    monkeypatch.setattr(ransac, 'fit_inliers', lambda race_name, *args: fitted.append(race_name) or fit_inliers(race_name, *args))
+    changed = make_data_Zs()
+    changed.loc[changed['Race_Name'] == 'Tigger Tor', 'HCScore'] += 0.01
+    assert ransac.add_inliers(changed, cache_path=cache_path)['inlier'].equals(data_Zs['inlier'])
+    assert fitted == ['Tigger Tor']
@@ -0,0 +1,10 @@
+import time
+from fellpace.parkrun.scrape_parkrun import TokenBucket
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # The first two are a burst, the other five wait 1/50 s each
+    assert time.monotonic() - start >= 0.09
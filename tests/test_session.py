@@ -0,0 +1,37 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fellpace.db.session import FellPaceDB, ReadOnlyPool
+
+def test_session_closes(tmp_path):
+    with FellPaceDB(tmp_path / 'fellpace.db') as db:
+        db.con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (1, '2024-05-18')")
+        db.con.commit()
+        assert db.chase_summary().shape[0] == 0 # no results yet
+        con = db.con
+    assert db.closed
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.con
+    with pytest.raises(sqlite3.ProgrammingError):
+        con.execute("SELECT 1")
+    db.close()
+
+def test_read_only_pool(tmp_path):
+    path = tmp_path / 'fellpace.db'
+    with FellPaceDB(path) as db:
+        db.con.executemany("INSERT INTO Racers (Racer_Name) VALUES (?)", [(f'racer {i}',) for i in range(100)])
+        db.con.commit()
+
+    def count_racers(pool):
+        with pool.connection() as con:
+            return con.execute("SELECT COUNT(*), ln(1) FROM Racers").fetchone()
+
+    with ReadOnlyPool(path, size=2) as pool:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert set(executor.map(count_racers, [pool] * 20)) == {(100, 0.0)}
+        with pool.connection() as con, pytest.raises(sqlite3.OperationalError):
+            con.execute("DELETE FROM Racers")
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.connection():
+            pass
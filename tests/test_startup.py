@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# The CLI module imports the heavy modules inside the commands that use them
+# and only commands that use the database connect to it (sqlite3)
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy', 'sklearn', 'matplotlib', 'seaborn', 'tabulate', 'sqlite3']
+IMPORT_BUDGET = 1.0 # seconds, about 0.2 s when this was written
+
+def test_cli_cold_start(tmp_path):
+    env = {**os.environ, 'PYTHONPATH': str(Path(__file__).parents[1])}
+    code = f"import sys, fellpace.__main__; print(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True,
+    )
+    assert result.stdout.split() == []
+    # importtime lines are "import time: self [us] | cumulative | module"
+    cumulative = {
+        line.split('|')[2].strip(): int(line.split('|')[1])
+        for line in result.stderr.splitlines() if line.startswith('import time:') and line.split('|')[1].strip().isdigit()
+    }
+    assert cumulative['fellpace.__main__'] / 1e6 < IMPORT_BUDGET
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import fellpace.modelling.sweep as sweep
+from fellpace.modelling.backtest import run_backtest
+from fellpace.modelling.prediction import DEFAULT_PARAMETERS, PredictionParameters
+from test_backtest import add_chase
+from test_entries import make_database
+
+def test_sweep(tmp_path, monkeypatch):
+    path = tmp_path / 'fellpace.db'
+    make_database(path)
+    add_chase(path, 2, '2024-05-18', range(1, 31))
+    cache_dir = tmp_path / 'backtest'
+
+    inputs = sweep.get_sweep_inputs(path=path, cache_dir=cache_dir)
+    assert inputs.finishers['Year'].unique().tolist() == [2024] and len(inputs.finishers) == 30
+    assert inputs.outliers(0.0).any()
+
+    # The vectorised predictions are the ones the backtest makes, whatever the parameters
+    candidates = [DEFAULT_PARAMETERS, PredictionParameters(0.0, 0.5, 2.0, 0.0, 1.0), PredictionParameters(1.0, 1.0, 1.0, 3.0, 0.0)]
+    parameters = pd.DataFrame([vars(candidate) for candidate in candidates])
+    posterior_mu, posterior_sigma = sweep.get_posteriors(inputs, parameters)
+    for candidate, mu, sigma in zip(candidates, posterior_mu, posterior_sigma):
+        predictions, _ = run_backtest([2024], path=path, cache_dir=cache_dir, parameters=candidate)
+        assert predictions['Racer_ID'].tolist() == inputs.finishers['Racer_ID'].tolist()
+        np.testing.assert_allclose(mu, predictions['chase_mu'])
+        np.testing.assert_allclose(sigma, predictions['chase_sig'])
+
+    grid = sweep.parameter_grid({'lambda_decay': [0.0, 0.25], 'outlier_threshold': [0.0, 1.2, 3.0]})
+    ranked = sweep.evaluate_parameters(inputs, pd.concat([grid, sweep.random_parameters(20)], ignore_index=True))
+    assert list(ranked.columns) == sweep.PARAMETERS + sweep.SWEEP_METRICS
+    assert len(ranked) == 26 and ranked[sweep.SWEEP_LOSS].is_monotonic_increasing
+    # Evaluating one candidate at a time, in any order, ranks them the same
+    ranked_grid = sweep.evaluate_parameters(inputs, grid)
+    monkeypatch.setattr(sweep, 'BLOCK_CELLS', 1)
+    pd.testing.assert_frame_equal(sweep.evaluate_parameters(inputs, grid.iloc[::-1]), ranked_grid)
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import fellpace.modelling.training as training
+from fellpace.db.db_setup import setup_db
+
+def make_data_Zs(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    races = []
+    for slope, race_name in zip([0.8, 1.2, 1.5], ['Lantern Pike', 'PR_Endcliffe', 'Tigger Tor']):
+        ZScore = rng.normal(size=40)
+        races.append(pd.DataFrame({
+            'Racer_ID': np.arange(40),
+            'Race_Name': race_name,
+            'Season': 2022 + np.arange(40) % 2,
+            'ZScore': ZScore,
+            'HCScore': slope * ZScore + rng.normal(scale=0.2, size=40),
+            'HCTime': rng.integers(3000, 4000, 40),
+            'inlier': rng.random(40) > 0.1,
+        }))
+    return pd.concat(races, ignore_index=True)
+
+def test_train_models_incremental(tmp_path, monkeypatch):
+    con = setup_db(tmp_path / 'fellpace.db')
+    con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (1, '2023-05-20'), (2, '2024-05-18')")
+    con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (?, ?)", [(c, t) for c in (1, 2) for t in range(3000, 4000, 50)])
+    con.commit()
+    fitted = []
+    fit_from_stats = training.fit_from_stats
+    def record_fit(stats):
+        fitted.append(sorted(stats.index))
+        return fit_from_stats(stats)
+    monkeypatch.setattr(training, 'fit_from_stats', record_fit)
+
+    data_Zs = make_data_Zs()
+    coeffs, covar = training.train_models_incremental(con, data_Zs)
+    expected_coeffs, expected_covar = training.train_models(data_Zs)
+    for race_name in expected_coeffs.index:
+        assert np.allclose(coeffs[race_name], expected_coeffs[race_name])
+        assert np.allclose(covar[race_name], expected_covar[race_name])
+    assert list(training.load_race_models(con).columns) == training.SUFFICIENT_STATS + training.MODEL_COLUMNS
+
+    # Nothing changed, nothing is refitted, only the changed race is refitted after a change
+    training.train_models_incremental(con, data_Zs.sample(frac=1, random_state=0))
+    changed = data_Zs.loc[data_Zs['Race_Name'] != 'Lantern Pike'].copy()
+    changed.loc[changed['Race_Name'] == 'Tigger Tor', 'HCScore'] += 0.5
+    coeffs, _ = training.train_models_incremental(con, changed)
+    assert fitted == [['Lantern Pike', 'PR_Endcliffe', 'Tigger Tor'], ['Tigger Tor']]
+    assert list(coeffs.index) == ['PR_Endcliffe', 'Tigger Tor']
+    assert np.allclose(coeffs['Tigger Tor'], training.train_models(changed)[0]['Tigger Tor'])
+
+def test_evaluate_models(tmp_path):
+    con = setup_db(tmp_path / 'fellpace.db')
+    chase_times = {2023: np.arange(3000, 4000, 50), 2024: np.arange(2800, 4200, 70)}
+    for chase_ID, (year, times) in enumerate(chase_times.items(), start=1):
+        con.execute("INSERT INTO Chases (Chase_ID, Chase_Date) VALUES (?, ?)", (chase_ID, f'{year}-05-20'))
+        con.executemany("INSERT INTO Results_Chase (Chase_ID, Time) VALUES (?, ?)", [(chase_ID, int(t)) for t in times])
+    con.commit()
+    data_Zs = make_data_Zs()
+    coeffs, _ = training.train_models(data_Zs)
+    by_race, by_season = training.evaluate_models(con, data_Zs, coeffs)
+
+    inliers = data_Zs.loc[data_Zs['inlier']]
+    # Each season is predicted with the stats of the chase that follows it
+    log_times = {2022: np.log(chase_times[2023]), 2023: np.log(chase_times[2024])}
+    residuals = pd.Series([
+        np.exp(log_times[row.Season].mean() + log_times[row.Season].std() * np.polyval(coeffs[row.Race_Name], row.ZScore)) - row.HCTime
+        for row in inliers.itertuples()
+    ], index=inliers.index)
+    for summary, column in [(by_race, 'Race_Name'), (by_season, 'Season')]:
+        grouped = residuals.groupby(inliers[column])
+        assert np.allclose(summary['RMSE'], grouped.apply(lambda r: np.sqrt(np.mean(r ** 2))))
+        assert np.allclose(summary['MAE'], grouped.apply(lambda r: r.abs().mean()))
+        assert np.allclose(summary['Bias'], grouped.mean())
+        assert (summary['N'] == grouped.size()).all()
+
+def test_model_file(tmp_path, monkeypatch):
+    coeffs, covar = training.train_models(make_data_Zs())
+    path = tmp_path / 'models.npz'
+    training.save_model_file(coeffs, covar, {'rows': 120}, path)
+    model_file = training.load_model_file(path)
+    assert model_file is training.load_model_file(path) # loaded once
+    assert model_file.metadata['rows'] == 120
+    assert model_file.coeffs.shape == (3, 2) and model_file.covars.shape == (3, 2, 2)
+
+    # load_models reads the model file, or the json models if there isn't one
+    coeffs.to_json(tmp_path / 'coeffs.json')
+    covar.to_json(tmp_path / 'covars.json')
+    monkeypatch.setattr(training, 'COEFFS_FILE_PATH', tmp_path / 'coeffs.json')
+    monkeypatch.setattr(training, 'COVAR_FILE_PATH', tmp_path / 'covars.json')
+    for model_path in [path, tmp_path / 'missing.npz']:
+        monkeypatch.setattr(training, 'MODEL_FILE_PATH', model_path)
+        loaded_coeffs, loaded_covar = training.load_models()
+        for race_name in coeffs.index:
+            assert np.allclose(loaded_coeffs[race_name], coeffs[race_name])
+            assert np.allclose(loaded_covar[race_name], covar[race_name])